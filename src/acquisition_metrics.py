@@ -0,0 +1,245 @@
+import datetime
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Timings of each stage of taking a reading, kept in the acquisition process as histograms so that the
+# cost on each reading is a clock read and a few integer operations. The histograms are exported
+# periodically to a status file, and optionally as text metrics over http for a metrics collector.
+
+# Stages of a reading
+STAGE_WAIT = "wait"        # Waiting for the end of the integration
+STAGE_I2C = "i2c"          # Reading the sensor registers and clearing the interrupt
+STAGE_LUX = "lux"          # Calculating the lux
+STAGE_ENV = "env"          # Reading the environmental sensors (in their own thread)
+STAGE_LOG = "log"          # Queueing the reading for the data files, event capture and detection
+STAGE_SQM = "sqm"          # Publishing the SQM reading
+STAGE_JITTER = "jitter"    # Difference between the time between readings and the integration time
+
+STATUS_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else '/tmp'
+EXPORT_INTERVAL = 60.0
+
+# Histogram buckets are powers of 2 microseconds: bucket i holds times from 2^(i-1) up to 2^i us,
+# and the last bucket everything from about 16 s
+BUCKETS = 25
+BUCKET_LIMITS = [2 ** i / 1e6 for i in range(BUCKETS - 1)] + [float('inf')]
+
+# All the metrics in the process, for the exporter
+_metrics = []
+
+
+class StageHistogram():
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, ns):
+        self.buckets[min(BUCKETS - 1, (ns // 1000).bit_length())] += 1
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    def quantile(self, q):
+        # Upper limit in seconds of the bucket holding the q quantile
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.buckets):
+            cumulative += count
+            if cumulative >= target:
+                return min(BUCKET_LIMITS[i], self.max_ns / 1e9)
+        return self.max_ns / 1e9
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_ns / self.count / 1e6, 3) if self.count else 0.0,
+            "p50_ms": round(1000 * self.quantile(0.5), 3),
+            "p99_ms": round(1000 * self.quantile(0.99), 3),
+            "max_ms": round(self.max_ns / 1e6, 3),
+        }
+
+
+class AcquisitionMetrics():
+    # Stage timings and counters for one sensor. Stages are timed with lap:
+    #     t = metrics.now()
+    #     ...
+    #     t = metrics.lap(STAGE_I2C, t)
+    # Stage timings use the performance counter. The time between readings and the gain switch downtime
+    # use the monotonic clock, as the sensor's integrations do (and which simulator.py speeds up)
+
+    def __init__(self, name=""):
+        self.name = name
+        self.stages = {}
+        self.missed_integrations = 0
+        self.discarded_readings = 0
+        self.gain_switches = 0
+        self.gain_switch_time = 0.0
+        self.gain_switch_start = None
+        self.last_reading = None
+        _metrics.append(self)
+
+    now = staticmethod(time.perf_counter_ns)
+
+    def add(self, stage, ns):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = StageHistogram()
+        histogram.add(ns)
+
+    def lap(self, stage, start_ns):
+        # Record the time since start_ns for the stage, and return the time now to start the next stage
+        now = time.perf_counter_ns()
+        self.add(stage, now - start_ns)
+        return now
+
+    def reading(self, integration_time):
+        # Record the time between readings against the integration time in seconds, and count
+        # the integrations missed if the reading came late
+        now = time.monotonic()
+        if self.last_reading is not None:
+            interval = now - self.last_reading
+            self.add(STAGE_JITTER, int(abs(interval - integration_time) * 1e9))
+            missed = int(interval / integration_time + 0.5) - 1
+            if missed > 0:
+                self.missed_integrations += missed
+        self.last_reading = now
+
+    def restart(self):
+        # The next reading follows a pause e.g. a sensor reset, so don't count it as a late reading
+        self.last_reading = None
+
+    def gain_switch_started(self):
+        if self.gain_switch_start is None:
+            self.gain_switch_start = time.monotonic()
+            self.gain_switches += 1
+
+    def gain_switch_finished(self):
+        # Readings are valid again after a gain switch
+        if self.gain_switch_start is not None:
+            self.gain_switch_time += time.monotonic() - self.gain_switch_start
+            self.gain_switch_start = None
+            self.restart()
+
+    def summary(self):
+        return {
+            "stages": {stage: histogram.summary() for stage, histogram in self.stages.items()},
+            "missed_integrations": self.missed_integrations,
+            "discarded_readings": self.discarded_readings,
+            "gain_switches": self.gain_switches,
+            "gain_switch_seconds": round(self.gain_switch_time, 3),
+        }
+
+
+def sensor_labels():
+    # Unique label of each of the metrics: the sensor name, numbered if several sensors have the same name
+    # e.g. "GAIN_MAX", "GAIN_MAX_2"
+    labels = []
+    seen = {}
+    for metrics in _metrics:
+        seen[metrics.name] = seen.get(metrics.name, 0) + 1
+        labels.append(metrics.name if seen[metrics.name] == 1 else "{0:s}_{1:d}".format(metrics.name, seen[metrics.name]))
+    return list(zip(labels, _metrics))
+
+
+def metrics_status():
+    # Status of all the sensors in the process, for the status file
+    return {
+        "time": datetime.datetime.now().isoformat(timespec='seconds'),
+        "pid": os.getpid(),
+        "sensors": {label: metrics.summary() for label, metrics in sensor_labels()},
+    }
+
+
+def metrics_text():
+    # All the metrics in the text format read by Prometheus and compatible collectors
+    sensors = sensor_labels()
+    lines = ["# TYPE radiometer_stage_seconds histogram"]
+    for label, metrics in sensors:
+        for stage, histogram in list(metrics.stages.items()):
+            labels = 'sensor="{0:s}",stage="{1:s}"'.format(label, stage)
+            cumulative = 0
+            for limit, count in zip(BUCKET_LIMITS, histogram.buckets):
+                cumulative += count
+                le = "+Inf" if limit == float('inf') else repr(limit)
+                lines.append('radiometer_stage_seconds_bucket{{{0:s},le="{1:s}"}} {2:d}'.format(labels, le, cumulative))
+            lines.append('radiometer_stage_seconds_sum{{{0:s}}} {1:.9f}'.format(labels, histogram.total_ns / 1e9))
+            lines.append('radiometer_stage_seconds_count{{{0:s}}} {1:d}'.format(labels, histogram.count))
+    for name in ("missed_integrations", "discarded_readings", "gain_switches"):
+        lines.append("# TYPE radiometer_{0:s}_total counter".format(name))
+        for label, metrics in sensors:
+            lines.append('radiometer_{0:s}_total{{sensor="{1:s}"}} {2:d}'.format(
+                name, label, getattr(metrics, name)))
+    lines.append("# TYPE radiometer_gain_switch_seconds_total counter")
+    for label, metrics in sensors:
+        lines.append('radiometer_gain_switch_seconds_total{{sensor="{0:s}"}} {1:.3f}'.format(
+            label, metrics.gain_switch_time))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsExporter():
+    # Writes the status file every interval seconds, and optionally serves the metrics over http on port
+
+    def __init__(self, file_name, interval=EXPORT_INTERVAL, port=None):
+        self.file_name = file_name
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.server = None
+        if port is not None:
+            self.server = ThreadingHTTPServer(("", port), MetricsRequestHandler)
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.server is not None:
+            self.server.shutdown()
+
+    def write_status(self):
+        # Write a new file and move it into place, so that readers never see a partly written file
+        tmp_name = self.file_name + ".tmp"
+        with open(tmp_name, "w") as file:
+            json.dump(metrics_status(), file, indent=1)
+        os.replace(tmp_name, self.file_name)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.write_status()
+            except Exception as e:
+                print("Error writing metrics status:", e)
+
+
+def start_metrics_exporter(script_name, interval=EXPORT_INTERVAL, port=None):
+    # Status file named after the script e.g. /dev/shm/sqm_tsl2591_metrics.json
+    file_name = os.path.join(STATUS_DIR, script_name + "_metrics.json")
+    return MetricsExporter(file_name, interval=interval, port=port).start()
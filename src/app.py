@@ -1,12 +1,117 @@
-from flask import Flask, jsonify, render_template
+from flask import Flask, Response, jsonify, render_template, request
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import json
 import os
+import threading
+import time
+import zlib
+from collections import deque
+from day_file_index import read_time_range
+from day_file_loader import parse_lines
+from decimation import min_max_indices
+from data_rollups import choose_level, read_rollups
 
 app = Flask(__name__)
 
 CAPTURE_DIR = '/home/pi/radiometer_data/'
 
+# Domyślna liczba punktów zwracanych przez /data - wykres i tak nie narysuje więcej
+DEFAULT_POINTS = 2000
+
+# Pola odpowiedzi kolumnowej i liczba wierszy kodowanych naraz
+RESPONSE_FIELDS = ["DateTime", "Lux", "Visible", "IR", "Gain", "IntTime", "Temp", "Humidity", "Pressure", "DewPoint", "CloudTemp"]
+CHUNK_ROWS = 10000
+
+# Dodatkowe pola odpowiedzi kolumnowej z podsumowań minutowych i godzinnych (data_rollups.py)
+ROLLUP_FIELDS = ["LuxMin", "LuxMax", "LuxMedian", "SQMDarkest", "Count"]
+
+# Szybka kompresja - na Raspberry Pi Zero czas procesora jest cenniejszy niż kilka procent rozmiaru
+COMPRESSION_LEVEL = 1
+
+# Strumień /live: odstęp sprawdzania pliku dziennego, liczba komunikatów pamiętanych dla klientów
+# wznawiających połączenie i odstęp komentarzy podtrzymujących połączenie (sekundy)
+LIVE_POLL_INTERVAL = 0.5
+LIVE_HISTORY = 120
+LIVE_KEEPALIVE = 15.0
+
+# Plik z poprzedniego dnia, nie modyfikowany od tylu sekund, jest kompletny - parsowany raz i przypięty w pamięci
+PIN_AGE = 300
+
+class CachedDayFile():
+    # Sparsowana zawartość pliku dziennego. Gdy plik rośnie, parsowane są tylko dopisane bajty
+    # (do ostatniego pełnego wiersza) i dołączane do kolumn w pamięci. Zmiana i-węzła, skrócenie pliku
+    # lub zmiana czasu modyfikacji bez zmiany rozmiaru oznacza nowy plik - parsowany od początku
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.inode = None
+        self.size = 0
+        self.mtime = None
+        self.offset = 0  # Koniec ostatniego sparsowanego wiersza
+        self.frame = None
+        self.pinned = False
+
+    def reset(self, inode):
+        self.inode = inode
+        self.size = 0
+        self.mtime = None
+        self.offset = 0
+        self.frame = None
+
+    def refresh(self, complete=False):
+        # Zwraca DataFrame z zawartością pliku lub None dla pustego pliku. FileNotFoundError, jeśli pliku nie ma
+        if self.pinned:
+            return self.frame
+        stat = os.stat(self.file_name)
+        if stat.st_ino != self.inode or stat.st_size < self.size or (
+                stat.st_size == self.size and stat.st_mtime_ns != self.mtime):
+            self.reset(stat.st_ino)
+
+        # Kompletny plik jest czytany do końca, także z niezakończonym ostatnim wierszem
+        final = complete and time.time() - stat.st_mtime > PIN_AGE
+        if stat.st_size > self.size or (final and stat.st_size > self.offset):
+            with open(self.file_name, "rb") as file:
+                file.seek(self.offset)
+                data = file.read(stat.st_size - self.offset)
+            end = len(data) if final else data.rfind(b"\n") + 1
+            if data[:end].strip():
+                # Czas z kolumn Date i Time jako DateTime, wartości w zwartych typach (day_file_loader.py)
+                chunk = parse_lines(data[:end])
+                self.frame = chunk if self.frame is None else pd.concat([self.frame, chunk], ignore_index=True)
+                self.offset += end
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+
+        self.pinned = final
+        return self.frame
+
+# Pamięć podręczna plików dziennych wspólna dla wszystkich zapytań, według ścieżki pliku
+_day_files = {}
+_day_files_lock = threading.Lock()
+
+def read_day_files(file_names):
+    # Zawartość plików dziennych; wszystkie oprócz ostatniego (dzisiejszego) są kompletne
+    dfs = []
+    with _day_files_lock:
+        for file_name in list(_day_files):
+            if file_name not in file_names:
+                del _day_files[file_name]
+        for i, file_name in enumerate(file_names):
+            day_file = _day_files.setdefault(file_name, CachedDayFile(file_name))
+            try:
+                frame = day_file.refresh(complete=i < len(file_names) - 1)
+                if frame is not None:
+                    dfs.append(frame)
+            except FileNotFoundError:
+                del _day_files[file_name]
+                print(f"Nie znaleziono pliku: {file_name}")
+            except pd.errors.ParserError as e:
+                day_file.reset(None)
+                print(f"Błąd podczas parsowania pliku {file_name}: {e}")
+    return dfs
+
 def get_filenames():
     today = datetime.now()
     yesterday = today - timedelta(days=1)
@@ -17,29 +122,113 @@ def get_filenames():
 def index():
     return render_template('index.html')
 
+def parse_time(value):
+    return None if value is None else pd.Timestamp(value)
+
+def time_range(frame, start, end):
+    # Wiersze ramki między start a end (włącznie), wyszukiwane binarnie po posortowanym czasie
+    times = frame["DateTime"].values
+    first = 0 if start is None else np.searchsorted(times, start.to_datetime64(), side='left')
+    last = len(times) if end is None else np.searchsorted(times, end.to_datetime64(), side='right')
+    return frame.iloc[first:last]
+
+def select_frames(dfs, start=None, end=None, points=0):
+    # Wiersze z zakresu czasu, zdecymowane do około points wierszy (0 - wszystkie wiersze),
+    # jako lista fragmentów ramek plików dziennych
+    frames = [time_range(frame, start, end) for frame in dfs]
+    frames = [frame for frame in frames if len(frame)]
+    if points > 0 and frames:
+        times = np.concatenate([frame["DateTime"].values.astype(np.int64) for frame in frames])
+        # Dla podsumowań szczyty są w LuxMax, a minima w LuxMin
+        rollups = all("LuxMax" in frame for frame in frames)
+        lux = np.concatenate([frame["LuxMax" if rollups else "Lux"].values.astype(np.float64) for frame in frames])
+        low = np.concatenate([frame["LuxMin"].values.astype(np.float64) for frame in frames]) if rollups else None
+        indices = min_max_indices(times, lux, points, low)
+        # Wybór wierszy z każdej ramki osobno, bez łączenia całych ramek
+        offsets = np.cumsum([0] + [len(frame) for frame in frames])
+        frames = [frame.iloc[indices[(indices >= lo) & (indices < hi)] - lo]
+                  for frame, lo, hi in zip(frames, offsets[:-1], offsets[1:])]
+    return frames
+
+def request_frames(default_points):
+    # Parametry zapytania: start i end (np. 2023-01-13T02:14:00) oraz points. Długi zakres czytany jest
+    # z najgrubszych podsumowań (minutowych lub godzinnych), które dają co najmniej points punktów.
+    # Krótszy zakres zaczynający się przed wczorajszym dniem czytany jest z plików dziennych przez indeks
+    start = parse_time(request.args.get("start"))
+    end = parse_time(request.args.get("end"))
+    points = int(request.args.get("points", default_points))
+    yesterday = pd.Timestamp(datetime.now().date() - timedelta(days=1))
+    range_end = end if end is not None else pd.Timestamp(datetime.now())
+    level = None
+    if start is not None and points > 0:
+        level = choose_level(start, range_end, points)
+    if level is not None:
+        dfs = [read_rollups(CAPTURE_DIR, start, range_end, level)]
+    elif start is not None and start < yesterday:
+        dfs = [read_time_range(CAPTURE_DIR, start, range_end)]
+    else:
+        dfs = read_day_files(get_filenames())
+    return select_frames(dfs, start, end, points)
+
+def request_rows(default_points):
+    frames = request_frames(default_points)
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+def encode_values(values):
+    # Tablica JSON bez nawiasów; NaN (brak odczytu) jako null
+    text = json.dumps(values.tolist())[1:-1]
+    if "N" in text or "I" in text:
+        text = text.replace("-Infinity", "null").replace("Infinity", "null").replace("NaN", "null")
+    return text
+
+def columns_json(frames):
+    # Obiekt JSON z tablicą dla każdego pola, np. {"DateTime": [...], "Lux": [...], ...}, generowany
+    # kawałkami po CHUNK_ROWS wierszy, bez budowania obiektów Pythona dla każdego wiersza.
+    # DateTime w milisekundach od 1970-01-01 (czas lokalny zapisany w plikach)
+    fields = RESPONSE_FIELDS + [field for field in ROLLUP_FIELDS if frames and all(field in frame for frame in frames)]
+    for i, field in enumerate(fields):
+        yield ('{"' if i == 0 else '],"') + field + '":['
+        separator = ""
+        for frame in frames:
+            values = frame[field].values
+            if field == "DateTime":
+                values = values.astype(np.int64) // 1000000
+            for first in range(0, len(values), CHUNK_ROWS):
+                yield separator + encode_values(values[first:first + CHUNK_ROWS])
+                separator = ","
+    yield ']}'
+
+def compressed(chunks, encoding):
+    # Kompresja strumienia: gzip lub deflate (format zlib) zależnie od nagłówka Accept-Encoding
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+def columns_response(frames):
+    encoding = request.accept_encodings.best_match(["gzip", "deflate"])
+    headers = {"Vary": "Accept-Encoding"}
+    chunks = columns_json(frames)
+    if encoding is None:
+        return Response((chunk.encode() for chunk in chunks), mimetype="application/json", headers=headers)
+    headers["Content-Encoding"] = encoding
+    return Response(compressed(chunks, encoding), mimetype="application/json", headers=headers)
+
 @app.route('/data')
 def get_data():
-    file_names = get_filenames()
-    dfs = []
-    for file_name in file_names:
-        try:
-            temp_df = pd.read_csv(
-                file_name,
-                sep=" ",  # Separator w pliku CSV
-                names=["Date", "Time", "Lux", "Visible", "IR", "Gain", "IntTime", "Temp", "Humidity", "Pressure", "DewPoint", "CloudTemp"],
-                parse_dates={"DateTime": ["Date", "Time"]},  # Połącz datę i godzinę w jedną kolumnę "DateTime"
-                date_format="%Y/%m/%d %H:%M:%S.%f",  # Format daty i godziny
-                on_bad_lines='warn'  # Wypisuj ostrzeżenia o błędnych liniach
-            )
-
-            dfs.append(temp_df)
-        except FileNotFoundError:
-            print(f"Nie znaleziono pliku: {file_name}")
-        except pd.errors.ParserError as e:
-            print(f"Błąd podczas parsowania pliku {file_name}: {e}")
-
-    df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
-    
+    # Seria zdecymowana do parametru points (domyślnie DEFAULT_POINTS); points=0 zwraca wszystkie wiersze.
+    # format=columns zwraca tablicę dla każdego pola, strumieniowo i skompresowaną
+    try:
+        frames = request_frames(DEFAULT_POINTS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if request.args.get("format") == "columns":
+        return columns_response(frames)
+
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
     # Konwersja danych na format JSON
     json_data = df.to_dict(orient='records')
     formatted_json = [
@@ -61,6 +250,148 @@ def get_data():
     
     return jsonify(formatted_json)
 
+@app.route('/download')
+def download_data():
+    # Pełna rozdzielczość z zakresu start - end jako plik csv w formacie plików dziennych
+    try:
+        df = request_rows(0)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    csv_text = ""
+    if len(df):
+        df.insert(0, "Date", df["DateTime"].dt.strftime("%Y/%m/%d"))
+        df["DateTime"] = df["DateTime"].dt.strftime("%H:%M:%S.%f").str[:-3]
+        # Jak w plikach dziennych: lux z 9 miejscami po przecinku, zliczenia jako liczby całkowite i brak odczytu jako nan,
+        # aby pobrany plik można było wczytać tak jak plik dzienny (day_file_loader)
+        df["Lux"] = df["Lux"].map("{:.9f}".format)
+        for column in ("Visible", "IR"):
+            df[column] = df[column].round().astype("Int64")
+        csv_text = df.to_csv(sep=" ", header=False, index=False, na_rep="nan")
+    return Response(csv_text, mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename=radiometer_data.csv"})
+
+
+class LiveFeed():
+    # Jeden wątek czytający przyrosty bieżącego pliku dziennego dla wszystkich klientów /live.
+    # Odczyty są agregowane co sekundę, a każdy komunikat Server-Sent Events jest formatowany raz
+    # i trafia do wspólnej historii, z której czytają wszyscy klienci - koszt nie rośnie z liczbą klientów
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.messages = deque(maxlen=LIVE_HISTORY)  # (numer, tekst komunikatu)
+        self.sequence = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def wait(self, after, timeout):
+        # Komunikaty o numerach większych niż after; pusta lista, jeśli przez timeout sekund nic nie przyszło
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence > after, timeout)
+            return [message for message in self.messages if message[0] > after]
+
+    def publish(self, record):
+        with self.condition:
+            self.sequence += 1
+            self.messages.append((self.sequence, f"id: {self.sequence}\ndata: {json.dumps(record)}\n\n"))
+            self.condition.notify_all()
+
+    def aggregate(self, second, lines):
+        # Podsumowanie odczytów z jednej sekundy: średnie, minimum i maksimum lux (szczyty bolidów)
+        # oraz ostatnie wzmocnienie i dane środowiskowe
+        rows = [line.split() for line in lines]
+        lux = [float(row[2]) for row in rows]
+        last = rows[-1]
+        record = {
+            "DateTime": int(datetime.strptime(second, "%Y/%m/%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp() * 1000),
+            "Count": len(rows),
+            "Lux": sum(lux) / len(lux),
+            "LuxMin": min(lux),
+            "LuxMax": max(lux),
+            "Visible": sum(float(row[3]) for row in rows) / len(rows),
+            "IR": sum(float(row[4]) for row in rows) / len(rows),
+            "Gain": float(last[5]),
+            "IntTime": float(last[6]),
+        }
+        for name, value in zip(RESPONSE_FIELDS[6:], last[7:12]):
+            record[name] = float(value)
+        # Brak odczytu (nan) jako null, bo JSON nie ma NaN
+        return {name: None if value != value else value for name, value in record.items()}
+
+    def run(self):
+        file_name = None
+        offset = 0
+        partial = b""
+        second = None
+        lines = []
+        while True:
+            try:
+                today = get_filenames()[-1]
+                if today != file_name:
+                    # Przy starcie tylko nowe odczyty; nowy plik dzienny od początku
+                    new_day = file_name is not None
+                    file_name = today
+                    offset = 0 if new_day or not os.path.exists(file_name) else os.path.getsize(file_name)
+                    partial = b""
+                if os.path.exists(file_name) and os.path.getsize(file_name) > offset:
+                    with open(file_name, "rb") as file:
+                        file.seek(offset)
+                        data = file.read()
+                    offset += len(data)
+                    data = partial + data
+                    end = data.rfind(b"\n") + 1
+                    partial = data[end:]
+                    for line in data[:end].decode(errors="replace").splitlines():
+                        if len(line) < 19:
+                            continue
+                        if line[:19] != second:
+                            if lines:
+                                self.publish(self.aggregate(second, lines))
+                            second = line[:19]
+                            lines = []
+                        lines.append(line)
+            except Exception as e:
+                print(f"Błąd odczytu danych na żywo: {e}")
+                second = None
+                lines = []
+            time.sleep(LIVE_POLL_INTERVAL)
+
+_live_feed = None
+_live_feed_lock = threading.Lock()
+
+def live_feed():
+    # Wątek czytający plik dzienny uruchamiany przy pierwszym kliencie
+    global _live_feed
+    with _live_feed_lock:
+        if _live_feed is None:
+            _live_feed = LiveFeed()
+        return _live_feed
+
+@app.route('/live')
+def live():
+    # Server-Sent Events z podsumowaniem każdej sekundy odczytów. Klient wznawiający połączenie
+    # (nagłówek Last-Event-ID) dostaje komunikaty, które go ominęły, o ile są jeszcze w historii
+    feed = live_feed()
+    try:
+        last = int(request.headers.get("Last-Event-ID", feed.sequence))
+    except ValueError:
+        last = feed.sequence
+    # Numer z poprzedniego uruchomienia serwera
+    last = min(last, feed.sequence)
+
+    def events():
+        after = last
+        while True:
+            messages = feed.wait(after, LIVE_KEEPALIVE)
+            if not messages:
+                yield ": keepalive\n\n"
+                continue
+            for sequence, text in messages:
+                yield text
+            after = messages[-1][0]
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=7777)
@@ -0,0 +1,118 @@
+import argparse
+import datetime
+import os
+import statistics
+import tempfile
+import time
+import radiometer_logger
+from radiometer_logger import BatchedDataLogger, DayFileSink
+
+# Emulated slow SD card. Each file operation is delayed, so the cost of opening, writing and
+# syncing the data file is seen by whichever thread performs it.
+OPEN_LATENCY = 0.002
+WRITE_LATENCY = 0.001
+WRITE_BANDWIDTH = 2e6   # bytes/s
+CLOSE_LATENCY = 0.001
+FSYNC_LATENCY = 0.05
+
+# The unthrottled fsync, as os.fsync is replaced while measuring the batched logger
+real_fsync = os.fsync
+
+LINE_FORMAT = '{0:s} {1:.9f} {2:1f} {3:1f} {4:.1f} {5:.1f} {6:.2f} {7:.2f} {8:.2f} {9:.2f} {10:.2f}\n'
+
+
+class ThrottledFile():
+    # File wrapper that adds SD card like delays to each operation
+
+    def __init__(self, file_name, mode):
+        time.sleep(OPEN_LATENCY)
+        self.file = open(file_name, mode)
+
+    def write(self, data):
+        time.sleep(WRITE_LATENCY + len(data) / WRITE_BANDWIDTH)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        time.sleep(CLOSE_LATENCY)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def throttled_fsync(fd):
+    time.sleep(FSYNC_LATENCY)
+    real_fsync(fd)
+
+
+def open_per_line_log_data(data_dir, obs_time, *values):
+    # The previous RadiometerDataLogger.log_data: build the file name, open, append and close for each reading
+    filename = "R" + obs_time.strftime("%Y%m%d") + ".csv"
+    with ThrottledFile(data_dir + filename, "a") as file:
+        file.write(LINE_FORMAT.format(
+            obs_time.strftime("%Y/%m/%d %H:%M:%S.%f")[:-3], *values))
+
+
+def sample_values(i):
+    return (0.0123 + i * 1e-6, 120, 40, 9876.0, 100.0, 4.5, 81.2, 1003.4, 1.5, -20.3)
+
+
+def measure(log_function, samples):
+    # Time spent in the sampling loop for each reading
+    times = []
+    for i in range(samples):
+        obs_time = datetime.datetime.now()
+        start = time.perf_counter()
+        log_function(obs_time, *sample_values(i))
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def report(label, times):
+    times = sorted(times)
+    print("{0:s}: mean {1:.3f} ms, median {2:.3f} ms, 99% {3:.3f} ms, max {4:.3f} ms per reading".format(
+        label, 1000 * statistics.mean(times), 1000 * statistics.median(times),
+        1000 * times[int(0.99 * (len(times) - 1))], 1000 * times[-1]))
+
+
+# Main program
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(
+        description='Measure the per reading cost of logging to an emulated slow SD card')
+    ap.add_argument("-n", "--samples", type=int, default=2000,
+                    help="Number of readings to log. Default is 2000")
+    args = vars(ap.parse_args())
+    samples = args['samples']
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir += "/"
+
+        times = measure(lambda obs_time, *values: open_per_line_log_data(
+            data_dir, obs_time, *values), samples)
+        report("Open per line", times)
+
+        # Use the throttled file for the batched logger's writer thread
+        radiometer_logger.open = ThrottledFile
+        os.fsync = throttled_fsync
+        try:
+            logger = BatchedDataLogger([DayFileSink("B", "", LINE_FORMAT, data_dir=data_dir)])
+            times = measure(lambda obs_time, *values: logger.log(0, obs_time, *values), samples)
+            start = time.perf_counter()
+            logger.close()
+            report("Batched", times)
+            print("Batched: {0:.1f} ms to drain the queue on close, {1:d} readings dropped".format(
+                1000 * (time.perf_counter() - start), logger.dropped))
+        finally:
+            os.fsync = real_fsync
+            del radiometer_logger.open
@@ -6,6 +6,8 @@ import numpy as np
 import scipy.stats
 import ephem
 import datetime
+import tsl2591_lux
+from data_archive import read_archive_file
 
 TWILIGHT_HORIZON = '-9.0'     # Set degree below horizon for twilight (astronomical is -18 degrees)
 
@@ -52,13 +54,46 @@ class DayNightChecker() :
         except:
             return False
 
+    def sun_down_intervals(self, start, end):
+        # Times (datetime64[ns], UTC as for ephem) of each setting of the sun from before start to end, and
+        # the following rising. Calculated once per night, instead of for each reading
+        settings = []
+        risings = []
+        time = ephem.Date(ephem.Date(start) - 1)
+        end = ephem.Date(end)
+        while time <= end:
+            try:
+                setting = self.location.next_setting(self.sun, start=time)
+                rising = self.location.next_rising(self.sun, start=setting)
+            except ephem.CircumpolarError:
+                # No setting or rising, e.g. in the summer at high latitude: counted as day, as by is_sun_down
+                time = ephem.Date(time + 1)
+                continue
+            settings.append(setting.datetime())
+            risings.append(rising.datetime())
+            time = rising
+        return np.array(settings, dtype='datetime64[ns]'), np.array(risings, dtype='datetime64[ns]')
+
+    def sun_down(self, times):
+        # Whether the sun is down at each of the times (datetime64 values), found by binary search of the
+        # intervals between setting and rising
+        times = np.asarray(times, dtype='datetime64[ns]')
+        if len(times) == 0:
+            return np.zeros(0, dtype=bool)
+        settings, risings = self.sun_down_intervals(pd.Timestamp(times.min()).to_pydatetime(),
+                                                    pd.Timestamp(times.max()).to_pydatetime())
+        if len(settings) == 0:
+            return np.zeros(len(times), dtype=bool)
+        interval = np.searchsorted(settings, times, side='right') - 1
+        return (interval >= 0) & (times < risings[np.maximum(interval, 0)])
+
 # Main program
 if __name__ == "__main__":
 
     # Construct the argument parser and parse the arguments
     ap = argparse.ArgumentParser(description='Compare lux meter SQM data to RMS FS measurements')
     ap.add_argument("sqm_file", type=str,
-                    help="File to analyse.")
+                    help="File to analyse. Either SQM readings (csv), or an archived radiometer data file (.parquet) for which the SQM is calculated from the lux")
     ap.add_argument("rms_file", type=str,
                     help="RMS FS file to analyse.")
     ap.add_argument("-c", "--config_dir", type=str, default='.',
@@ -88,7 +123,17 @@ if __name__ == "__main__":
     # Use this for reading RMS background pixel file
     # df_photom = pd.read_csv(photom_file, sep=' ', dtype={'Date':'string', 'Time':'string'})
 
-    df_sqm = pd.read_csv(sqm_file, sep=',')
+    if sqm_file.endswith(".parquet"):
+        # Read only the lux of the night being compared
+        start_date = end_date = None
+        if night is not None:
+            start_date = datetime.datetime.strptime(night + ' 12:00', "%Y%m%d %H:%M")
+            end_date = start_date + datetime.timedelta(days=1)
+        df_sqm = read_archive_file(sqm_file, ["Lux"], start_date, end_date)
+        df_sqm["SQM"] = tsl2591_lux.sqm(df_sqm.Lux.where(df_sqm.Lux > 0))
+        df_sqm = df_sqm.rename(columns={"DateTime": "times"})
+    else:
+        df_sqm = pd.read_csv(sqm_file, sep=',')
 
     print(df_fs)
     print(df_sqm)
@@ -97,8 +142,9 @@ if __name__ == "__main__":
     df_fs["times"] = pd.to_datetime(df_fs.DateTime,
                            format="%Y-%m-%d %H:%M:%S.%f")
 
-    df_sqm["times"] = pd.to_datetime(df_sqm.Date + " " + df_sqm.Time,
-                           format="%Y/%m/%d %H:%M:%S")
+    if "times" not in df_sqm:
+        df_sqm["times"] = pd.to_datetime(df_sqm.Date + " " + df_sqm.Time,
+                               format="%Y/%m/%d %H:%M:%S")
 
 
     # Merge the data into 1 dataframe
@@ -121,13 +167,7 @@ if __name__ == "__main__":
         df = res[res['times'] < end_date]
 
     # Clip the data outside astronomical twilight (sun 18 degrees below horizon)
-    indexes = []
-    for index, row in df.iterrows():
-        if not night_checker.is_sun_down(row.times) :
-            # print("Dropping", index, row.times)
-            indexes.append(index)
-    
-    df.drop(index=indexes, inplace=True)
+    df = df[night_checker.sun_down(df.times.values)]
 
     print(df)
 
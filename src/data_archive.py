@@ -0,0 +1,134 @@
+import argparse
+import datetime
+import glob
+import os
+import time
+import pandas as pd
+from day_file_index import index_file_name
+from day_file_loader import VALUE_COLUMNS, parse_lines
+
+# Archive of closed csv day files as compressed, columnar Parquet files, one per day file in year and
+# month directories e.g. ~/radiometer_data/archive/2023/01/R20230113.parquet. Reading a time range only
+# opens the files of the days in the range, and within them only the row groups (hours) and columns needed.
+#
+# Needs pyarrow (pip install pyarrow), which is only imported when the archive is written or read.
+
+DATA_DIR = os.path.expanduser('~/radiometer_data/')
+ARCHIVE_DIR = os.path.join(DATA_DIR, 'archive')
+
+# Day files are archived once they have not been written to for this many seconds
+CLOSED_AGE = 3600
+
+COMPRESSION = 'zstd'
+
+# An hour of readings at 10 Hz in each row group, so that a time range reads at most an hour either side
+ROW_GROUP_SIZE = 36000
+
+
+def archive_file_name(file_name, archive_dir=ARCHIVE_DIR):
+    # Archive file of a csv day file, e.g. R_GAIN_MAX_20230113.csv is archive/2023/01/R_GAIN_MAX_20230113.parquet
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    date = name[-8:]
+    return os.path.join(archive_dir, date[:4], date[4:6], name + ".parquet")
+
+
+def compact_day_file(file_name, archive_dir=ARCHIVE_DIR, delete=False):
+    # Write a csv day file to the archive, and check that the archive has a row for every line. If delete
+    # is set and every line was archived, the csv file and its index are deleted (the minute and hour
+    # summaries are kept). Returns the number of rows archived and the number of lines which could not be read
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    with open(file_name, "rb") as file:
+        data = file.read()
+    lines = sum(1 for line in data.splitlines() if line.strip())
+    # The columns are stored with the types they are loaded with (day_file_loader.DTYPES)
+    df = parse_lines(data)
+    df["DateTime"] = df.DateTime.astype("datetime64[ms]")
+
+    archive_name = archive_file_name(file_name, archive_dir)
+    os.makedirs(os.path.dirname(archive_name), exist_ok=True)
+    tmp_name = archive_name + ".tmp"
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_name,
+                   compression=COMPRESSION, row_group_size=ROW_GROUP_SIZE)
+    archived = pq.ParquetFile(tmp_name).metadata.num_rows
+    if archived != len(df):
+        os.remove(tmp_name)
+        raise ValueError("Archive of {0:s} has {1:d} rows instead of {2:d}".format(file_name, archived, len(df)))
+    os.replace(tmp_name, archive_name)
+
+    unreadable = lines - archived
+    if delete and unreadable == 0:
+        os.remove(file_name)
+        if os.path.exists(index_file_name(file_name)):
+            os.remove(index_file_name(file_name))
+    return archived, unreadable
+
+
+def closed_day_files(data_dir=DATA_DIR, pattern="R*.csv"):
+    # Csv day files from before today which are no longer being written
+    today = datetime.date.today().strftime("%Y%m%d")
+    now = time.time()
+    return [file_name for file_name in sorted(glob.glob(os.path.join(data_dir, pattern)))
+            if os.path.splitext(file_name)[0][-8:] < today and now - os.path.getmtime(file_name) > CLOSED_AGE]
+
+
+def read_archive_file(file_name, columns=None, start=None, end=None):
+    # Read an archive file into a DataFrame with a DateTime column and the given columns (default all),
+    # only reading the row groups which can have readings between start and end
+    import pyarrow.parquet as pq
+    filters = []
+    if start is not None:
+        filters.append(("DateTime", ">=", pd.Timestamp(start)))
+    if end is not None:
+        filters.append(("DateTime", "<=", pd.Timestamp(end)))
+    if columns is not None:
+        columns = ["DateTime"] + [column for column in columns if column != "DateTime"]
+    table = pq.read_table(file_name, columns=columns, filters=filters or None)
+    df = table.to_pandas()
+    df["DateTime"] = df.DateTime.astype("datetime64[ns]")
+    return df
+
+
+def read_archive(start, end, columns=None, prefix="R", archive_dir=ARCHIVE_DIR):
+    # Readings from start to end from the archive files of each day in the range
+    dfs = []
+    day = pd.Timestamp(start).date()
+    while day <= pd.Timestamp(end).date():
+        file_name = os.path.join(archive_dir, day.strftime("%Y"), day.strftime("%m"), prefix + day.strftime("%Y%m%d") + ".parquet")
+        if os.path.exists(file_name):
+            dfs.append(read_archive_file(file_name, columns, start, end))
+        day += datetime.timedelta(days=1)
+    if not dfs:
+        return pd.DataFrame(columns=["DateTime"] + (columns or VALUE_COLUMNS))
+    return pd.concat(dfs, ignore_index=True)
+
+
+# Main program
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Compact closed csv day files into the compressed, columnar archive')
+    ap.add_argument("file", type=str, nargs='*',
+                    help="Csv day files to archive. Default is all the closed R*.csv files in " + DATA_DIR)
+    ap.add_argument("-o", "--archive-dir", type=str, default=ARCHIVE_DIR,
+                    help="Archive directory. Default is " + ARCHIVE_DIR)
+    ap.add_argument("-d", "--delete", action='store_true',
+                    help="Delete each csv file once all its lines are in the archive")
+    args = vars(ap.parse_args())
+
+    for file_name in args['file'] or closed_day_files():
+        try:
+            if args['delete']:
+                # Keep the minute and hour summaries of the day for long range graphs
+                from data_rollups import update_rollups
+                update_rollups(file_name)
+            csv_size = os.path.getsize(file_name)
+            archived, unreadable = compact_day_file(file_name, args['archive_dir'], args['delete'])
+            archive_size = os.path.getsize(archive_file_name(file_name, args['archive_dir']))
+            print("{0:s}: {1:d} rows, {2:.1f} MB to {3:.1f} MB".format(
+                file_name, archived, csv_size / 1e6, archive_size / 1e6))
+            if unreadable:
+                print("  {0:d} lines could not be read, csv file kept".format(unreadable))
+        except Exception as e:
+            print("Error archiving", file_name, e)
@@ -0,0 +1,188 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import pandas as pd
+import tsl2591_lux
+from day_file_index import update_index, read_range_bytes, day_file_names, to_ms
+from day_file_loader import parse_lines
+
+# Per minute and per hour summaries (rollups) of each csv day file, kept beside it as e.g.
+# R20230113.csv.minute.npy and R20230113.csv.hour.npy, so that a month or a year can be graphed from
+# a few thousand rows instead of millions of readings.
+#
+# The rollups are brought up to date whenever they are read, by recalculating them from the start of
+# their last hour (the only one that can be incomplete), so the current day's file costs at most an
+# hour of readings to update. `python data_rollups.py --watch 60` keeps them up to date in the background.
+
+DATA_DIR = os.path.expanduser('~/radiometer_data/')
+
+# Length of each rollup period in ms
+LEVELS = {"minute": 60 * 1000, "hour": 60 * 60 * 1000}
+
+# Rollup record: start of the period (ms since 1970-01-01 of the local time in the files), number of readings,
+# lux minimum, maximum, mean and median, darkest SQM (of the minimum lux), mean channel counts and integration
+# time, number of readings at each gain and mean environmental readings (NaN if the file has none)
+ROLLUP_DTYPE = np.dtype([
+    ('time', '<i8'), ('count', '<i4'),
+    ('lux_min', '<f8'), ('lux_max', '<f8'), ('lux_mean', '<f8'), ('lux_median', '<f8'), ('sqm_darkest', '<f8'),
+    ('visible', '<f8'), ('ir', '<f8'), ('int_time', '<f8'),
+    ('gain_low', '<i4'), ('gain_med', '<i4'), ('gain_high', '<i4'), ('gain_max', '<i4'),
+    ('temp', '<f8'), ('humidity', '<f8'), ('pressure', '<f8'), ('dew_point', '<f8'), ('cloud_temp', '<f8'),
+])
+
+GAIN_COLUMNS = {'gain_low': 1.0, 'gain_med': 25.0, 'gain_high': 428.0, 'gain_max': 9876.0}
+MEAN_COLUMNS = {'visible': 'Visible', 'ir': 'IR', 'int_time': 'IntTime', 'temp': 'Temp', 'humidity': 'Humidity',
+                'pressure': 'Pressure', 'dew_point': 'DewPoint', 'cloud_temp': 'CloudTemp'}
+
+
+def rollup_file_name(file_name, level):
+    return file_name + "." + level + ".npy"
+
+
+def rollup(df, period):
+    # Summarise the readings in df (with DateTime, as from parse_lines) over periods of period ms
+    times = df.DateTime.values.astype('datetime64[ms]').astype(np.int64)
+    periods = times - times % period
+    grouped = df.groupby(periods, sort=True)
+    lux = grouped.Lux
+    size = grouped.size()
+
+    summary = np.empty(len(size), dtype=ROLLUP_DTYPE)
+    summary['time'] = size.index.values
+    summary['count'] = size.values
+    summary['lux_min'] = lux.min().values
+    summary['lux_max'] = lux.max().values
+    summary['lux_mean'] = lux.mean().values
+    summary['lux_median'] = lux.median().values
+    summary['sqm_darkest'] = tsl2591_lux.sqm(np.where(summary['lux_min'] > 0, summary['lux_min'], np.nan))
+    for name, column in MEAN_COLUMNS.items():
+        summary[name] = grouped[column].mean().values
+    for name, factor in GAIN_COLUMNS.items():
+        summary[name] = (df.Gain == factor).groupby(periods, sort=True).sum().values
+    return summary
+
+
+def load_rollup(name):
+    if os.path.exists(name):
+        return np.load(name)
+    return np.empty(0, dtype=ROLLUP_DTYPE)
+
+
+def save_rollup(name, summary):
+    # np.save adds .npy to a name without it, so the temporary file also ends in .npy
+    tmp_name = name[:-len(".npy")] + ".tmp.npy"
+    np.save(tmp_name, summary)
+    os.replace(tmp_name, name)
+
+
+def update_rollups(file_name):
+    # Bring the rollups of a day file up to date and return them as a dict of level: records
+    # The summaries of a file which has been archived (and deleted) are complete
+    names = {level: rollup_file_name(file_name, level) for level in LEVELS}
+    if not os.path.exists(file_name):
+        return {level: load_rollup(name) for level, name in names.items()}
+    if all(os.path.exists(name) and os.path.getmtime(name) >= os.path.getmtime(file_name) for name in names.values()):
+        return {level: load_rollup(name) for level, name in names.items()}
+
+    # Recalculate from the start of the last hour summarised, or the whole file
+    hours = load_rollup(names["hour"])
+    start = int(hours['time'][-1]) if len(hours) else None
+    data = read_range_bytes(file_name, start) if start is not None else b""
+    if start is None:
+        update_index(file_name)
+        with open(file_name, "rb") as file:
+            data = file.read()
+        data = data[:data.rfind(b"\n") + 1]
+
+    df = None
+    if data.strip():
+        df = parse_lines(data)
+        if start is not None:
+            df = df[df.DateTime >= pd.Timestamp(start, unit='ms')]
+
+    summaries = {}
+    for level, period in LEVELS.items():
+        summary = load_rollup(names[level])
+        if start is not None:
+            summary = summary[summary['time'] < start]
+        if df is not None and len(df):
+            summary = np.concatenate([summary, rollup(df, period)])
+        try:
+            save_rollup(names[level], summary)
+        except OSError as e:
+            print("Cannot save rollup", names[level], e)
+        summaries[level] = summary
+    return summaries
+
+
+def choose_level(start, end, points):
+    # The coarsest level with at least points periods between start and end, or None for the readings
+    span = to_ms(end) - to_ms(start)
+    for level in sorted(LEVELS, key=LEVELS.get, reverse=True):
+        if span / LEVELS[level] >= points:
+            return level
+    return None
+
+
+def read_rollups(data_dir, start, end, level, prefix="R"):
+    # Rollup records of the day files from start to end as a DataFrame. The columns are named as for
+    # the readings, with Lux as the mean, and the extra summary columns LuxMin, LuxMax, LuxMedian, SQMDarkest,
+    # Count and the readings at each gain. Gain is the most used gain in each period
+    start_ms = to_ms(start)
+    end_ms = to_ms(end)
+    summaries = []
+    for file_name in day_file_names(data_dir, pd.Timestamp(start), pd.Timestamp(end), prefix):
+        if os.path.exists(file_name) or os.path.exists(rollup_file_name(file_name, level)):
+            summary = update_rollups(file_name)[level]
+            summaries.append(summary[(summary['time'] >= start_ms - LEVELS[level] + 1) & (summary['time'] <= end_ms)])
+    summary = np.concatenate(summaries) if summaries else np.empty(0, dtype=ROLLUP_DTYPE)
+
+    gain_counts = np.column_stack([summary[name] for name in GAIN_COLUMNS]) if len(summary) else np.empty((0, 4))
+    df = pd.DataFrame({
+        "DateTime": pd.to_datetime(summary['time'], unit='ms'),
+        "Lux": summary['lux_mean'],
+        "Visible": summary['visible'],
+        "IR": summary['ir'],
+        "Gain": np.array(list(GAIN_COLUMNS.values()))[np.argmax(gain_counts, axis=1)] if len(summary) else [],
+        "IntTime": summary['int_time'],
+        "Temp": summary['temp'],
+        "Humidity": summary['humidity'],
+        "Pressure": summary['pressure'],
+        "DewPoint": summary['dew_point'],
+        "CloudTemp": summary['cloud_temp'],
+        "LuxMin": summary['lux_min'],
+        "LuxMax": summary['lux_max'],
+        "LuxMedian": summary['lux_median'],
+        "SQMDarkest": summary['sqm_darkest'],
+        "Count": summary['count'],
+    })
+    for name in GAIN_COLUMNS:
+        df[name] = summary[name]
+    return df
+
+
+# Main program
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Update the minute and hour summaries of csv day files')
+    ap.add_argument("file", type=str, nargs='*',
+                    help="Csv day files to summarise. Default is all the R*.csv files in " + DATA_DIR)
+    ap.add_argument("-w", "--watch", type=float, default=None,
+                    help="Keep updating the summaries every this many seconds")
+    args = vars(ap.parse_args())
+
+    while True:
+        file_names = args['file'] or sorted(glob.glob(DATA_DIR + "R*.csv"))
+        for file_name in file_names:
+            try:
+                summaries = update_rollups(file_name)
+                if args['watch'] is None:
+                    print(file_name, len(summaries["minute"]), "minutes", len(summaries["hour"]), "hours")
+            except Exception as e:
+                print("Error summarising", file_name, e)
+        if args['watch'] is None:
+            break
+        time.sleep(args['watch'])
@@ -0,0 +1,175 @@
+import argparse
+import datetime
+import os
+import numpy as np
+import pandas as pd
+from day_file_loader import COLUMNS, TIME_LENGTH, line_starts, parse_lines, parse_times
+
+# Sparse index of a csv day file, e.g. R20230113.csv, kept beside it as R20230113.csv.idx: the time and
+# byte offset of the first reading of each minute. A time range is found by binary search of the index,
+# so only the lines in the range (and at most a minute either side) are read and parsed.
+#
+# The index is extended from its last entry each time it is used, so the current day's file can be
+# indexed while it is still being written. Only complete lines are indexed, and lines which do not start
+# with a valid time, e.g. a line cut short by a power failure joined to the next, are skipped.
+
+INDEX_EXTENSION = ".idx"
+
+# Time in ms since 1970-01-01 of the local time in the file, and byte offset of the line
+INDEX_DTYPE = np.dtype([('time', '<i8'), ('offset', '<i8')])
+
+# Bytes of the data file scanned at a time when building the index
+SCAN_BLOCK = 8 * 1024 * 1024
+
+
+def index_file_name(file_name):
+    return file_name + INDEX_EXTENSION
+
+
+def line_time(line):
+    # Time in ms of a data file line (bytes), or None if it does not start with a valid time
+    buffer = np.frombuffer(line[:TIME_LENGTH + 1], dtype=np.uint8)
+    times, valid = parse_times(buffer, np.zeros(1, dtype=np.int64), np.array([len(buffer)]))
+    return int(times[0] // 10**6) if valid[0] else None
+
+
+def to_ms(obs_time):
+    # Time in ms of a datetime or pandas Timestamp, in the same (local) time as the files
+    return int(np.datetime64(pd.Timestamp(obs_time).to_datetime64(), 'ms').astype(np.int64))
+
+
+def scan_minutes(data, base_offset, last_key):
+    # Index entries for the lines in data (complete lines read from base_offset), for each line whose
+    # minute differs from the line before. Returns the entries and the minute of the last line
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    starts, ends = line_starts(buffer)
+    times, valid = parse_times(buffer, starts, ends)
+    starts = starts[valid]
+    if len(starts) == 0:
+        return np.empty(0, dtype=INDEX_DTYPE), last_key
+
+    times = times[valid] // 10**6
+    keys = times // 60000
+    change = np.empty(len(keys), dtype=bool)
+    change[0] = keys[0] != last_key
+    change[1:] = keys[1:] != keys[:-1]
+
+    entries = np.empty(np.count_nonzero(change), dtype=INDEX_DTYPE)
+    entries['time'] = times[change]
+    entries['offset'] = starts[change] + base_offset
+    return entries, keys[-1]
+
+
+def update_index(file_name):
+    # Load the index of a day file, extending it to the end of the file (and saving it) if the file has
+    # grown. An index which does not match the file, e.g. because the file was replaced, is rebuilt
+    index_name = index_file_name(file_name)
+    size = os.path.getsize(file_name)
+    index = np.empty(0, dtype=INDEX_DTYPE)
+    if os.path.exists(index_name):
+        index = np.fromfile(index_name, dtype=INDEX_DTYPE)
+
+    with open(file_name, "rb") as file:
+        # Check that the last entry still points at the start of a line with its time
+        if len(index):
+            last = index[-1]
+            file.seek(last['offset'])
+            line = file.read(TIME_LENGTH + 1)
+            if not (last['offset'] < size and line_time(line) == last['time']):
+                index = np.empty(0, dtype=INDEX_DTYPE)
+
+        # Rescan from the start of the last indexed minute, which may have been incomplete
+        offset = int(index['offset'][-1]) if len(index) else 0
+        kept = index[:-1]
+        new_entries = []
+        last_key = None
+        file.seek(offset)
+        while offset < size:
+            data = file.read(min(SCAN_BLOCK, size - offset))
+            end = data.rfind(b"\n") + 1
+            if end == 0:
+                break
+            entries, last_key = scan_minutes(data[:end], offset, last_key)
+            new_entries.append(entries)
+            offset += end
+            file.seek(offset)
+
+    updated = np.concatenate([kept] + new_entries)
+    if len(updated) != len(index) or not np.array_equal(updated, index):
+        try:
+            tmp_name = index_name + ".tmp"
+            updated.tofile(tmp_name)
+            os.replace(tmp_name, index_name)
+        except OSError as e:
+            # e.g. a read only archive: the index is still used, just not kept
+            print("Cannot save index", index_name, e)
+    return updated
+
+
+def read_range_bytes(file_name, start=None, end=None):
+    # Lines of a day file from the minute containing start up to the end of the minute containing end,
+    # found with the index. start and end are times in ms, or None for the start or end of the file
+    index = update_index(file_name)
+    if len(index) == 0:
+        return b""
+    first = 0
+    if start is not None:
+        first = max(0, int(np.searchsorted(index['time'], start, side='right')) - 1)
+    last = len(index)
+    if end is not None:
+        last = int(np.searchsorted(index['time'], end, side='right'))
+    if last <= first:
+        return b""
+    with open(file_name, "rb") as file:
+        file.seek(index['offset'][first])
+        if last < len(index):
+            data = file.read(index['offset'][last] - index['offset'][first])
+        else:
+            data = file.read()
+            data = data[:data.rfind(b"\n") + 1]
+    return data
+
+
+def day_file_names(data_dir, start, end, prefix="R"):
+    # Names of the csv day files, e.g. R20230113.csv or R_GAIN_MAX_20230113.csv, for each day from start to end
+    day = start.date()
+    names = []
+    while day <= end.date():
+        names.append(os.path.join(data_dir, prefix + day.strftime("%Y%m%d") + ".csv"))
+        day += datetime.timedelta(days=1)
+    return names
+
+
+def read_time_range(data_dir, start, end, prefix="R"):
+    # Readings from start to end (datetimes, inclusive) from the indexed day files in data_dir, or from
+    # the archive in data_dir/archive for days whose csv file has been archived and deleted
+    start_ms = to_ms(start)
+    end_ms = to_ms(end)
+    dfs = []
+    for file_name in day_file_names(data_dir, pd.Timestamp(start), pd.Timestamp(end), prefix):
+        if not os.path.exists(file_name):
+            from data_archive import archive_file_name, read_archive_file
+            archive_name = archive_file_name(file_name, os.path.join(data_dir, "archive"))
+            if os.path.exists(archive_name):
+                dfs.append(read_archive_file(archive_name, start=start, end=end))
+            continue
+        data = read_range_bytes(file_name, start_ms, end_ms)
+        if data.strip():
+            dfs.append(parse_lines(data))
+    if not dfs:
+        return pd.DataFrame(columns=["DateTime"] + COLUMNS[2:])
+    df = pd.concat(dfs, ignore_index=True)
+    in_range = (df.DateTime >= pd.Timestamp(start)) & (df.DateTime <= pd.Timestamp(end))
+    return df[in_range].reset_index(drop=True)
+
+
+# Main program
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Build or update the time index of csv day files, e.g. for an archive of past data')
+    ap.add_argument("file", type=str, nargs='+', help="Csv day files to index")
+    args = vars(ap.parse_args())
+    for file_name in args['file']:
+        index = update_index(file_name)
+        print(file_name, len(index), "minutes indexed")
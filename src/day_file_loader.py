@@ -0,0 +1,190 @@
+import gzip
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import pandas as pd
+
+# Loading of the csv day files e.g. R20230113.csv into NumPy columns, shared by the graph, lightcurve and
+# web tools. The times are converted from their fixed layout "2023/01/13 02:14:00.985" straight from the
+# bytes of the file to int64 ns, instead of joining the date and time strings of every line and parsing
+# them, and the other columns are read with explicit compact types, by pyarrow's csv reader if it is
+# installed (pip install pyarrow) or else by pandas. Several files are loaded in parallel.
+
+COLUMNS = ["Date", "Time", "Lux", "Visible", "IR", "Gain", "IntTime", "Temp", "Humidity", "Pressure", "DewPoint", "CloudTemp"]
+VALUE_COLUMNS = COLUMNS[2:]
+
+# The counts, gain and integration time are whole numbers, exact in float32. Lux and the environmental
+# readings are written with more digits than float32 keeps
+DTYPES = {
+    "Lux": np.float64, "Visible": np.float32, "IR": np.float32, "Gain": np.float32, "IntTime": np.float32,
+    "Temp": np.float64, "Humidity": np.float64, "Pressure": np.float64, "DewPoint": np.float64, "CloudTemp": np.float64,
+}
+
+# Layout of the time at the start of each line, followed by a space: positions of the separators and the digits
+TIME_LENGTH = 23
+SEPARATOR_POSITIONS = [4, 7, 10, 13, 16, 19, 23]
+SEPARATORS = np.frombuffer(b"// ::. ", dtype=np.uint8)
+DIGIT_POSITIONS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18, 20, 21, 22]
+
+# Bytes of a file searched for newlines at a time, and read and parsed at a time
+SCAN_BLOCK = 8 * 1024 * 1024
+LOAD_BLOCK = 8 * 1024 * 1024
+
+# Number of files loaded at once. Parsing is mostly done without the GIL, so threads run in parallel
+LOAD_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def line_starts(buffer):
+    # Offsets of the starts and ends of the non empty lines in a byte array, including a last line without
+    # a newline. The newlines are found a block at a time, to save memory
+    newlines = np.concatenate([np.flatnonzero(buffer[offset:offset + SCAN_BLOCK] == ord("\n")) + offset
+                               for offset in range(0, len(buffer), SCAN_BLOCK)] or [np.empty(0, dtype=np.int64)])
+    ends = newlines if len(buffer) == 0 or buffer[-1] == ord("\n") else np.append(newlines, len(buffer))
+    starts = np.concatenate(([0], newlines + 1))[:len(ends)]
+    return starts[ends > starts], ends[ends > starts]
+
+
+def parse_times(buffer, starts, ends):
+    # Times in ns since 1970-01-01 of the lines, and whether each line starts with a valid time. The first
+    # TIME_LENGTH + 1 bytes of every line are gathered at once through a sliding window over the buffer
+    valid = ends - starts > TIME_LENGTH
+    if len(buffer) <= TIME_LENGTH:
+        # Too short for a time, e.g. a fragment of a line
+        return np.zeros(len(starts), dtype=np.int64), np.zeros(len(starts), dtype=bool)
+    window = as_strided(buffer, shape=(max(0, len(buffer) - TIME_LENGTH), TIME_LENGTH + 1), strides=(1, 1), writeable=False)
+    chars = window[np.where(valid, starts, 0)]
+    valid &= (chars[:, SEPARATOR_POSITIONS] == SEPARATORS).all(axis=1)
+    digits = chars[:, DIGIT_POSITIONS] - np.uint8(ord("0"))
+    valid &= (digits <= 9).all(axis=1)
+
+    def number(first, last):
+        value = np.zeros(len(starts), dtype=np.int64)
+        for position in range(first, last):
+            value *= 10
+            value += digits[:, position]
+        return value
+
+    # Built up in place, as these are the largest arrays
+    month = number(4, 6)
+    valid &= (month >= 1) & (month <= 12)
+    months = np.where(valid, (number(0, 4) - 1970) * 12 + month - 1, 0)
+    times = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+    day = number(6, 8)
+    valid &= day >= 1
+    times += day - 1
+    for first, last, factor in ((8, 10, 24), (10, 12, 60), (12, 14, 60), (14, 17, 1000)):
+        times *= factor
+        times += number(first, last)
+    times *= 10**6
+    return times, valid
+
+
+def read_values(data, names, columns):
+    # The value columns of the lines, with pyarrow's multithreaded csv reader if it is installed.
+    # Raises ValueError for a value which is not a number
+    dtypes = {column: DTYPES[column] for column in columns}
+    try:
+        import pyarrow as pa
+        import pyarrow.csv
+    except ImportError:
+        df = pd.read_csv(io.BytesIO(data), sep=" ", names=names, usecols=columns, dtype=dtypes,
+                         on_bad_lines='skip', low_memory=False)
+        return {column: df[column].values for column in columns}
+    table = pa.csv.read_csv(
+        pa.BufferReader(data),
+        read_options=pa.csv.ReadOptions(column_names=names),
+        parse_options=pa.csv.ParseOptions(delimiter=" "),
+        convert_options=pa.csv.ConvertOptions(
+            include_columns=columns, column_types={column: pa.from_numpy_dtype(dtype) for column, dtype in dtypes.items()}))
+    return {column: table.column(column).to_numpy() for column in columns}
+
+
+def parse_columns_slowly(data, columns):
+    # Parse lines which the fast parser cannot, e.g. with a missing or extra field or an unreadable number.
+    # Lines without a valid time are dropped and unreadable numbers are NaN
+    df = pd.read_csv(io.BytesIO(data), sep=" ", names=COLUMNS, on_bad_lines='warn', dtype=str)
+    times = pd.to_datetime(df.Date + " " + df.Time, format="%Y/%m/%d %H:%M:%S.%f", errors='coerce')
+    valid = times.notna().values
+    result = {"DateTime": times.values[valid].astype('datetime64[ns]')}
+    for column in columns:
+        result[column] = pd.to_numeric(df[column], errors='coerce').values[valid].astype(DTYPES[column])
+    return result
+
+
+def parse_columns(data, columns=None):
+    # Day file lines (bytes) as a dict of NumPy arrays: DateTime (datetime64[ns]) and the value columns,
+    # default all. Files without environmental readings (e.g. from sqm_tsl2591.py) have NaN for those
+    # columns. Lines without a valid time, e.g. cut short by a power failure, are dropped
+    columns = VALUE_COLUMNS if columns is None else [column for column in columns if column != "DateTime"]
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    starts, ends = line_starts(buffer)
+    if len(starts) == 0:
+        return {"DateTime": np.empty(0, dtype='datetime64[ns]'),
+                **{column: np.empty(0, dtype=DTYPES[column]) for column in columns}}
+    times, valid = parse_times(buffer, starts, ends)
+
+    # The number of fields is taken from the first line, and any line with a different number is parsed slowly.
+    # The date and time fields are skipped, but not converted
+    names = COLUMNS[:data.count(b" ", starts[0], ends[0]) + 1]
+    try:
+        values = read_values(data, names, [column for column in columns if column in names])
+    except ValueError:
+        return parse_columns_slowly(data, columns)
+    if any(len(column_values) != len(starts) for column_values in values.values()):
+        return parse_columns_slowly(data, columns)
+
+    result = {"DateTime": times[valid].view('datetime64[ns]')}
+    for column in columns:
+        column_values = values.get(column)
+        if column_values is None:
+            result[column] = np.full(np.count_nonzero(valid), np.nan, dtype=DTYPES[column])
+        else:
+            result[column] = column_values if valid.all() else column_values[valid]
+    return result
+
+
+def parse_lines(data, columns=None):
+    # Day file lines as a DataFrame with a DateTime column
+    return pd.DataFrame(parse_columns(data, columns))
+
+
+def concatenate_columns(parts, columns=None):
+    if len(parts) == 1:
+        return parts[0]
+    if len(parts) == 0:
+        return parse_columns(b"", columns)
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+def load_day_file(file_name, columns=None):
+    # The file is read and parsed a block of lines at a time, so that it is never all in memory.
+    # A last line without a newline is still being written, or was cut short by a power failure, and is left out
+    parts = []
+    rest = b""
+    with (gzip.open if file_name.endswith(".gz") else open)(file_name, "rb") as file:
+        while True:
+            block = file.read(LOAD_BLOCK)
+            if not block:
+                break
+            data = rest + block
+            end = data.rfind(b"\n") + 1
+            if end:
+                parts.append(parse_columns(data[:end], columns))
+            rest = data[end:]
+    return concatenate_columns(parts, columns)
+
+
+def load_day_files(file_names, columns=None, workers=LOAD_WORKERS):
+    # Readings of the day files in order as a dict of NumPy arrays, loading up to workers files at once
+    if len(file_names) <= 1 or workers <= 1:
+        loaded = [load_day_file(file_name, columns) for file_name in file_names]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            loaded = list(executor.map(lambda file_name: load_day_file(file_name, columns), file_names))
+    return concatenate_columns(loaded, columns)
+
+
+def load_day_files_dataframe(file_names, columns=None, workers=LOAD_WORKERS):
+    return pd.DataFrame(load_day_files(file_names, columns, workers))
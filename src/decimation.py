@@ -0,0 +1,37 @@
+import numpy as np
+
+# Reduction of a series of readings to the rows that matter for drawing it at a given resolution,
+# used by the web page (app.py) and the batch graphs (graph_radiometer_data.py --batch).
+
+
+def min_max_indices(times, values, points, low_values=None):
+    # Min/max decimation: the time axis is divided into points/2 equal buckets and the rows with the
+    # minimum and maximum value are taken from each, so short peaks (fireballs) are never lost.
+    # low_values is a separate series for the minima, e.g. the minimum of the summaries when values is
+    # the maximum. Returns the sorted indices of the rows selected, always including the first and last
+    n = len(values)
+    if points <= 0 or n <= points:
+        return np.arange(n)
+    edges = np.linspace(times[0], times[-1], max(1, points // 2) + 1)[:-1]
+    starts = np.unique(np.searchsorted(times, edges, side='left'))  # Empty buckets are skipped
+    counts = np.diff(np.append(starts, n))
+    bucket = np.repeat(np.arange(len(starts)), counts)
+
+    selected = [np.array([0, n - 1])]
+    for reduce, fill, series in ((np.maximum, -np.inf, values),
+                                 (np.minimum, np.inf, values if low_values is None else low_values)):
+        filled = np.where(np.isnan(series), fill, series)
+        extremes = reduce.reduceat(filled, starts)
+        hits = np.flatnonzero(filled == extremes[bucket])
+        # First hit in each bucket
+        first = np.ones(len(hits), dtype=bool)
+        first[1:] = bucket[hits][1:] != bucket[hits][:-1]
+        selected.append(hits[first])
+    return np.unique(np.concatenate(selected))
+
+
+def pixel_indices(times, series, pixels):
+    # Rows needed to draw all the series against times (int64) on a graph pixels wide: the minimum
+    # and maximum of each series in each pixel
+    return np.unique(np.concatenate([min_max_indices(times, np.asarray(values, dtype=np.float64), 2 * pixels)
+                                     for values in series]))
@@ -0,0 +1,76 @@
+import datetime
+import threading
+import time
+import numpy as np
+from acquisition_metrics import STAGE_ENV
+
+# Seconds between environmental readings. Temperature, humidity and pressure change over minutes
+ENV_SAMPLE_INTERVAL = 10.0
+
+# Values used until the first successful reading, or for a sensor that isn't fitted
+NO_ENV_DATA = (float('nan'),) * 5
+
+
+def read_bme280_data(sensor):
+    temperatura = sensor.temperature
+    wilgotnosc = sensor.humidity
+    cisnienie = sensor.pressure
+    punkt_rosy = calculate_dew_point(temperatura, wilgotnosc)
+    return temperatura, wilgotnosc, cisnienie, punkt_rosy
+
+
+def calculate_dew_point(temperatura, wilgotnosc):
+    b = 17.62
+    c = 243.12
+    gamma = (b * temperatura) / (c + temperatura) + np.log(wilgotnosc / 100.0)
+    punkt_rosy = (c * gamma) / (b - gamma)
+    return punkt_rosy
+
+
+class EnvironmentSampler():
+    # Reads the BME280 and MLX90614 sensors in a background thread at a low rate, so that their
+    # slow i2c transfers are not added to every light reading. The light reading loop only
+    # takes the cached values from latest.
+
+    def __init__(self, bme280=None, mlx=None, interval=ENV_SAMPLE_INTERVAL):
+        self.bme280 = bme280
+        self.mlx = mlx
+        self.interval = interval
+
+        # Time of the last reading, and temperature, humidity, pressure, dew point and cloud temperature.
+        # Replaced as a whole tuple so the reading loop always sees a consistent set of values
+        self.latest = (None, NO_ENV_DATA)
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+        # Optional AcquisitionMetrics for the time taken to read the sensors
+        self.metrics = None
+
+    def start(self):
+        # Take the first reading before returning, so that the values are available straight away
+        self.sample()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def sample(self):
+        temp, humidity, pressure, dew_point, cloud_temp = self.latest[1]
+        start_ns = time.perf_counter_ns()
+        try:
+            if self.bme280 is not None:
+                temp, humidity, pressure, dew_point = read_bme280_data(self.bme280)
+            if self.mlx is not None:
+                cloud_temp = self.mlx.object_temperature
+        except Exception as e:
+            print("Error reading environmental sensors:", e)
+            return
+        if self.metrics is not None:
+            self.metrics.lap(STAGE_ENV, start_ns)
+        self.latest = (datetime.datetime.now(), (temp, humidity, pressure, dew_point, cloud_temp))
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
@@ -0,0 +1,103 @@
+import datetime
+import os
+from collections import deque
+from radiometer_logger import DayFileSink
+
+# Seconds of full rate readings kept before a trigger, and written after it
+PRE_TRIGGER = 30.0
+POST_TRIGGER = 30.0
+
+
+class EventFileSink(DayFileSink):
+    # Writes each event to its own file, named from the trigger time e.g. E_name_20230113_021452.csv.
+    # The first value of each record is the trigger time of the event it belongs to.
+
+    def add(self, obs_time, values):
+        event_time = values[0]
+        if event_time != self.day:
+            try:
+                self.write_pending()
+                self.open_day(event_time)
+            except Exception:
+                # The record is lost, and the next one tries the event's file again
+                self.dropped += 1
+                raise
+            self.day = event_time
+        self.pending.append(self.line_format.format(self.formatter.format(obs_time), *values[1:]))
+
+    def open_day(self, event_time):
+        if self.file is not None:
+            file, self.file = self.file, None
+            file.close()
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.filename = self.prefix + event_time.strftime("%Y%m%d_%H%M%S") + self.extension
+        self.file = open(self.data_dir + self.filename, "a")
+
+
+class EventCapture():
+    # Holds the last PRE_TRIGGER seconds of full rate readings in a ring buffer. When triggered, the
+    # buffered readings and the readings for the next POST_TRIGGER seconds are written to an event file.
+    # A trigger during a capture extends it. Triggers come from the StreamingDetector.
+
+    def __init__(self, logger, event_sink, rate, pre_trigger=PRE_TRIGGER, post_trigger=POST_TRIGGER):
+        self.logger = logger
+        self.event_sink = event_sink
+        self.ring = deque(maxlen=max(1, int(pre_trigger * rate)))
+        self.post_trigger = datetime.timedelta(seconds=post_trigger)
+        self.event_time = None
+        self.capture_until = None
+
+    def add(self, obs_time, values):
+        # Add a reading to the ring buffer, or to the event being written
+        if self.capture_until is not None:
+            if obs_time <= self.capture_until:
+                self.logger.log(self.event_sink, obs_time, self.event_time, *values)
+            else:
+                self.capture_until = None
+                self.ring.append((obs_time, values))
+        else:
+            self.ring.append((obs_time, values))
+
+    def trigger(self, obs_time):
+        # Start writing an event, or extend the one being written
+        if self.capture_until is None:
+            self.event_time = obs_time
+            for buffered_time, buffered_values in self.ring:
+                self.logger.log(self.event_sink, buffered_time, obs_time, *buffered_values)
+            self.ring.clear()
+        self.capture_until = obs_time + self.post_trigger
+
+
+class Decimator():
+    # Averages each block of readings into one reading for the main data file.
+    # Readings are (lux, ch0, ch1, gain, atime, ...). A block ends early if the gain or integration
+    # time changes, as the raw counts can't be averaged across gain settings.
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.count = 0
+        self.lux = self.ch0 = self.ch1 = 0.0
+        self.last = None
+
+    def add(self, obs_time, values):
+        # Returns the averaged (obs_time, values) when a block is complete, otherwise None
+        block = None
+        if self.count and values[3:5] != self.last[1][3:5]:
+            block = self.average()
+        self.count += 1
+        self.lux += values[0]
+        self.ch0 += values[1]
+        self.ch1 += values[2]
+        self.last = (obs_time, values)
+        if self.count >= self.block_size:
+            return self.average()
+        return block
+
+    def average(self):
+        # The averaged reading takes the time, gain and other values of the last reading in the block
+        obs_time, values = self.last
+        block = (obs_time, (self.lux / self.count, round(self.ch0 / self.count),
+                            round(self.ch1 / self.count)) + tuple(values[3:]))
+        self.count = 0
+        self.lux = self.ch0 = self.ch1 = 0.0
+        return block
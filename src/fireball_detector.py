@@ -0,0 +1,109 @@
+from bisect import bisect_left, insort
+from collections import deque
+
+# Seconds of readings in the sliding background window. Long enough that a fireball of a few seconds
+# doesn't move the background median, short enough to follow twilight and passing cloud
+DETECTOR_WINDOW = 30.0
+
+# An excursion starts when a reading is this many noise levels above the background median
+TRIGGER_SIGMA = 6.0
+
+# Minimum rise in lux above the background for an excursion, for when the sky is so steady that the
+# noise level estimate is close to zero
+TRIGGER_STEP = 0.005
+
+# Readings needed in the window before excursions are flagged
+MIN_WINDOW_READINGS = 10
+
+# Converts the median absolute deviation to the standard deviation of normally distributed noise.
+# The MAD of a symmetric distribution is half its interquartile range
+MAD_TO_SIGMA = 1.4826
+
+# Detection records in the F*.csv files: time of the peak, start time of the excursion,
+# peak lux, background lux and noise level in lux
+DETECTION_FORMAT = '{0:s} {1:s} {2:.9f} {3:.9f} {4:.9f}\n'
+
+
+class StreamingDetector():
+    # Flags sudden increases in light level (e.g. fireballs) one reading at a time, for use in the
+    # acquisition loop. The background is the median of a sliding window of readings, and the noise
+    # level the MAD, taken from the quartiles of the window. The window is kept sorted, so each reading
+    # costs a binary search and a short list move rather than a sort of the whole window.
+    #
+    # on_trigger(obs_time) is called on the reading which starts an excursion, and
+    # on_peak(peak_time, start_time, peak_lux, background, noise) on the reading after a peak,
+    # once the light level has started to fall.
+
+    def __init__(self, rate, window=DETECTOR_WINDOW, trigger_sigma=TRIGGER_SIGMA, trigger_step=TRIGGER_STEP):
+        self.readings = deque()
+        self.sorted_readings = []
+        self.window_size = max(MIN_WINDOW_READINGS, int(window * rate))
+        self.trigger_sigma = trigger_sigma
+        self.trigger_step = trigger_step
+
+        self.on_trigger = None
+        self.on_peak = None
+
+        # The excursion in progress: start time, background and noise level at the start,
+        # and the highest reading so far and whether it has been reported as a peak
+        self.start_time = None
+        self.background = None
+        self.noise = None
+        self.peak_time = None
+        self.peak_lux = None
+        self.peak_reported = False
+
+    def background_level(self):
+        # Median and noise level (standard deviation) of the readings in the window
+        window = self.sorted_readings
+        n = len(window)
+        median = (window[(n - 1) // 2] + window[n // 2]) / 2
+        noise = MAD_TO_SIGMA * (window[(3 * n) // 4] - window[n // 4]) / 2
+        return median, noise
+
+    def add(self, obs_time, lux):
+        # Test the reading against the background, then add it to the window. Returns True while
+        # an excursion is in progress
+        if lux != lux:
+            # Skip NaN readings, which can't be placed in the sorted window
+            return self.start_time is not None
+        if len(self.sorted_readings) >= MIN_WINDOW_READINGS:
+            median, noise = self.background_level()
+            above = lux - median > max(self.trigger_step, self.trigger_sigma * noise)
+            if self.start_time is None:
+                if above:
+                    self.start_excursion(obs_time, lux, median, noise)
+            else:
+                self.update_excursion(obs_time, lux, above)
+
+        self.readings.append(lux)
+        insort(self.sorted_readings, lux)
+        if len(self.readings) > self.window_size:
+            del self.sorted_readings[bisect_left(self.sorted_readings, self.readings.popleft())]
+
+        return self.start_time is not None
+
+    def start_excursion(self, obs_time, lux, median, noise):
+        self.start_time = obs_time
+        self.background = median
+        self.noise = noise
+        self.peak_time = obs_time
+        self.peak_lux = lux
+        self.peak_reported = False
+        if self.on_trigger is not None:
+            self.on_trigger(obs_time)
+
+    def update_excursion(self, obs_time, lux, above):
+        if lux > self.peak_lux:
+            # Still rising, or a higher peak later in the same excursion
+            self.peak_time = obs_time
+            self.peak_lux = lux
+            self.peak_reported = False
+        elif not self.peak_reported:
+            # The first fall after the highest reading so far
+            self.peak_reported = True
+            if self.on_peak is not None:
+                self.on_peak(self.peak_time, self.start_time, self.peak_lux, self.background, self.noise)
+
+        if not above:
+            self.start_time = None
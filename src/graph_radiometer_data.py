@@ -1,26 +1,176 @@
 import argparse
 import glob
 import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from matplotlib import pyplot as plt
 from scipy.signal import find_peaks
 import numpy as np
+from radiometer_binary import binary_day_file_dataframe
+from day_file_index import read_time_range
+from data_rollups import choose_level, read_rollups
+from data_archive import read_archive_file
+from day_file_loader import load_day_files_dataframe
+from decimation import pixel_indices
+import tsl2591_lux
 
 
 CAPTURE_DIR = os.path.expanduser('~/radiometer_data/')
 
 PEAK_DETECTION_LUX_LIMIT = 2.0
 
+# A time range long enough to give this many minutes or hours is graphed from the minute or hour summaries
+GRAPH_POINTS = 5000
+
 # Taken from https://github.com/adafruit/Adafruit_CircuitPython_TSL2591/blob/main/adafruit_tsl2591.py for cpl calculation
 ADAFRUIT_TSL2591_LUX_DF = 408.0
 
+# Columns graphed
+COLUMNS = ["Lux", "Visible", "IR", "Gain", "IntTime"]
+
+# Size in inches and resolution of the graphs saved in batch mode. Each series is reduced to its minimum
+# and maximum in each pixel of the width before it is drawn
+BATCH_FIGURE_SIZE = (10, 6)
+BATCH_DPI = 100
+
+# Graphs saved for each day file, e.g. R20230113.png, R20230113_sqm.png and R20230113_counts.png
+BATCH_GRAPHS = ["", "_sqm", "_counts"]
+
+
+def read_data_file(file_name):
+    # Read a csv, binary (.bin) or archived (.parquet) radiometer data file
+    if file_name.endswith(".bin"):
+        return binary_day_file_dataframe(file_name)
+    if file_name.endswith(".parquet"):
+        return read_archive_file(file_name, COLUMNS)
+    return load_day_files_dataframe([file_name], COLUMNS)
+
+
+def read_data_files(file_names):
+    # Csv files are loaded in parallel
+    if all(not file_name.endswith((".bin", ".parquet")) for file_name in file_names):
+        return load_day_files_dataframe(file_names, COLUMNS)
+    return pd.concat([read_data_file(file_name) for file_name in file_names], ignore_index=True)
+
+
+def day_name(file_name):
+    # e.g. R20230113 for R20230113.csv, R20230113.csv.gz or archive/2023/01/R20230113.parquet
+    return os.path.basename(file_name).split(".")[0]
+
+
+def batch_file_names(paths, start=None, end=None):
+    # Day files in the given files and directories, for the days from start to end (dates, or None for all).
+    # A day whose csv file has been archived (and deleted) is read from the directory's archive
+    file_names = {}
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = [file_name for file_name in sorted(glob.glob(os.path.join(path, "R*.csv*")))
+                          if not file_name.endswith((".idx", ".npy"))]
+            candidates += sorted(glob.glob(os.path.join(path, "archive", "*", "*", "R*.parquet")))
+        else:
+            candidates = [path]
+        for file_name in candidates:
+            file_names.setdefault(day_name(file_name), file_name)
+    first = start.strftime("%Y%m%d") if start is not None else ""
+    last = end.strftime("%Y%m%d") if end is not None else "99999999"
+    return [file_names[name] for name in sorted(file_names) if first <= name[-8:] <= last]
+
+
+def batch_graph_names(file_name, output_dir=None):
+    directory = output_dir if output_dir is not None else os.path.dirname(file_name)
+    return [os.path.join(directory, day_name(file_name) + suffix + '.png') for suffix in BATCH_GRAPHS]
+
+
+def graphs_up_to_date(file_name, graph_names):
+    modified = os.path.getmtime(file_name)
+    return all(os.path.exists(name) and os.path.getmtime(name) >= modified for name in graph_names)
+
+
+def render_day(file_name, graph_names, night_range=False, linear_scale=False, prominence=0, reprocess=False):
+    # Save the illuminance, sky brightness and raw count graphs of a day file, as the interactive graphs.
+    # The figures are drawn without pyplot, so this can run in a worker process with no display
+    from matplotlib.figure import Figure
+
+    df = read_data_file(file_name)
+    if len(df) == 0:
+        return 0
+    if reprocess:
+        df["Lux"] = tsl2591_lux.lux(df.Visible, df.IR, df.Gain, df.IntTime)
+    times = df.DateTime.values
+    time_ns = times.astype(np.int64)
+    lux = df.Lux.values
+    rolling = (df.Lux.rolling(64, center=True).sum()/64).values
+    peaks = []
+    if prominence != 0:
+        peaks, properties = find_peaks(
+            df.Lux.clip(upper=PEAK_DETECTION_LUX_LIMIT), prominence=prominence, width=(1, 60))
+    pixels = BATCH_FIGURE_SIZE[0] * BATCH_DPI
+
+    def new_figure(title, ylabel):
+        figure = Figure(figsize=BATCH_FIGURE_SIZE, dpi=BATCH_DPI)
+        axes = figure.subplots()
+        axes.set_title(title)
+        axes.set_xlabel('Time')
+        axes.set_ylabel(ylabel)
+        return figure, axes
+
+    # Illuminance, with any peaks
+    figure, axes = new_figure('Illuminance', 'Lux')
+    shown = pixel_indices(time_ns, [lux], pixels)
+    axes.plot(times[shown], lux[shown])
+    if night_range:
+        axes.set_ylim(-0.1, 0.5)
+    elif not linear_scale:
+        axes.set_yscale("log")
+    if len(peaks) > 0:
+        axes.plot(times[peaks], lux[peaks], marker="o", ls="", ms=3)
+    axes.grid()
+    figure.savefig(graph_names[0])
+
+    # Sky brightness and rolling average. The SQM falls as the lux rises, so the lux extremes are its extremes
+    figure, axes = new_figure('Sky Brightness', r'Mag/$arcsec^2$ (mpsas)')
+    shown = pixel_indices(time_ns, [lux, rolling], pixels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        axes.plot(times[shown], tsl2591_lux.sqm(lux[shown]), label="Sky Brightness")
+        axes.plot(times[shown], tsl2591_lux.sqm(rolling[shown]), label="Rolling average")
+    axes.legend(loc='lower left')
+    figure.savefig(graph_names[1])
+
+    # Raw sensor values
+    figure, axes = new_figure('Raw sensor values', 'Count')
+    shown = pixel_indices(time_ns, [df.Visible.values, df.IR.values], pixels)
+    if not linear_scale:
+        axes.set_yscale("log")
+    axes.plot(times[shown], df.Visible.values[shown], label="Visible and IR")
+    axes.plot(times[shown], df.IR.values[shown], label="IR")
+    axes.legend(loc='upper left')
+    figure.savefig(graph_names[2])
+    return len(df)
+
+
+def render_days(file_names, output_dir=None, force=False, jobs=None, **options):
+    # Save the graphs of each day file whose graphs are missing or older than the file, jobs days at a time
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    graph_names = {file_name: batch_graph_names(file_name, output_dir) for file_name in file_names}
+    todo = [file_name for file_name in file_names if force or not graphs_up_to_date(file_name, graph_names[file_name])]
+    print("Graphing", len(todo), "of", len(file_names), "days")
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {file_name: executor.submit(render_day, file_name, graph_names[file_name], **options) for file_name in todo}
+        for file_name, future in futures.items():
+            try:
+                print(file_name, future.result(), "readings")
+            except Exception as e:
+                print("Error graphing", file_name, e)
+
+
 # Main program
 if __name__ == "__main__":
 
     # Construct the argument parser and parse the arguments
     ap = argparse.ArgumentParser(description='Analyse radiometer data')
     ap.add_argument("file", type=str, nargs='*',
-                    help="File or directory to analyse. Default is last 2 files in the directory " + CAPTURE_DIR)
+                    help="Csv, binary (.bin) or archive (.parquet) file to analyse. Default is last 2 files in the directory " + CAPTURE_DIR)
     ap.add_argument("-n", "--night", action='store_true',
                     help="Display with night readings range")
     ap.add_argument("-l", "--linear", action='store_true',
@@ -31,6 +181,21 @@ if __name__ == "__main__":
     #                 help="Display sky brightness")
     ap.add_argument("-p", "--prominence", type=float, default=0,
                     help="Peak detection prominence above background. Usually 0.005 lux. Default is no peak detection")
+    ap.add_argument("-r", "--reprocess", action='store_true',
+                    help="Recalculate the lux values from the raw sensor counts")
+    ap.add_argument("--start", type=str, default=None,
+                    help="Graph the readings from this time e.g. \"2023/01/13 02:10\", read from the csv day files in " + CAPTURE_DIR)
+    ap.add_argument("--end", type=str, default=None,
+                    help="Graph the readings up to this time. Default is 1 hour after --start")
+    ap.add_argument("-b", "--batch", action='store_true',
+                    help="Save the illuminance, sky brightness and raw count graphs of each day in the files and directories given "
+                         "(default " + CAPTURE_DIR + "), from the date --start to the date --end, skipping days whose graphs are up to date")
+    ap.add_argument("-o", "--output-dir", type=str, default=None,
+                    help="Directory for the batch graphs. Default is beside each day file")
+    ap.add_argument("-f", "--force", action='store_true',
+                    help="Save the batch graphs even if they are up to date")
+    ap.add_argument("-j", "--jobs", type=int, default=None,
+                    help="Number of days graphed at once in batch mode. Default is the number of processors")
 
     args = vars(ap.parse_args())
 
@@ -39,18 +204,42 @@ if __name__ == "__main__":
     prominence = args['prominence']
     linear_scale = args['linear']
     save_figure = args['save']
+    reprocess = args['reprocess']
+
+    if args['batch']:
+        render_days(batch_file_names(args['file'] or [CAPTURE_DIR],
+                                     pd.Timestamp(args['start']) if args['start'] is not None else None,
+                                     pd.Timestamp(args['end']) if args['end'] is not None else None),
+                    output_dir=args['output_dir'], force=args['force'], jobs=args['jobs'],
+                    night_range=night_range, linear_scale=linear_scale, prominence=prominence, reprocess=reprocess)
+        exit(0)
 
     # If no filenames were given, use the 2 newest files
-    if len(file_names) == 0:
-        file_names = sorted(glob.glob(CAPTURE_DIR + "R*.csv*"))[-2:]
+    if len(file_names) == 0 and args['start'] is None:
+        file_names = [file_name for file_name in sorted(glob.glob(CAPTURE_DIR + "R*.csv*"))
+                      if not file_name.endswith((".idx", ".npy"))][-2:]
 
-    print("Graphing", file_names)
+    # Collect the data into a pandas dataframe, with the times in a DateTime column
+    if args['start'] is not None:
+        # Read only the time range, using the day files' time index
+        start = pd.Timestamp(args['start'])
+        end = pd.Timestamp(args['end']) if args['end'] is not None else start + pd.Timedelta(hours=1)
+        level = choose_level(start, end, GRAPH_POINTS)
+        if level is not None:
+            # Mean lux of each minute or hour
+            print("Graphing", start, "to", end, "from the", level, "summaries")
+            df = read_rollups(CAPTURE_DIR, start, end, level)
+        else:
+            print("Graphing", start, "to", end)
+            df = read_time_range(CAPTURE_DIR, start, end)
+    else:
+        print("Graphing", file_names)
+        df = read_data_files(file_names)
+    times = df.DateTime
 
-    # Collect the data into a pandas dataframe
-    columns = ["Date", "Time", "Lux", "Visible", "IR", "Gain", "IntTime"]
-    dfs = [pd.read_csv(file_name, sep=' ', names=columns)
-           for file_name in file_names]
-    df = pd.concat(dfs, ignore_index=True)
+    # Recalculate lux from the raw counts, gain and integration time, for the whole data set at once
+    if reprocess:
+        df["Lux"] = tsl2591_lux.lux(df.Visible, df.IR, df.Gain, df.IntTime)
 
     # Find peaks in the data that may match the light curve of a fireball
     peaks = []
@@ -60,11 +249,7 @@ if __name__ == "__main__":
         print("Peaks found:", len(peaks))
         if (len(peaks) < 50):
             for peak in peaks:
-                print(df.Time[peak], df.Lux[peak])
-
-    # Format the times into datetime values
-    times = pd.to_datetime(df.Date + " " + df.Time,
-                           format="%Y/%m/%d %H:%M:%S.%f")
+                print(times[peak], df.Lux[peak])
 
     print("Contents in csv file:")
     print(df)
@@ -75,16 +260,16 @@ if __name__ == "__main__":
     sky_brightness_measurements_sorted = sky_brightness_measurements.sort_values(
         by=['Lux'], ascending=False)
     for row in sky_brightness_measurements_sorted.itertuples():
-        print(row.Date, row.Time, "SQM:", np.log10((row.Lux)/108000)/-0.4)
+        print(row.DateTime, "SQM:", tsl2591_lux.sqm(row.Lux))
 
     # Calculate sky brightness and minimum rolling average over 64 readings (~6 seconds)
     rolling = df.Lux.rolling(64, center=True).sum()/64
     min_lux_index = np.argmin(df.Lux)
     min_rolling_index = np.argmin(rolling)
-    print("Min sky brightness:", times[min_lux_index], np.log10(
-        df.Lux[min_lux_index]/108000)/-0.4, "mag/arcsec^2")
-    print("Min rolling average sky brightness:", times[min_rolling_index], np.log10(
-        rolling[min_rolling_index]/108000)/-0.4, "mag/arcsec^2")
+    print("Min sky brightness:", times[min_lux_index], tsl2591_lux.sqm(
+        df.Lux[min_lux_index]), "mag/arcsec^2")
+    print("Min rolling average sky brightness:", times[min_rolling_index], tsl2591_lux.sqm(
+        rolling[min_rolling_index]), "mag/arcsec^2")
 
     # Plot the lux data vs time
     plt.figure(figsize=(10, 6))
@@ -104,14 +289,17 @@ if __name__ == "__main__":
     plt.title('Illuminance')
     plt.grid()
     if save_figure:
-        plt.savefig(os.path.splitext(file_names[-1])[0] + '.png')
+        if args['start'] is not None:
+            plt.savefig(CAPTURE_DIR + start.strftime("R%Y%m%d_%H%M%S") + '.png')
+        else:
+            plt.savefig(os.path.splitext(file_names[-1])[0] + '.png')
         exit(0)
     plt.show()
 
     # Display sky brightness and rolling average
-    sky_brightness = np.log10(df.Lux/108000)/-0.4
+    sky_brightness = tsl2591_lux.sqm(df.Lux)
     plt.plot(times, sky_brightness, label="Sky Brightness")
-    plt.plot(times, np.log10(rolling/108000)/-0.4, label="Rolling average")
+    plt.plot(times, tsl2591_lux.sqm(rolling), label="Rolling average")
     plt.xlabel('Time')
     plt.ylabel(r'Mag/$arcsec^2$ (mpsas)')
 
@@ -1,17 +1,18 @@
 import argparse
 import glob
 import os
-import pandas as pd
 from matplotlib import pyplot as plt
 from scipy.signal import find_peaks
 import numpy as np
+import tsl2591_lux
+from day_file_loader import load_day_files_dataframe
 
 CAPTURE_DIR = os.path.expanduser('~/radiometer_data/')
 PEAK_DETECTION_LUX_LIMIT = 2.0
 ADAFRUIT_TSL2591_LUX_DF = 408.0
 
 def lux_to_magarcsec2(lux):
-    return -2.5 * np.log10(lux / 108000)
+    return tsl2591_lux.sqm(lux)
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser(description='Analyse radiometer data')
@@ -30,15 +31,12 @@ if __name__ == "__main__":
     save_figure = args['save']
 
     if len(file_names) == 0:
-        file_names = sorted(glob.glob(CAPTURE_DIR + "R*.csv*"))[-2:]
+        file_names = [file_name for file_name in sorted(glob.glob(CAPTURE_DIR + "R*.csv*"))
+                      if not file_name.endswith((".idx", ".npy"))][-2:]
 
     print("Graphing", file_names)
 
-    dfs = []
-    for file_name in file_names:
-        temp_df = pd.read_csv(file_name, sep=" ", names=["DateTime", "Lux", "Visible", "IR", "Gain", "IntTime", "Temp", "Humidity", "Pressure", "DewPoint"], parse_dates=["DateTime"])
-        dfs.append(temp_df)
-    df = pd.concat(dfs, ignore_index=True)
+    df = load_day_files_dataframe(file_names, ["Lux", "Visible", "IR", "Gain", "IntTime", "Temp", "Humidity", "Pressure", "DewPoint"])
 
     print("Contents in csv file:")
     print(df.head())
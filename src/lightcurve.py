@@ -1,11 +1,16 @@
 import argparse
 import glob
 import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from matplotlib import pyplot as plt
 from scipy.signal import find_peaks
 # from scipy.integrate import simpson
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import tsl2591_lux
+from data_archive import read_archive_file
+from day_file_loader import load_day_files_dataframe
 
 
 CAPTURE_DIR = os.path.expanduser('~/radiometer_data/')
@@ -22,16 +27,158 @@ LUMINOUS_EFFICACY = 0.0079
 # Power of a magnitude 0 fireball is 1500 Watts
 POWER_OF_MAG_ZERO_FIREBALL = 1500
 
-# Re irradiance responsivity from TSL2591 datasheet, white light on "visible" sensor channel 0
-# The 100 scaling factor is to convert the RE_WHITE_CHANNEL0 from the datsheet units of counts/(μW/cm2) to counts/(W/m2)
-RE_WHITE_CHANNEL0 = 264.1 * 100
-
-# High gain factor 428x from https://github.com/adafruit/Adafruit_CircuitPython_TSL2591/blob/main/adafruit_tsl2591.py
-GAIN_HIGH = 428
-
 # Minimum magnitude detectable with the sensor
 MIN_MAGNITUDE = -6.0
 
+# Percentiles of the Monte Carlo estimates reported, and the largest incident angle drawn in degrees
+PERCENTILES = (5, 16, 50, 84, 95)
+MAX_ANGLE = 89.0
+
+COLUMNS = ["Lux", "Visible", "IR", "Gain", "IntTime"]
+
+
+def read_data_file(file_name, start=None, end=None):
+    # Read a csv or archived (.parquet) data file, with the times in a DateTime column. Only the readings
+    # from start to end (if given) are read from an archive file
+    if file_name.endswith(".parquet"):
+        return read_archive_file(file_name, COLUMNS, start, end)
+    df = load_day_files_dataframe([file_name], COLUMNS)
+    if start is not None:
+        df = df[df.DateTime >= start]
+    if end is not None:
+        df = df[df.DateTime <= end]
+    return df
+
+
+def find_events(df, prominence=0.0):
+    # Indices of the peaks in the lux. If no prominence is given, calculate one
+    if prominence == 0.0:
+        prominence = np.max(df.Lux) - np.median(df.Lux) - np.std(df.Lux)
+    peaks, properties = find_peaks(df.Lux, prominence=prominence)  # , width=3)
+    return peaks
+
+
+def event_windows(values, peaks, width):
+    # Rows of the width values around each peak (from width/2 before it), gathered into a 2D array
+    # through a sliding window view. Values beyond the ends of the data are NaN
+    half = int(width/2)
+    padded = np.concatenate((np.full(half, np.nan), np.asarray(values, dtype=np.float64), np.full(half, np.nan)))
+    return sliding_window_view(padded, 2 * half)[np.asarray(peaks)]
+
+
+def integrate(values, seconds):
+    # Trapezoidal integral of each row of values over time, leaving out the intervals with a missing value
+    return np.nansum((values[:, 1:] + values[:, :-1]) * np.diff(seconds, axis=1), axis=1) / 2
+
+
+def light_curves(df, peaks, width, distance, angle, extinction):
+    # Light curves of all the peaks at once, one row per peak: times, lux above the median, and the powers
+    # and absolute magnitudes from the lux and from the raw visible (channel 0) counts
+    curves = {}
+    times = df.DateTime.values
+    offsets = event_windows((times - times[0]).astype(np.int64), peaks, width)
+    curves["times"] = times[0] + offsets.astype('timedelta64[ns]')
+    curves["seconds"] = offsets / 1e9
+
+    # Calculate the area of the sphere at that distance, and the adjustments for the incident angle with
+    # the sensor and for atmospheric extinction
+    area = 4 * np.pi * np.square(distance)
+    adjustment = np.power(2.5, extinction) / np.cos(np.deg2rad(angle))
+
+    # Power and magnitude from the lux
+    curves["lux"] = np.maximum(event_windows(df.Lux, peaks, width) - np.median(df.Lux), 0)
+    curves["powers"] = curves["lux"] * adjustment * area * LUMINOUS_EFFICACY
+    with np.errstate(divide='ignore', invalid='ignore'):
+        magnitudes = -2.5*np.log10(curves["powers"]/POWER_OF_MAG_ZERO_FIREBALL)
+    magnitudes[magnitudes == np.inf] = MIN_MAGNITUDE
+    curves["magnitudes"] = magnitudes
+
+    # Power and magnitude from the raw visible counts, getting watts/m2 by scaling the counts by the gain
+    visible = event_windows(df.Visible - np.median(df.Visible), peaks, width)
+    gains = event_windows(df.Gain, peaks, width)
+    curves["irradiance"] = np.maximum(tsl2591_lux.irradiance(visible, gains), 0)
+    curves["raw_powers"] = curves["irradiance"] * area
+    curves["adjusted_raw_powers"] = curves["raw_powers"] * adjustment
+    with np.errstate(divide='ignore', invalid='ignore'):
+        magnitudes_raw = -2.5*np.log10(curves["adjusted_raw_powers"]/POWER_OF_MAG_ZERO_FIREBALL)
+    magnitudes_raw[magnitudes_raw == np.inf] = MIN_MAGNITUDE
+    curves["raw_magnitudes"] = magnitudes_raw
+    return curves
+
+
+def event_table(df, peaks, curves, velocity):
+    # One row per peak: time, peak lux, area under the peak (lux.s), and the energy, mass and peak
+    # magnitude from the lux and from the raw visible counts
+    energy = integrate(curves["powers"], curves["seconds"])
+    raw_energy = integrate(curves["adjusted_raw_powers"], curves["seconds"])
+    with np.errstate(invalid='ignore'):
+        return pd.DataFrame({
+            "Time": df.DateTime.values[peaks],
+            "PeakLux": df.Lux.values[peaks],
+            "IntegratedLux": integrate(curves["lux"], curves["seconds"]),
+            "Energy": energy,
+            "Mass": 2 * energy / (TAU * np.square(velocity)),
+            "PeakMagnitude": np.nanmin(curves["magnitudes"], axis=1),
+            "RawEnergy": raw_energy,
+            "RawMass": 2 * raw_energy / (TAU * np.square(velocity)),
+            "RawPeakMagnitude": np.nanmin(curves["raw_magnitudes"], axis=1),
+        })
+
+
+def sample_parameters(draws, distance, angle, extinction, velocity, errors, seed=None):
+    # Draws of the meteor parameters from normal distributions with the standard deviations in errors
+    # (distance, angle, extinction, velocity), limited to physical values
+    rng = np.random.default_rng(seed)
+    values = [rng.normal(mean, error, draws) if error > 0 else np.full(draws, float(mean))
+              for mean, error in zip((distance, angle, extinction, velocity), errors)]
+    return {
+        "distance": np.maximum(values[0], 1.0),
+        "angle": np.clip(values[1], 0.0, MAX_ANGLE),
+        "extinction": np.maximum(values[2], 0.0),
+        "velocity": np.maximum(values[3], 1.0),
+    }
+
+
+def monte_carlo(curves, parameters, percentiles=PERCENTILES):
+    # Percentiles of the energy, mass and peak magnitude of each event over all the parameter draws, as
+    # one row per event and quantity. The powers are the light curves scaled by a factor of the parameters,
+    # so the integrals and peaks of the light curves are taken once and the draws broadcast against them
+    scale = 4 * np.pi * np.square(parameters["distance"]) * np.power(2.5, parameters["extinction"]) \
+        / np.cos(np.deg2rad(parameters["angle"]))
+    mass_per_joule = 2 / (TAU * np.square(parameters["velocity"]))
+
+    rows = []
+    for event, time in enumerate(curves["times"][:, curves["times"].shape[1] // 2]):
+        results = {}
+        for prefix, curve, efficacy in (("", curves["lux"][event], LUMINOUS_EFFICACY), ("Raw", curves["irradiance"][event], 1.0)):
+            energy = integrate(curve[np.newaxis], curves["seconds"][event][np.newaxis])[0] * efficacy * scale
+            with np.errstate(divide='ignore'):
+                peak_magnitude = -2.5*np.log10(np.nanmax(curve) * efficacy * scale / POWER_OF_MAG_ZERO_FIREBALL)
+            # As for the single values, a reading with no power counts as the minimum magnitude
+            if np.any(curve == 0):
+                peak_magnitude = np.minimum(peak_magnitude, MIN_MAGNITUDE)
+            results[prefix + "Energy"] = energy
+            results[prefix + "Mass"] = energy * mass_per_joule
+            results[prefix + "PeakMagnitude"] = peak_magnitude
+        for quantity, values in results.items():
+            rows.append([time, quantity] + list(np.percentile(values, percentiles)))
+    return pd.DataFrame(rows, columns=["Time", "Quantity"] + ["{0:g}%".format(p) for p in percentiles])
+
+
+def catalogue_file(file_name, start=None, end=None, prominence=0.0, width=40, distance=50000, angle=45,
+                   extinction=0.0, velocity=15000, reprocess=False):
+    # Event table of one data file, for a process pool
+    df = read_data_file(file_name, start, end).reset_index(drop=True)
+    if len(df) == 0:
+        return pd.DataFrame()
+    if reprocess:
+        df["Lux"] = tsl2591_lux.lux(df.Visible, df.IR, df.Gain, df.IntTime)
+    peaks = find_events(df, prominence)
+    events = event_table(df, peaks, light_curves(df, peaks, width, distance, angle, extinction), velocity)
+    events.insert(0, "File", os.path.basename(file_name))
+    return events
+
+
 # Main program
 if __name__ == "__main__":
 
@@ -40,7 +187,7 @@ if __name__ == "__main__":
         description='Analyse a light curve from the radiometer data',
         epilog='Example usage: python lightcurve.py -p 0.01 -w 40 -d 120000 -a 50 -v 12000 20230131_0001.csv')
     ap.add_argument("file", type=str, nargs='+',
-                    help="File to analyse")
+                    help="Csv or archive (.parquet) file to analyse")
     ap.add_argument("-p", "--prominence", type=float, default=0.0,
                     help="Peak detection prominence above background. Default is auto")
     ap.add_argument("-w", "--width", type=int, default=40,
@@ -53,6 +200,31 @@ if __name__ == "__main__":
                     help="Atmospheric extinction in magnitudes. Default is 0 magnitudes extinctions")
     ap.add_argument("-v", "--velocity", type=float, default=15000,
                     help="Velocity in m/s. Default is 15000 m/s")
+    ap.add_argument("-r", "--reprocess", action='store_true',
+                    help="Recalculate the lux values from the raw sensor counts")
+    ap.add_argument("--start", type=str, default=None,
+                    help="Analyse the readings from this time e.g. \"2023/01/13 02:14\"")
+    ap.add_argument("--end", type=str, default=None,
+                    help="Analyse the readings up to this time")
+    ap.add_argument("-c", "--catalogue", action='store_true',
+                    help="Analyse each file separately, several at once, and print a table of the events in all of them without graphs")
+    ap.add_argument("-o", "--output", type=str, default=None,
+                    help="Also save the table of events to this csv file")
+    ap.add_argument("-m", "--monte-carlo", type=int, default=0,
+                    help="Number of random draws of the distance, angle, extinction and velocity from their errors, "
+                         "e.g. 100000, to report percentiles of the energy, mass and peak magnitude of each event")
+    ap.add_argument("--distance-error", type=float, default=0.0,
+                    help="Standard deviation of the distance in meters for --monte-carlo")
+    ap.add_argument("--angle-error", type=float, default=0.0,
+                    help="Standard deviation of the angle in degrees for --monte-carlo")
+    ap.add_argument("--extinction-error", type=float, default=0.0,
+                    help="Standard deviation of the extinction in magnitudes for --monte-carlo")
+    ap.add_argument("--velocity-error", type=float, default=0.0,
+                    help="Standard deviation of the velocity in m/s for --monte-carlo")
+    ap.add_argument("--seed", type=int, default=None,
+                    help="Random seed for --monte-carlo, to repeat a run")
+    ap.add_argument("-j", "--jobs", type=int, default=None,
+                    help="Number of files analysed at once with --catalogue. Default is the number of processors")
 
     args = vars(ap.parse_args())
 
@@ -63,80 +235,81 @@ if __name__ == "__main__":
     angle = args['angle']
     extinction = args['extinction']
     velocity = args['velocity']
+    reprocess = args['reprocess']
+    start = pd.Timestamp(args['start']) if args['start'] is not None else None
+    end = pd.Timestamp(args['end']) if args['end'] is not None else None
+
+    options = dict(start=start, end=end, prominence=prominence, width=width, distance=distance, angle=angle,
+                   extinction=extinction, velocity=velocity, reprocess=reprocess)
 
-    print("Graphing", file_names)
+    print("Cataloguing" if args['catalogue'] else "Graphing", file_names)
     print("Initial parameters.\nDistance (m):", distance,
           "\nAngle (degrees):", angle, "\nAtmospheric Extinction", extinction, "\nVelocity (m/s):", velocity)
     print()
 
+    # Catalogue the events of many files in parallel
+    if args['catalogue']:
+        with ProcessPoolExecutor(max_workers=args['jobs']) as executor:
+            futures = [executor.submit(catalogue_file, file_name, **options) for file_name in file_names]
+            tables = []
+            for file_name, future in zip(file_names, futures):
+                try:
+                    tables.append(future.result())
+                except Exception as e:
+                    print("Error analysing", file_name, e)
+        events = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+        print(events.to_string(index=False))
+        if args['output'] is not None:
+            events.to_csv(args['output'], index=False)
+        exit(0)
+
     # Ignore div by zero warnings
     np.seterr(divide='ignore')
 
     # Collect the data into a pandas dataframe
-    columns = ["Date", "Time", "Lux", "Visible", "IR", "Gain", "IntTime"]
-    dfs = [pd.read_csv(file_name, sep=' ', names=columns)
+    dfs = [read_data_file(file_name, start, end)
            for file_name in file_names]
     df = pd.concat(dfs, ignore_index=True)
 
-    # Format the times into datetime values
-    times = pd.to_datetime(df.Date + " " + df.Time,
-                           format="%Y/%m/%d %H:%M:%S.%f")
+    # Recalculate lux from the raw counts, gain and integration time, for the whole data set at once
+    if reprocess:
+        df["Lux"] = tsl2591_lux.lux(df.Visible, df.IR, df.Gain, df.IntTime)
 
-    # Find peaks in the data. If no prominence is given, calculate one
-    if prominence == 0.0:
-        prominence = np.max(df.Lux) - np.median(df.Lux) - np.std(df.Lux)
-    peaks = []
-    peaks, properties = find_peaks(
-        df.Lux, prominence=prominence)  # , width=3)
+    times = df.DateTime
+
+    # Find peaks in the data
+    peaks = find_events(df, prominence)
     print("Peaks found:", len(peaks))
 
     if len(peaks) == 0:
         exit(-1)
 
-    for peak in peaks:
-        print(df.Time[peak], df.Lux[peak])
-
-    # Calculate area under the peak
-    # print(peaks, properties)
-    median_adjusted_lux = df.Lux[peak -
-                                 (int(width/2)):peak+(int(width/2))]-np.median(df.Lux)
-    median_adjusted_lux[median_adjusted_lux < 0] = 0
-    times_over_peaks = times[peak - (int(width/2)):peak+(int(width/2))]
-    times_over_peaks = times_over_peaks - times[peak - (int(width/2))]
-    np_times_over_peaks = times_over_peaks.to_numpy(dtype=float)/1e9
-
-    print("Median", np.median(df.Lux), "Peak",
-          df.Lux[peak], "STD", np.std(df.Lux))
-    integrated_lux = np.trapz(median_adjusted_lux, x=np_times_over_peaks)
-    # , simpson(adjusted_peaks))
-    print("Area under peak:", integrated_lux, "Lux.s\n")
-
-    # Calculate the area of the sphere at that distance
-    area = 4 * np.pi * np.square(distance)
-
-    # Adjust the lux values for incident angle with the sensor
-    angle_adjusted_lux = median_adjusted_lux / np.cos(np.deg2rad(angle))
-
-    # Adjust the lux values for atmospheric extinction
-    extinction_adjusted_lux = angle_adjusted_lux * np.power(2.5, extinction)
-
-    # Calculate the power and magnitude over the light curve
-    powers = extinction_adjusted_lux * area * LUMINOUS_EFFICACY
-    powers[powers < 0] = 0
-    magnitudes = -2.5*np.log10(powers/POWER_OF_MAG_ZERO_FIREBALL)
-    magnitudes[magnitudes == np.inf] = MIN_MAGNITUDE
-
-    integrated_power = np.trapz(powers, x=np_times_over_peaks)
-    mass = 2 * integrated_power / (TAU * np.square(velocity))
-
-    print("Estimated energy:", np.around(integrated_power, 2), "J")
-    print("Estimated mass:", np.around(mass, 2), "kg")
-    print("Peak magnitude", np.around(np.min(magnitudes), 2))
+    # Analyse all the peaks at once
+    curves = light_curves(df, peaks, width, distance, angle, extinction)
+    events = event_table(df, peaks, curves, velocity)
+    print("Median", np.median(df.Lux), "STD", np.std(df.Lux))
+    print(events.to_string(index=False))
     print()
+    if args['output'] is not None:
+        events.to_csv(args['output'], index=False)
+
+    # Percentiles of the estimates over random draws of the parameters
+    if args['monte_carlo'] > 0:
+        errors = (args['distance_error'], args['angle_error'], args['extinction_error'], args['velocity_error'])
+        parameters = sample_parameters(args['monte_carlo'], distance, angle, extinction, velocity, errors, args['seed'])
+        print("Monte Carlo estimates from", args['monte_carlo'], "draws")
+        print(monte_carlo(curves, parameters).to_string(index=False))
+        print()
+
+    # Graph the brightest event
+    event = int(np.argmax(events.PeakLux))
+    peak = peaks[event]
+    times_over_peaks = curves["times"][event] - curves["times"][event][0]
 
     # Plot the lux data vs time
     plt.plot(times, df.Lux)
-    plt.axvspan(times[peaks-width], times[peaks+width], color='red', alpha=0.1)
+    for window in curves["times"]:
+        plt.axvspan(np.nanmin(window), np.nanmax(window), color='red', alpha=0.1)
     plt.xlabel('Time')
     plt.ylabel('Lux')
 
@@ -149,7 +322,7 @@ if __name__ == "__main__":
     plt.show()
 
     # Plot the magnitudes
-    plt.plot(times_over_peaks, magnitudes)
+    plt.plot(times_over_peaks, curves["magnitudes"][event])
     plt.xlabel('Time')
     plt.ylabel('Abs Magnitude')
     plt.gca().invert_yaxis()
@@ -164,58 +337,16 @@ if __name__ == "__main__":
     plt.legend(loc='upper left')
     plt.show()
 
-    # Calculate energy and mass using the raw channel 0 data which includes visble and IR
-    visible_data = df.Visible
-    visible_data = visible_data - np.median(visible_data)
-
-    # Restrict the data to values either side of the peak
-    visible_data = visible_data[peak - (int(width/2)):peak+(int(width/2))]
-    times_of_visible_data = times[peak - (int(width/2)):peak+(int(width/2))]
-    gains_of_visible_data = df.Gain[peak - (int(width/2)):peak+(int(width/2))]
-
-    # Calculate the gain scaling
-    # The RE_WHITE_CHANNEL0 measured in the datasheet is measured at high gain, so divide by the GAIN_HIGH factor
-    # Note: datasheet says the gain scaling for max gain is 9200/400
-    gain_scaling = gains_of_visible_data/GAIN_HIGH
-
-    # Get watts/m2.
-    watts_per_square_meter = visible_data / (RE_WHITE_CHANNEL0 * gain_scaling)
-    powers = watts_per_square_meter * area
-
-    # Remove any powers that may be negative
-    powers[powers < 0] = 0
-
-    # Adjust the powers for the incident angle of the light with the sensor
-    angle_adjusted_powers = powers / np.cos(np.deg2rad(angle))
-
-    # Adjust the powers for atmospheric extinction
-    extinction_adjusted_powers = angle_adjusted_powers * np.power(2.5, extinction)
-
-    # Integrate the power over time to get the energy under the light curve
-    integrated_power = np.trapz(extinction_adjusted_powers, x=np_times_over_peaks)
-
-    mass = 2 * integrated_power / (TAU * np.square(velocity))
-    print("Estimated energy from raw sensor data",
-          '{:.2E}'.format(integrated_power), "J")
-    print("Estimated mass from raw sensor data", np.around(mass, 2), "kg")
-
-    magnitudes_raw = -2.5*np.log10(extinction_adjusted_powers /
-                               POWER_OF_MAG_ZERO_FIREBALL)
-
-    magnitudes_raw[magnitudes_raw == np.inf] = MIN_MAGNITUDE
-
-    print("Peak magnitude", np.around(np.min(magnitudes_raw), 2))
-
     # Plot power graph
-    plt.plot(times_of_visible_data, powers, marker='.')
+    plt.plot(curves["times"][event], curves["raw_powers"][event], marker='.')
     plt.title("Power from Raw Visible Sensor Data")
     plt.xlabel('Time')
     plt.ylabel('Power (Watts)')
     plt.show()
 
     # Plot graph of magnitudes
-    plt.plot(times_of_visible_data, magnitudes, label="Lux Data", marker='.')
-    plt.plot(times_of_visible_data, magnitudes_raw, label="Raw Visible Sensor Data", marker='.')
+    plt.plot(curves["times"][event], curves["magnitudes"][event], label="Lux Data", marker='.')
+    plt.plot(curves["times"][event], curves["raw_magnitudes"][event], label="Raw Visible Sensor Data", marker='.')
     plt.title("Magnitudes")
     plt.xlabel('Time')
     plt.ylabel('Abs Magnitude')
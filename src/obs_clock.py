@@ -0,0 +1,83 @@
+import datetime
+import time
+
+# Observation times for the readings, taken from the monotonic clock and anchored to the wall clock
+# once a minute, so that a step of the wall clock (e.g. NTP correcting it) never makes the readings go
+# backwards, and the formatting of those times for the data files, with the date formatted once a day.
+
+# Nanoseconds of monotonic time between re-reading the wall clock
+ANCHOR_INTERVAL = 60 * 10**9
+
+# When the wall clock has gone back, the observation clock runs 1/SLEW_DIVISOR slower until it has
+# caught up, i.e. 50 ms per second, instead of stepping back. Steps forward are followed at once
+SLEW_DIVISOR = 20
+
+_default_clock = None
+
+
+def default_clock():
+    # The observation clock shared by all the sensors in the process, created when first used
+    global _default_clock
+    if _default_clock is None:
+        _default_clock = ObservationClock()
+    return _default_clock
+
+
+class ObservationClock():
+    # Local times are calculated from the latest anchor, so a daylight saving change is followed at
+    # the next anchor, up to a minute later
+
+    def __init__(self, anchor_interval=ANCHOR_INTERVAL):
+        self.anchor_interval = anchor_interval
+        monotonic_ns = time.monotonic_ns()
+        self.set_anchor(monotonic_ns, time.time_ns(), 0)
+
+    def set_anchor(self, monotonic_ns, epoch_ns, slew_ns):
+        seconds, ns = divmod(epoch_ns, 10**9)
+        anchor_time = datetime.datetime.fromtimestamp(seconds) + datetime.timedelta(0, 0, ns // 1000)
+        # One tuple, so that readers in other threads never see half an anchor
+        self.anchor = (monotonic_ns, epoch_ns, anchor_time, slew_ns)
+
+    def offset_ns(self, monotonic_ns):
+        # Nanoseconds of observation time from the anchor to monotonic_ns, less the slew so far
+        anchor_ns, _, _, slew_ns = self.anchor
+        elapsed = monotonic_ns - anchor_ns
+        if slew_ns and elapsed > 0:
+            elapsed -= min(slew_ns, elapsed // SLEW_DIVISOR)
+        return elapsed
+
+    def reanchor(self):
+        monotonic_ns = time.monotonic_ns()
+        epoch_ns = time.time_ns()
+        predicted_ns = self.anchor[1] + self.offset_ns(monotonic_ns)
+        if epoch_ns >= predicted_ns:
+            self.set_anchor(monotonic_ns, epoch_ns, 0)
+        else:
+            self.set_anchor(monotonic_ns, predicted_ns, predicted_ns - epoch_ns)
+
+    def from_monotonic_ns(self, monotonic_ns):
+        # Local time of a monotonic clock time in ns, e.g. the kernel's timestamp of a GPIO edge
+        if monotonic_ns - self.anchor[0] >= self.anchor_interval:
+            self.reanchor()
+        anchor_time = self.anchor[2]
+        return anchor_time + datetime.timedelta(0, 0, self.offset_ns(monotonic_ns) // 1000)
+
+    def now(self):
+        return self.from_monotonic_ns(time.monotonic_ns())
+
+
+class TimeFormatter():
+    # Formats times as in the data files, e.g. "2023/01/13 02:14:52.938". The date part is only
+    # formatted when the day changes, and day is the day number (ordinal) of the last time formatted
+
+    def __init__(self):
+        self.day = None
+        self.date_prefix = None
+
+    def format(self, obs_time):
+        day = obs_time.toordinal()
+        if day != self.day:
+            self.day = day
+            self.date_prefix = obs_time.strftime("%Y/%m/%d ")
+        return "%s%02d:%02d:%02d.%03d" % (self.date_prefix, obs_time.hour, obs_time.minute,
+                                         obs_time.second, obs_time.microsecond // 1000)
@@ -0,0 +1,174 @@
+import os
+import struct
+import numpy as np
+from radiometer_logger import DATA_DIR
+
+# Binary day files hold the same readings as the R*.csv files as fixed size records, so that
+# a whole night can be mapped into memory instead of being parsed line by line.
+#
+# The file starts with a 16 byte header: magic, format version, header size and record size.
+MAGIC = b'RADB'
+VERSION = 1
+HEADER = struct.Struct('<4sHHH6x')
+
+# Record layout for version 1. Times are nanoseconds since the unix epoch, gain and atime
+# are the TSL2591 register codes e.g. GAIN_MAX 0x30, INTEGRATIONTIME_100MS 0
+RECORD_DTYPE = np.dtype([
+    ('time', '<i8'),
+    ('ch0', '<u2'),
+    ('ch1', '<u2'),
+    ('gain', 'u1'),
+    ('atime', 'u1'),
+    ('pad', 'V2'),
+    ('lux', '<f4'),
+    ('temp', '<f4'),
+    ('humidity', '<f4'),
+    ('pressure', '<f4'),
+    ('dew_point', '<f4'),
+    ('cloud_temp', '<f4'),
+])
+RECORD = struct.Struct('<qHHBB2xf5f')
+
+# Gain factors for the TSL2591 gain codes
+GAIN_CODES = {1.0: 0x00, 25.0: 0x10, 428.0: 0x20, 9876.0: 0x30}
+GAIN_FACTORS = np.zeros(256, dtype=np.float32)
+for factor, code in GAIN_CODES.items():
+    GAIN_FACTORS[code] = factor
+
+NAN = float('nan')
+
+
+def epoch_ns(obs_time):
+    # Convert a local datetime to nanoseconds since the epoch, to microsecond resolution
+    return round(obs_time.timestamp() * 1e6) * 1000
+
+
+def prepare_for_append(file, file_name):
+    # Make a binary day file opened for appending ready for new records. A new file, or one whose header
+    # was cut short, gets a header. The header of an existing file is checked, and a partly written last
+    # record (e.g. after a power cut) is cut off, so that the records appended after it stay aligned
+    size = file.seek(0, os.SEEK_END)
+    if size < HEADER.size:
+        file.truncate(0)
+        file.write(HEADER.pack(MAGIC, VERSION, HEADER.size, RECORD.size))
+        return
+    with open(file_name, "rb") as reader:
+        magic, version, header_size, record_size = HEADER.unpack(reader.read(HEADER.size))
+    if magic != MAGIC or version != VERSION or header_size != HEADER.size or record_size != RECORD.size:
+        raise ValueError("Cannot append to {0:s}: not a version {1:d} radiometer binary file".format(file_name, VERSION))
+    partial = (size - HEADER.size) % RECORD.size
+    if partial:
+        print("Removing a partly written record from", file_name)
+        file.truncate(size - partial)
+
+
+class BinaryDayFileSink():
+    # A dated binary output file e.g. R_name_20221127.bin, written alongside the csv file.
+    # Takes the same values as the csv data file: lux, ch0, ch1, gain factor, atime in ms and
+    # optionally temperature, humidity, pressure, dew point and cloud temperature.
+
+    def __init__(self, prefix, name, extension=".bin", data_dir=DATA_DIR):
+        self.prefix = prefix + name
+        self.extension = extension
+        self.data_dir = data_dir
+        self.day = None
+        self.file = None
+        self.filename = None
+        self.pending = []
+        self.dropped = 0  # Records lost because they could not be written
+
+    def add(self, obs_time, values):
+        day = obs_time.toordinal()
+        if day != self.day:
+            try:
+                self.write_pending()
+                self.open_day(obs_time)
+            except Exception:
+                # The record is lost, and the next one tries the new day's file again
+                self.dropped += 1
+                raise
+            self.day = day
+        lux, ch0, ch1, again, atime = values[:5]
+        env = tuple(values[5:10]) + (NAN,) * (10 - len(values))
+        self.pending.append(RECORD.pack(
+            epoch_ns(obs_time), int(ch0), int(ch1), GAIN_CODES.get(again, 0xFF),
+            int(atime) // 100 - 1, lux, *env))
+
+    def open_day(self, obs_time):
+        # The file is only set once the new one is open and checked, so that after an error nothing is written
+        # to a closed file
+        if self.file is not None:
+            file, self.file = self.file, None
+            file.close()
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.filename = self.prefix + obs_time.strftime("%Y%m%d") + self.extension
+        file = open(self.data_dir + self.filename, "ab")
+        try:
+            prepare_for_append(file, self.data_dir + self.filename)
+        except Exception:
+            file.close()
+            raise
+        self.file = file
+
+    def write_pending(self):
+        # The records are taken before writing, so that after a write error (e.g. a full or read only SD card)
+        # they are counted and dropped, instead of being kept and written again with every later batch
+        if self.pending:
+            pending, self.pending = self.pending, []
+            try:
+                self.file.write(b"".join(pending))
+            except Exception:
+                self.dropped += len(pending)
+                raise
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def fsync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.write_pending()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def open_binary_day_file(file_name):
+    # Map a binary day file into memory as a structured array, without copying or parsing it.
+    # A partly written record at the end of the file is ignored.
+    with open(file_name, "rb") as file:
+        magic, version, header_size, record_size = HEADER.unpack(file.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("Not a radiometer binary file: " + file_name)
+    if version != VERSION or record_size != RECORD_DTYPE.itemsize:
+        raise ValueError("Unsupported radiometer binary file version {0:d} in {1:s}".format(version, file_name))
+
+    count = (os.path.getsize(file_name) - header_size) // record_size
+    if count <= 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(file_name, dtype=RECORD_DTYPE, mode='r', offset=header_size, shape=(count,))
+
+
+def binary_day_file_dataframe(file_name):
+    # Read a binary day file into a dataframe with the same columns as the csv files, and local times
+    import pandas as pd
+    from dateutil import tz
+    records = open_binary_day_file(file_name)
+    times = pd.DatetimeIndex(records['time'].astype('datetime64[ns]'), tz='UTC')
+    return pd.DataFrame({
+        "DateTime": times.tz_convert(tz.tzlocal()).tz_localize(None),
+        "Lux": records['lux'],
+        "Visible": records['ch0'],
+        "IR": records['ch1'],
+        "Gain": GAIN_FACTORS[records['gain']],
+        "IntTime": (records['atime'].astype(np.float32) + 1) * 100,
+        "Temp": records['temp'],
+        "Humidity": records['humidity'],
+        "Pressure": records['pressure'],
+        "DewPoint": records['dew_point'],
+        "CloudTemp": records['cloud_temp'],
+    })
@@ -0,0 +1,256 @@
+import argparse
+import asyncio
+import json
+import signal
+from adafruit_extended_bus import ExtendedI2C as I2C
+import adafruit_tsl2591
+from radiometer_tsl2591 import adafruit_tsl2591_extended, RadiometerDataLogger, DEFAULT_I2C_ADDRESS
+from radiometer_logger import close_loggers
+from environment_sampler import EnvironmentSampler, ENV_SAMPLE_INTERVAL, NO_ENV_DATA
+from event_capture import PRE_TRIGGER, POST_TRIGGER
+from fireball_detector import TRIGGER_SIGMA, TRIGGER_STEP
+from obs_clock import default_clock
+from acquisition_metrics import AcquisitionMetrics, start_metrics_exporter, STAGE_LOG, EXPORT_INTERVAL
+
+# Gain settings that can be requested for each sensor. Auto gain starts at maximum
+GAIN_SETTINGS = {
+    "max": adafruit_tsl2591.GAIN_MAX,
+    "high": adafruit_tsl2591.GAIN_HIGH,
+    "med": adafruit_tsl2591.GAIN_MED,
+    "low": adafruit_tsl2591.GAIN_LOW,
+    "auto": adafruit_tsl2591.GAIN_MAX,
+}
+
+# Time between readings, matching the 100ms integration time of the sensor
+READING_PERIOD = 0.1
+
+
+def parse_sensor_spec(spec):
+    # Parse a sensor description such as "bus=3,gain=med,name=GAIN_MED,mux=1,address=0x29"
+    sensor = {"bus": 1, "address": DEFAULT_I2C_ADDRESS,
+              "mux": None, "gain": "auto", "name": ""}
+    for item in spec.split(","):
+        key, _, value = item.partition("=")
+        key = key.strip()
+        if key not in sensor:
+            raise ValueError("Unknown sensor option: " + key)
+        sensor[key] = value.strip()
+    return normalise_sensor(sensor)
+
+
+def normalise_sensor(sensor):
+    # Convert the sensor options to their proper types and check the gain setting
+    sensor = dict(sensor)
+    sensor["bus"] = int(sensor.get("bus", 1))
+    address = sensor.get("address", DEFAULT_I2C_ADDRESS)
+    sensor["address"] = int(address, 0) if isinstance(address, str) else int(address)
+    mux = sensor.get("mux")
+    sensor["mux"] = None if mux in (None, "") else int(mux)
+    sensor["gain"] = sensor.get("gain", "auto")
+    sensor["name"] = sensor.get("name", "")
+    if sensor["gain"] not in GAIN_SETTINGS:
+        raise ValueError("Unknown gain setting: " + str(sensor["gain"]))
+    return sensor
+
+
+def sensor_location(config):
+    # Where a sensor is connected, e.g. "bus3_mux1_0x29"
+    mux = "" if config["mux"] is None else "_mux" + str(config["mux"])
+    return "bus{0:d}{1:s}_{2:#04x}".format(config["bus"], mux, config["address"])
+
+
+def load_sensor_config(file_name):
+    # Read a JSON list of sensor descriptions
+    with open(file_name) as config_file:
+        return [normalise_sensor(sensor) for sensor in json.load(config_file)]
+
+
+class SensorBuses():
+    # Open each i2c bus and TCA9548A multiplexer only once, however many sensors share it
+
+    def __init__(self):
+        self.buses = {}
+        self.multiplexers = {}
+
+    def bus(self, bus_number):
+        if bus_number not in self.buses:
+            self.buses[bus_number] = I2C(bus_number)
+        return self.buses[bus_number]
+
+    def device_bus(self, bus_number, mux_channel):
+        if mux_channel is None:
+            return self.bus(bus_number)
+        if bus_number not in self.multiplexers:
+            import adafruit_tca9548a
+            self.multiplexers[bus_number] = adafruit_tca9548a.TCA9548A(
+                self.bus(bus_number))
+        return self.multiplexers[bus_number][mux_channel]
+
+
+class SensorChannel():
+    # State for one light sensor: the device, its gain policy and its data logger
+
+    def __init__(self, config, buses, verbose=False, env_sampler=None, logger_options={}):
+        self.config = config
+        self.env_sampler = env_sampler
+        self.name = config["name"]
+        self.auto_gain = config["gain"] == "auto"
+        self.verbose = verbose
+
+        device_bus = buses.device_bus(config["bus"], config["mux"])
+        if config["mux"] is not None:
+            self.sensor = adafruit_tsl2591_extended(device_bus)
+        else:
+            self.sensor = adafruit_tsl2591_extended(
+                device_bus, address=config["address"])
+        self.sensor.enable()
+        self.sensor.gain = GAIN_SETTINGS[config["gain"]]
+        self.sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_100MS
+        self.sensor.auto_gain = self.auto_gain
+
+        # Data file options shared by all the sensors e.g. binary output, event capture and decimation
+        self.logger = RadiometerDataLogger(name=self.name, rate=1 / READING_PERIOD, **logger_options)
+        self.sensor.on_gain_transition = self.logger.log_gain_transition
+
+        # Timings of each stage of a reading, for the metrics exporter. An unnamed sensor is labelled by where it is connected
+        self.metrics = AcquisitionMetrics(self.name or sensor_location(config))
+        self.sensor.metrics = self.metrics
+        self.clock = default_clock()
+
+    def read(self):
+        # Take one reading and log it. This must not block for longer than an i2c transfer
+        time_stamp = self.clock.now()
+        self.metrics.reading(READING_PERIOD)
+        reading = self.sensor.get_light_levels()
+
+        # Readings taken while the gain is being changed are discarded by the sensor
+        if reading is None:
+            return
+
+        lux, vis_level, ir_level, again, atime = reading
+        env_data = self.env_sampler.latest[1] if self.env_sampler is not None else NO_ENV_DATA
+        t = self.metrics.now()
+        self.logger.log_data(time_stamp, lux, vis_level,
+                             ir_level, again, atime, *env_data)
+        self.metrics.lap(STAGE_LOG, t)
+        if self.verbose:
+            print(f"{self.name} Log: {time_stamp}, Lux: {lux}, Gain: {again}")
+
+    async def run(self):
+        # Read the sensor once per integration period on a fixed schedule
+        loop = asyncio.get_running_loop()
+        next_reading = loop.time() + READING_PERIOD
+        while True:
+            await asyncio.sleep(max(0.0, next_reading - loop.time()))
+            try:
+                self.read()
+            except RuntimeError as e:
+                print(self.name, "Sensor error:", e)
+            except Exception as e:
+                print(self.name, "Unexpected error:", e)
+
+            # Stay on the integration schedule, but don't try to catch up on missed readings
+            next_reading += READING_PERIOD
+            if next_reading < loop.time():
+                next_reading = loop.time() + READING_PERIOD
+
+
+def start_environment_sampler(i2c, interval):
+    # Sample the BME280 and MLX90614 on the given bus in the background, for all the light sensors
+    from adafruit_bme280 import basic as adafruit_bme280
+    import adafruit_mlx90614
+    bme280 = mlx = None
+    try:
+        bme280 = adafruit_bme280.Adafruit_BME280_I2C(i2c)
+    except Exception as e:
+        print("No BME280 found:", e)
+    try:
+        mlx = adafruit_mlx90614.MLX90614(i2c)
+    except Exception as e:
+        print("No MLX90614 found:", e)
+    env_sampler = EnvironmentSampler(bme280=bme280, mlx=mlx, interval=interval)
+    env_sampler.metrics = AcquisitionMetrics("environment")
+    return env_sampler.start()
+
+
+async def run_sensors(sensor_configs, verbose=False, env_bus=None, env_interval=ENV_SAMPLE_INTERVAL, logger_options={},
+                      metrics=False, metrics_interval=EXPORT_INTERVAL, metrics_port=None):
+    buses = SensorBuses()
+    env_sampler = None
+    if env_bus is not None:
+        env_sampler = start_environment_sampler(buses.bus(env_bus), env_interval)
+    channels = [SensorChannel(config, buses, verbose=verbose, env_sampler=env_sampler, logger_options=logger_options)
+                for config in sensor_configs]
+    if metrics or metrics_port is not None:
+        start_metrics_exporter("radiometer_daemon", interval=metrics_interval, port=metrics_port)
+
+    # Stop all the sensor tasks cleanly on a termination signal
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    tasks = [asyncio.create_task(channel.run()) for channel in channels]
+    await stop.wait()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Write out any readings still queued for the data files
+    close_loggers()
+
+
+# Main program
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(
+        description='Acquire light levels from several sensors in one process',
+        epilog='Example usage: python radiometer_daemon.py -s bus=1,gain=max,name=GAIN_MAX -s bus=3,gain=med,name=GAIN_MED')
+    ap.add_argument("-s", "--sensor", type=str, action='append', default=[],
+                    help="Sensor description as comma separated key=value options: bus, address, mux, gain (max, high, med, low, auto) and name. May be repeated")
+    ap.add_argument("-c", "--config", type=str, default=None,
+                    help="JSON file containing a list of sensor descriptions with the same keys as --sensor")
+    ap.add_argument("--binary", action='store_true',
+                    help="Also write the readings to binary .bin data files")
+    ap.add_argument("--events", action='store_true',
+                    help="Write the full rate readings around sudden increases in light level (e.g. fireballs) to separate event files")
+    ap.add_argument("--detect", action='store_true',
+                    help="Record the peaks of sudden increases in light level to F*.csv detection files. Implied by --events")
+    ap.add_argument("--pre-trigger", type=float, default=PRE_TRIGGER,
+                    help="Seconds of readings written before an event. Default is " + str(PRE_TRIGGER))
+    ap.add_argument("--post-trigger", type=float, default=POST_TRIGGER,
+                    help="Seconds of readings written after an event. Default is " + str(POST_TRIGGER))
+    ap.add_argument("--trigger-step", type=float, default=TRIGGER_STEP,
+                    help="Minimum rise in lux above the background which triggers an event. Default is " + str(TRIGGER_STEP))
+    ap.add_argument("--trigger-sigma", type=float, default=TRIGGER_SIGMA,
+                    help="Rise above the background in noise levels (standard deviations) which triggers an event. Default is " + str(TRIGGER_SIGMA))
+    ap.add_argument("-d", "--decimate", type=int, default=1,
+                    help="Write the average of this many readings to the main data files. Default is 1 (every reading)")
+    ap.add_argument("-e", "--env-bus", type=int, default=None,
+                    help="i2c bus of the BME280 and MLX90614 environmental sensors. Default is no environmental sensors")
+    ap.add_argument("--env-interval", type=float, default=ENV_SAMPLE_INTERVAL,
+                    help="Seconds between environmental readings. Default is " + str(ENV_SAMPLE_INTERVAL))
+    ap.add_argument("--metrics", action='store_true',
+                    help="Write the timings of each stage of a reading to a status file e.g. /dev/shm/radiometer_daemon_metrics.json")
+    ap.add_argument("--metrics-interval", type=float, default=EXPORT_INTERVAL,
+                    help="Seconds between status file updates. Default is " + str(EXPORT_INTERVAL))
+    ap.add_argument("--metrics-port", type=int, default=None,
+                    help="Also serve the timings as text metrics over http on this port e.g. 9100")
+    ap.add_argument("-v", "--verbose", action='store_true',
+                    help="Verbose output to terminal")
+    args = vars(ap.parse_args())
+
+    sensor_configs = [parse_sensor_spec(spec) for spec in args['sensor']]
+    if args['config'] is not None:
+        sensor_configs += load_sensor_config(args['config'])
+    if len(sensor_configs) == 0:
+        sensor_configs = [normalise_sensor({})]
+
+    logger_options = {key: args[key] for key in
+                      ('binary', 'events', 'detect', 'decimate', 'pre_trigger', 'post_trigger',
+                       'trigger_sigma', 'trigger_step')}
+    asyncio.run(run_sensors(sensor_configs, verbose=args['verbose'], env_bus=args['env_bus'],
+                            env_interval=args['env_interval'], logger_options=logger_options,
+                            metrics=args['metrics'], metrics_interval=args['metrics_interval'],
+                            metrics_port=args['metrics_port']))
@@ -0,0 +1,177 @@
+import os
+import queue
+import threading
+import time
+from obs_clock import TimeFormatter
+
+DATA_DIR = os.path.expanduser('~/radiometer_data/')
+
+# Maximum number of records held in memory waiting to be written.
+# At 10 Hz this is over 13 minutes of readings.
+QUEUE_SIZE = 8192
+
+# Maximum number of records written to the files in one go
+MAX_BATCH = 1024
+
+# Seconds between flushing written records to the operating system, and between forcing them onto the SD card
+FLUSH_INTERVAL = 1.0
+FSYNC_INTERVAL = 30.0
+
+# Open loggers, so that they can all be drained when the process is terminated
+_loggers = []
+
+
+def close_loggers():
+    # Write out everything still queued in all open loggers. Used by the signal handlers
+    for logger in list(_loggers):
+        logger.close()
+
+
+class DayFileSink():
+    # A dated output file e.g. R_name_20221127.csv, which moves to a new file when the date changes
+
+    def __init__(self, prefix, name, line_format, extension=".csv", data_dir=DATA_DIR):
+        self.prefix = prefix + name
+        self.line_format = line_format
+        self.extension = extension
+        self.data_dir = data_dir
+        self.day = None
+        self.file = None
+        self.filename = None
+        self.pending = []
+        self.dropped = 0  # Records lost because they could not be written
+        self.formatter = TimeFormatter()
+
+    def add(self, obs_time, values):
+        # Format a record, changing to a new file if the record is from a new day
+        time_text = self.formatter.format(obs_time)
+        if self.formatter.day != self.day:
+            try:
+                self.write_pending()
+                self.open_day(obs_time)
+            except Exception:
+                # The record is lost, and the next one tries the new day's file again
+                self.dropped += 1
+                raise
+            self.day = self.formatter.day
+        self.pending.append(self.line_format.format(time_text, *values))
+
+    def open_day(self, obs_time):
+        # The file is only set once the new one is open, so that after an error nothing is written to a closed file
+        if self.file is not None:
+            file, self.file = self.file, None
+            file.close()
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.filename = self.prefix + obs_time.strftime("%Y%m%d") + self.extension
+        self.file = open(self.data_dir + self.filename, "a")
+
+    def write_pending(self):
+        # The records are taken before writing, so that after a write error (e.g. a full or read only SD card)
+        # they are counted and dropped, instead of being kept and written again with every later batch
+        if self.pending:
+            pending, self.pending = self.pending, []
+            try:
+                self.file.write("".join(pending))
+            except Exception:
+                self.dropped += len(pending)
+                raise
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def fsync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.write_pending()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class BatchedDataLogger():
+    # Write-behind logger. Records are queued by the sampling loop without blocking, and a
+    # background thread formats and writes them to the output files in batches.
+
+    def __init__(self, sinks, queue_size=QUEUE_SIZE, flush_interval=FLUSH_INTERVAL, fsync_interval=FSYNC_INTERVAL):
+        self.sinks = sinks
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.dropped = 0
+        self.closed = False
+
+        self.writer_thread = threading.Thread(target=self.write_records, daemon=True)
+        self.writer_thread.start()
+        _loggers.append(self)
+
+    def log(self, sink, obs_time, *values):
+        # Queue a record for the given sink. Never blocks: if the queue is full the record is counted and dropped
+        try:
+            self.queue.put_nowait((sink, obs_time, values))
+        except queue.Full:
+            self.dropped += 1
+
+    def write_records(self):
+        last_flush = last_fsync = time.monotonic()
+        running = True
+        while running:
+            # Wait for the first record of a batch, then take whatever else is already queued
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=self.flush_interval))
+                while len(batch) < MAX_BATCH:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            for record in batch:
+                if record is None:
+                    running = False
+                    continue
+                sink, obs_time, values = record
+                try:
+                    self.sinks[sink].add(obs_time, values)
+                except Exception as e:
+                    print("Error logging data:", e)
+
+            try:
+                for sink in self.sinks:
+                    sink.write_pending()
+
+                now = time.monotonic()
+                if now - last_fsync >= self.fsync_interval:
+                    for sink in self.sinks:
+                        sink.fsync()
+                    last_fsync = last_flush = now
+                elif now - last_flush >= self.flush_interval:
+                    for sink in self.sinks:
+                        sink.flush()
+                    last_flush = now
+            except Exception as e:
+                print("Error writing data:", e)
+
+        for sink in self.sinks:
+            try:
+                sink.fsync()
+                sink.close()
+            except Exception as e:
+                print("Error closing data file:", e)
+
+    def close(self, timeout=10.0):
+        # Write out all queued records, sync and close the files
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.writer_thread.join(timeout)
+        if self in _loggers:
+            _loggers.remove(self)
+        if self.dropped:
+            print("Records dropped because the log queue was full:", self.dropped)
+        unwritten = sum(sink.dropped for sink in self.sinks)
+        if unwritten:
+            print("Records dropped because they could not be written:", unwritten)
@@ -1,124 +1,226 @@
 import argparse
-import datetime
 import os
 import signal
 import time
-import numpy as np
-import board
-import busio
 from adafruit_extended_bus import ExtendedI2C as I2C
 import adafruit_tsl2591
 import adafruit_mlx90614
 import adafruit_bme280
 from adafruit_bme280 import basic as adafruit_bme280
+from radiometer_logger import BatchedDataLogger, DayFileSink, close_loggers
+from radiometer_binary import BinaryDayFileSink
+from event_capture import EventCapture, EventFileSink, Decimator, PRE_TRIGGER, POST_TRIGGER
+from fireball_detector import StreamingDetector, TRIGGER_SIGMA, TRIGGER_STEP, DETECTION_FORMAT
+from environment_sampler import EnvironmentSampler, ENV_SAMPLE_INTERVAL
+import tsl2591_lux
+import tsl2591_io
+from obs_clock import default_clock
+from acquisition_metrics import (AcquisitionMetrics, start_metrics_exporter, STAGE_I2C, STAGE_LUX, STAGE_LOG,
+                                 EXPORT_INTERVAL)
+from tsl2591_lux import GAIN_FACTORS
 
-DATA_DIR = os.path.expanduser('~/radiometer_data/')
-GUARD_TIME = 2  # Czas oczekiwania po zmianie wzmocnienia sensora
+GAIN_DOWN_COUNTS = 30000  # Zmniejsz wzmocnienie powyżej tej liczby zliczeń kanału 0
+GAIN_UP_COUNTS = 1000  # Zwiększ wzmocnienie poniżej tej liczby zliczeń kanału 0
 DEFAULT_I2C_ADDRESS = adafruit_tsl2591._TSL2591_ADDR  # Domyślny adres I2C dla sensora TSL2591
 
+# Stany automatu wzmocnienia
+GAIN_STATE_SETTLED = 0
+GAIN_STATE_DISCARD = 1
+GAIN_STATE_NAMES = {GAIN_STATE_SETTLED: "SETTLED", GAIN_STATE_DISCARD: "DISCARD"}
+
 def signalHandler(signum, frame):
+    # Zapisz dane oczekujące w kolejce przed zakończeniem
+    close_loggers()
     os._exit(0)
 
-def read_bme280_data(sensor):
-    temperatura = sensor.temperature
-    wilgotnosc = sensor.humidity
-    cisnienie = sensor.pressure
-    punkt_rosy = calculate_dew_point(temperatura, wilgotnosc)
-    return temperatura, wilgotnosc, cisnienie, punkt_rosy
-
-def calculate_dew_point(temperatura, wilgotnosc):
-    b = 17.62
-    c = 243.12
-    gamma = (b * temperatura) / (c + temperatura) + np.log(wilgotnosc / 100.0)
-    punkt_rosy = (c * gamma) / (b - gamma)
-    return punkt_rosy
-
 class RadiometerDataLogger:
-    def __init__(self, name=""):
+    # Odczyty trafiają do pliku R<nazwa><data>.csv, a przejścia automatu wzmocnienia do G<nazwa><data>.csv.
+    # Zapis odbywa się w tle (BatchedDataLogger), więc pętla pomiarowa nie czeka na kartę SD.
+    # Opcjonalnie odczyty zapisywane są też w formacie binarnym R<nazwa><data>.bin (radiometer_binary)
+    # Opcjonalnie zdarzenia (np. bolidy) zapisywane są z pełną częstotliwością do plików E<nazwa><data>_<czas>.csv,
+    # a do głównego pliku trafiają średnie z bloków decimate odczytów.
+    # Zdarzenia wykrywa na bieżąco StreamingDetector, a ich szczyty zapisywane są do pliku F<nazwa><data>.csv
+    DATA_SINK = 0
+    GAIN_SINK = 1
+    EVENT_SINK = 2
+    DETECTION_SINK = 3
+    BINARY_SINK = 4
+
+    def __init__(self, name="", binary=False, events=False, detect=False, rate=10.0, decimate=1,
+                 pre_trigger=PRE_TRIGGER, post_trigger=POST_TRIGGER, trigger_sigma=TRIGGER_SIGMA, trigger_step=TRIGGER_STEP):
         self.name = name
         if name:
             self.name = "_" + name + "_"
-        os.makedirs(DATA_DIR, exist_ok=True)
-        self.filename = "R" + self.name + datetime.datetime.now().strftime("%Y%m%d") + ".csv"
+        self.binary = binary
+        line_format = '{0:s} {1:.9f} {2:1f} {3:1f} {4:.1f} {5:.1f} {6:.2f} {7:.2f} {8:.2f} {9:.2f} {10:.2f}\n'
+        sinks = [
+            DayFileSink("R", self.name, line_format),
+            DayFileSink("G", self.name, '{0:s} {1:s} {2:.1f} {3:.1f} {4:d} {5:d}\n'),
+            EventFileSink("E", self.name, line_format),
+            DayFileSink("F", self.name, DETECTION_FORMAT),
+        ]
+        if binary:
+            sinks.append(BinaryDayFileSink("R", self.name))
+        self.logger = BatchedDataLogger(sinks)
+
+        self.events = None
+        if events:
+            self.events = EventCapture(self.logger, self.EVENT_SINK, rate, pre_trigger=pre_trigger,
+                                       post_trigger=post_trigger)
+        self.detector = None
+        if events or detect:
+            self.detector = StreamingDetector(rate, trigger_sigma=trigger_sigma, trigger_step=trigger_step)
+            self.detector.on_trigger = self.trigger
+            self.detector.on_peak = self.log_detection
+        self.decimator = Decimator(decimate) if decimate > 1 else None
 
     def log_data(self, obs_time, lux_value, vis_level, ir_level, again, atime, temp, humidity, pressure, dew_point, mlx_temp):
-        try:
-            filename = "R" + self.name + obs_time.strftime("%Y%m%d") + ".csv"
-            if filename != self.filename:
-                self.filename = filename
+        values = (lux_value, vis_level, ir_level, again, atime, temp, humidity, pressure, dew_point, mlx_temp)
+        if self.events is not None:
+            self.events.add(obs_time, values)
+        if self.detector is not None:
+            self.detector.add(obs_time, lux_value)
+        if self.decimator is not None:
+            block = self.decimator.add(obs_time, values)
+            if block is None:
+                return
+            obs_time, values = block
 
-            with open(DATA_DIR + self.filename, "a") as file:
-                out_string = '{0:s} {1:.9f} {2:1f} {3:1f} {4:.1f} {5:.1f} {6:.2f} {7:.2f} {8:.2f} {9:.2f} {10:.2f}\n'.format(
-                    obs_time.strftime("%Y/%m/%d %H:%M:%S.%f")[:-3], lux_value, vis_level, ir_level, again, atime, temp, humidity, pressure, dew_point, mlx_temp)
-                file.write(out_string)
+        self.logger.log(self.DATA_SINK, obs_time, *values)
+        if self.binary:
+            self.logger.log(self.BINARY_SINK, obs_time, *values)
 
-        except Exception as e:
-            print("Błąd podczas zapisu danych: ", e)
+    def trigger(self, obs_time):
+        # Zapisz zdarzenie wokół podanego czasu
+        if self.events is not None:
+            self.events.trigger(obs_time)
+
+    def log_detection(self, peak_time, start_time, peak_lux, background, noise):
+        # Zapis szczytu wykrytego zdarzenia; zapis zdarzenia trwa jeszcze post_trigger sekund po szczycie
+        self.logger.log(self.DETECTION_SINK, peak_time, start_time.strftime("%Y/%m/%d %H:%M:%S.%f")[:-3],
+                        peak_lux, background, noise)
+        self.trigger(peak_time)
+
+    def log_gain_transition(self, obs_time, state, old_again, new_again, vis_level, ir_level):
+        # Zapis przejść automatu wzmocnienia, aby móc zamaskować odczyty
+        # z okresu zmiany wzmocnienia (od stanu DISCARD do następnego SETTLED)
+        self.logger.log(self.GAIN_SINK, obs_time, state, old_again, new_again, vis_level, ir_level)
+
+    def close(self):
+        self.logger.close()
 
 class adafruit_tsl2591_extended(adafruit_tsl2591.TSL2591):
-    def adjust_gain(self):
-        channel_0, _ = self.raw_luminosity
-        current_gain = self.gain
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.auto_gain = True
+        self.gain_state = GAIN_STATE_SETTLED
+        self.gain_change_time = 0.0  # Czas (monotoniczny) ostatniej zmiany wzmocnienia
+        self.on_gain_transition = None  # Funkcja zapisująca przejścia automatu wzmocnienia
+        self._block_buffer = bytearray(tsl2591_io.BLOCK_LENGTH)
+        self.status = 0  # Rejestr statusu z ostatniego odczytu
+        self.saturated = False  # Czy ostatni odczyt był wysycony
+        self.metrics = None  # Opcjonalne AcquisitionMetrics - czasy odczytu i2c i obliczeń lux
 
-        if channel_0 > 30000:  # Zbliżanie się do wysycenia
+    def select_gain(self, channel_0, current_gain):
+        # Wybierz nowe wzmocnienie na podstawie odczytu kanału 0, bez zmiany ustawień sensora
+        if channel_0 > GAIN_DOWN_COUNTS:  # Zbliżanie się do wysycenia
             if current_gain == adafruit_tsl2591.GAIN_MAX:
-#                new_gain = adafruit_tsl2591.GAIN_HIGH
-#            elif current_gain == adafruit_tsl2591.GAIN_HIGH:
-                new_gain = adafruit_tsl2591.GAIN_MED
+                return adafruit_tsl2591.GAIN_HIGH
+            elif current_gain == adafruit_tsl2591.GAIN_HIGH:
+                return adafruit_tsl2591.GAIN_MED
             elif current_gain == adafruit_tsl2591.GAIN_MED:
-                new_gain = adafruit_tsl2591.GAIN_LOW
-            else:
-                new_gain = current_gain  # Pozostaw bez zmian
-        elif channel_0 < 1000:  # Zaciemnianie
+                return adafruit_tsl2591.GAIN_LOW
+        elif channel_0 < GAIN_UP_COUNTS:  # Zaciemnianie
             if current_gain == adafruit_tsl2591.GAIN_LOW:
-                new_gain = adafruit_tsl2591.GAIN_MED
+                return adafruit_tsl2591.GAIN_MED
             elif current_gain == adafruit_tsl2591.GAIN_MED:
-#               new_gain = adafruit_tsl2591.GAIN_HIGH
-#            elif current_gain == adafruit_tsl2591.GAIN_HIGH:
-                new_gain = adafruit_tsl2591.GAIN_MAX
+                return adafruit_tsl2591.GAIN_HIGH
+            elif current_gain == adafruit_tsl2591.GAIN_HIGH:
+                return adafruit_tsl2591.GAIN_MAX
+        return current_gain  # Pozostaw bez zmian
+
+    def record_gain_transition(self, new_state, old_again, new_again, channel_0, channel_1):
+        self.gain_state = new_state
+        if self.metrics is not None:
+            if new_state == GAIN_STATE_DISCARD:
+                self.metrics.gain_switch_started()
             else:
-                new_gain = current_gain  # Pozostaw bez zmian
-        else:
-            new_gain = current_gain  # Pozostaw bez zmian
+                self.metrics.gain_switch_finished()
+        if self.on_gain_transition is not None:
+            self.on_gain_transition(default_clock().now(), GAIN_STATE_NAMES[new_state],
+                                    old_again, new_again, channel_0, channel_1)
+
+    def discard(self):
+        if self.metrics is not None:
+            self.metrics.discarded_readings += 1
+        return None
+
+    def update_gain(self, reading):
+        # Automat wzmocnienia, bez oczekiwania (time.sleep).
+        # SETTLED: odczyty są poprawne, wzmocnienie zmieniane jest po odczycie bliskim wysycenia lub zbyt ciemnym.
+        # DISCARD: integracja trwająca w chwili zmiany miesza oba wzmocnienia, więc odrzucamy odczyty
+        # aż do końca następnej pełnej integracji (najpóźniej 2 czasy integracji po zmianie).
+        # Zwraca odczyt lub None, jeśli odczyt należy odrzucić.
+        lux, channel_0, channel_1, again, atime = reading
+        now = time.monotonic()
 
-        if new_gain != current_gain:
+        if self.gain_state == GAIN_STATE_DISCARD:
+            if now - self.gain_change_time < 2 * atime / 1000.0:
+                return self.discard()
+            self.record_gain_transition(GAIN_STATE_SETTLED, again, again, channel_0, channel_1)
+
+        new_gain = self.select_gain(channel_0, self._gain)
+        if new_gain != self._gain:
             self.gain = new_gain
-            time.sleep(GUARD_TIME)  # Odczekaj po zmianie wzmocnienia
+            self.gain_change_time = now
+            self.record_gain_transition(GAIN_STATE_DISCARD, again, GAIN_FACTORS[new_gain], channel_0, channel_1)
+
+        # Wysycony odczyt ma obcięte zliczenia i błędny lux, więc jest odrzucany (tylko zmienia wzmocnienie)
+        if self.saturated:
+            return self.discard()
+
+        # Odczyt wykonany przed zmianą jest poprawny dla poprzedniego wzmocnienia
+        return reading
 
     def get_light_levels(self, disable_exception=False):
-        self.adjust_gain()
-        time.sleep(GUARD_TIME)
-        channel_0, channel_1 = self.raw_luminosity
+        # Przy automatycznym wzmocnieniu wysycenie obsługuje automat, więc nie zgłaszamy wyjątku
+        reading = self.read_light_levels(disable_exception or self.auto_gain)
+        # Przed pierwszą zakończoną integracją (AVALID) kanały nie zawierają odczytu, również w stanie DISCARD
+        if not self.status & tsl2591_io.STATUS_AVALID:
+            return self.discard()
+        if not self.auto_gain:
+            return reading
+        return self.update_gain(reading)
+
+    def read_light_levels(self, disable_exception=False):
+        # Odczyt bez zmiany wzmocnienia i bez oczekiwania - do użycia w pętli zdarzeń.
+        # Rejestr statusu i oba kanały odczytywane są w jednej transakcji i2c
+        start_ns = time.perf_counter_ns()
+        self.status, channel_0, channel_1 = tsl2591_io.read_status_and_channels(self._device, self._block_buffer)
+        read_ns = time.perf_counter_ns()
         atime = 100.0 * self._integration_time + 100.0
         if self._integration_time == adafruit_tsl2591.INTEGRATIONTIME_100MS:
             max_counts = adafruit_tsl2591._TSL2591_MAX_COUNT_100MS
         else:
             max_counts = adafruit_tsl2591._TSL2591_MAX_COUNT
 
-        if channel_0 >= max_counts or channel_1 >= max_counts:
+        self.saturated = channel_0 >= max_counts or channel_1 >= max_counts
+        if self.saturated:
             message = "Overflow reading light channels!"
             if not disable_exception:
                 raise RuntimeError(message)
 
-        again = 1.0  # Domyślne wzmocnienie dla GAIN_LOW
-        if self._gain == adafruit_tsl2591.GAIN_LOW:
-            again = 1.0
-        elif self._gain == adafruit_tsl2591.GAIN_MED:
-            again = 25.0
-#        elif self._gain == adafruit_tsl2591.GAIN_HIGH:
-#            again = 428.0  # lub inna odpowiednia wartość dla GAIN_HIGH
-        elif self._gain == adafruit_tsl2591.GAIN_MAX:
-            again = 9876.0  # lub inna odpowiednia wartość dla GAIN_MAX
-
-        cpl = (atime * again) / adafruit_tsl2591._TSL2591_LUX_DF
-        lux1 = (channel_0 - (adafruit_tsl2591._TSL2591_LUX_COEFB * channel_1)) / cpl
-        lux2 = ((adafruit_tsl2591._TSL2591_LUX_COEFC * channel_0) - (adafruit_tsl2591._TSL2591_LUX_COEFD * channel_1)) / cpl
-        lux = max(lux1, lux2)
+        again = GAIN_FACTORS[self._gain]
+        lux = tsl2591_lux.reading_lux(channel_0, channel_1, again, atime)
 
         # Przeliczanie wartości widzialnego światła (vis) i podczerwieni (ir) uwzględniając wzmocnienie
         vis_level = channel_0
         ir_level = channel_1
 
+        if self.metrics is not None:
+            self.metrics.add(STAGE_I2C, read_ns - start_ns)
+            self.metrics.lap(STAGE_LUX, read_ns)
+
         return lux, vis_level, ir_level, again, atime
 
 
@@ -131,6 +233,11 @@ if __name__ == "__main__":
     ap.add_argument("-m", "--multiplexer", type=int, default=None, help="Connect to the i2c sensor via an adafruit TCA9548A multiplexer using the number of the multiplexer channel e.g. 0-7")
     ap.add_argument("-n", "--name", type=str, default="", help="Optional name of the sensor for the output file name. Default is no name")
     ap.add_argument("-s", "--sqm", action='store_true', help="Take hourly SQM measurements")
+    ap.add_argument("--binary", action='store_true', help="Also write the readings to a binary .bin data file")
+    ap.add_argument("-e", "--env-interval", type=float, default=ENV_SAMPLE_INTERVAL, help="Seconds between temperature, humidity and pressure readings. Default is " + str(ENV_SAMPLE_INTERVAL))
+    ap.add_argument("--metrics", action='store_true', help="Write the timings of each stage of a reading to a status file e.g. /dev/shm/radiometer_tsl2591_metrics.json")
+    ap.add_argument("--metrics-interval", type=float, default=EXPORT_INTERVAL, help="Seconds between status file updates. Default is " + str(EXPORT_INTERVAL))
+    ap.add_argument("--metrics-port", type=int, default=None, help="Also serve the timings as text metrics over http on this port e.g. 9100")
     ap.add_argument("-v", "--verbose", action='store_true', help="Verbose output to terminal")
     args = vars(ap.parse_args())
 
@@ -142,6 +249,11 @@ if __name__ == "__main__":
     mlx = adafruit_mlx90614.MLX90614(i2c)
     bme280 = adafruit_bme280.Adafruit_BME280_I2C(i2c)
 
+    # Czujniki środowiskowe odczytywane są w tle, pętla pomiarowa korzysta z ostatnich wartości
+    env_sampler = EnvironmentSampler(bme280=bme280, mlx=mlx, interval=args['env_interval'])
+    env_sampler.metrics = AcquisitionMetrics("environment")
+    env_sampler.start()
+
     if args['multiplexer'] is not None:
         import adafruit_tca9548a
         tca = adafruit_tca9548a.TCA9548A(i2c)
@@ -149,15 +261,38 @@ if __name__ == "__main__":
     else:
         sensor = adafruit_tsl2591_extended(i2c, address=args['address'])
 
-    radiometer_data_logger = RadiometerDataLogger(name=args['name'])
+    # Ustaw wzmocnienie z linii poleceń. Automatyczne wzmocnienie startuje od maksymalnego
+    gain_settings = {"max": adafruit_tsl2591.GAIN_MAX, "high": adafruit_tsl2591.GAIN_HIGH,
+                     "med": adafruit_tsl2591.GAIN_MED, "low": adafruit_tsl2591.GAIN_LOW, "auto": adafruit_tsl2591.GAIN_MAX}
+    sensor.gain = gain_settings[args['gain']]
+    sensor.auto_gain = args['gain'] == "auto"
+
+    radiometer_data_logger = RadiometerDataLogger(name=args['name'], binary=args['binary'])
+    sensor.on_gain_transition = radiometer_data_logger.log_gain_transition
+
+    # Pomiar czasów poszczególnych etapów odczytu, opcjonalnie eksportowanych do pliku statusu i przez http
+    metrics = AcquisitionMetrics(args['name'])
+    sensor.metrics = metrics
+    if args['metrics'] or args['metrics_port'] is not None:
+        start_metrics_exporter("radiometer_tsl2591" + radiometer_data_logger.name.rstrip("_"),
+                               interval=args['metrics_interval'], port=args['metrics_port'])
+
+    # Czas odczytu z zegara monotonicznego, odpornego na korekty zegara systemowego przez NTP
+    clock = default_clock()
 
     while True:
         try:
-            time_stamp = datetime.datetime.now()
-            lux, vis_level, ir_level, again, atime = sensor.get_light_levels()
-            temp, wilgotnosc, cisnienie, punkt_rosy = read_bme280_data(bme280)
-            mlx_temp = mlx.object_temperature
+            time_stamp = clock.now()
+            reading = sensor.get_light_levels()
+            if reading is None:
+                # Odczyt z okresu zmiany wzmocnienia - odrzucony
+                time.sleep(0.1)
+                continue
+            lux, vis_level, ir_level, again, atime = reading
+            _, (temp, wilgotnosc, cisnienie, punkt_rosy, mlx_temp) = env_sampler.latest
+            t = metrics.now()
             radiometer_data_logger.log_data(time_stamp, lux, vis_level, ir_level, again, atime, temp, wilgotnosc, cisnienie, punkt_rosy, mlx_temp)
+            metrics.lap(STAGE_LOG, t)
             if args['verbose']:
                 print(f"Log: {time_stamp}, Lux: {lux}, Temp: {temp}, Gain: {again}")
 
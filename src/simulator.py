@@ -0,0 +1,302 @@
+import argparse
+import datetime
+import math
+import os
+import runpy
+import signal
+import sys
+import threading
+import time
+import types
+import numpy as np
+import tsl2591_io
+from tsl2591_fake import FakeI2CBus, FakeInterruptLine, DARK_SKY_RATE, TSL2591_ADDRESS
+from radiometer_binary import open_binary_day_file, GAIN_FACTORS
+
+# Runs the acquisition scripts (sqm_tsl2591.py, radiometer_tsl2591.py) without a Raspberry Pi, against
+# a software TSL2591, BME280 and MLX90614, with the light levels replayed from a recorded data file or
+# from a synthetic night. The clock runs speed times faster than real time, so a night can be used to
+# soak test the gain switching, logging, day file rotation and SQM publication in a few minutes.
+#
+# Example: python simulator.py --replay ../samples/20230113_021400.csv --speed 10 sqm_tsl2591.py --events
+#
+# radiometer_daemon.py can also be run against the simulated devices, but only at --speed 1, as
+# asyncio waits in real time.
+
+# The real clock functions, before the simulated clock replaces them
+real_monotonic = time.monotonic
+real_sleep = time.sleep
+real_datetime = datetime.datetime
+
+# Environmental readings used when a replayed file has none: temperature, humidity,
+# pressure and sky (MLX90614 object) temperature
+DEFAULT_ENV = (5.0, 80.0, 1010.0, -20.0)
+
+# Synthetic night: seconds between fireballs, their peak brightness as a multiple of the dark sky,
+# and their duration in seconds
+FIREBALL_INTERVAL = 300.0
+FIREBALL_PEAK = 50.0
+FIREBALL_DURATION = 1.0
+
+# Synthetic dawn: seconds for the sky to brighten by a factor of 10, from the dark sky to daylight
+DAWN_DECADE = 600.0
+DAYLIGHT_FACTOR = 1e6
+
+
+class SimulatedClock():
+    # Replaces time.monotonic, time.time (and their ns versions), time.sleep and datetime.datetime.now with a clock which starts
+    # at start and runs speed times faster than real time. time.perf_counter is left as real time, for
+    # measuring the cost of each reading
+
+    def __init__(self, start, speed=1.0):
+        self.start = start
+        self.start_timestamp = start.timestamp()
+        self.speed = speed
+        self.real_start = real_monotonic()
+
+    def elapsed(self):
+        return (real_monotonic() - self.real_start) * self.speed
+
+    def monotonic(self):
+        return self.real_start + self.elapsed()
+
+    def time(self):
+        return self.start_timestamp + self.elapsed()
+
+    def monotonic_ns(self):
+        return int(self.monotonic() * 1e9)
+
+    def time_ns(self):
+        return int(self.time() * 1e9)
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=self.elapsed())
+
+    def sleep(self, seconds):
+        real_sleep(max(0.0, seconds) / self.speed)
+
+    def install(self):
+        clock = self
+
+        class SimulatedDatetime(real_datetime):
+            @classmethod
+            def now(cls, tz=None):
+                now = clock.now()
+                if tz is not None:
+                    return now.astimezone(tz)
+                return cls.combine(now.date(), now.time())
+
+        time.monotonic = self.monotonic
+        time.monotonic_ns = self.monotonic_ns
+        time.time = self.time
+        time.time_ns = self.time_ns
+        time.sleep = self.sleep
+        datetime.datetime = SimulatedDatetime
+
+
+def load_replay_file(file_name):
+    # Read a csv (R*.csv, or a sample file) or binary (.bin) data file into the start time, seconds since
+    # the start, counts per ms at gain 1 for each channel, whether each reading was saturated and the
+    # environmental readings (temperature, humidity, pressure, sky temperature) if the file has them
+    if file_name.endswith(".bin"):
+        records = open_binary_day_file(file_name)
+        times = records['time'].astype('datetime64[ns]')
+        start = real_datetime.fromtimestamp(records['time'][0] / 1e9)
+        ch0 = records['ch0'].astype(np.float64)
+        ch1 = records['ch1'].astype(np.float64)
+        again = GAIN_FACTORS[records['gain']].astype(np.float64)
+        atime = (records['atime'].astype(np.float64) + 1) * 100
+        env = np.column_stack([records[name] for name in ('temp', 'humidity', 'pressure', 'cloud_temp')])
+    else:
+        with open(file_name) as file:
+            rows = [line.split() for line in file if line.strip()]
+        times = np.array([row[0].replace("/", "-") + "T" + row[1] for row in rows], dtype='datetime64[ms]')
+        start = real_datetime.strptime(rows[0][0] + " " + rows[0][1], "%Y/%m/%d %H:%M:%S.%f")
+        values = np.array([row[2:7] for row in rows], dtype=np.float64)
+        ch0, ch1, again, atime = values[:, 1], values[:, 2], values[:, 3], values[:, 4]
+        env = None
+        if min(len(row) for row in rows) >= 12:
+            env = np.array([[row[7], row[8], row[9], row[11]] for row in rows], dtype=np.float64)
+
+    elapsed = (times - times[0]) / np.timedelta64(1, 's')
+    max_counts = np.where(atime == 100.0, 36863, 65535)
+    saturated = (ch0 >= max_counts) | (ch1 >= max_counts)
+    rates = np.column_stack((ch0, ch1)) / (again * atime)[:, np.newaxis]
+    return start, elapsed, rates, saturated, env
+
+
+class ReplayLight():
+    # Light source for the simulated TSL2591 from a recorded data file. The sensor sees the light level of the
+    # latest recorded reading, converted to counts per ms at gain 1, so a different gain or integration
+    # time to the recording gives the counts it would have measured. Saturated readings in the recording
+    # only give a lower limit of the light level
+
+    def __init__(self, file_name):
+        self.start, self.elapsed, self.rates, self.saturated, self.env = load_replay_file(file_name)
+        self.duration = self.elapsed[-1]
+
+    def index(self, elapsed):
+        return max(0, int(np.searchsorted(self.elapsed, elapsed, side='right')) - 1)
+
+    def __call__(self, elapsed):
+        return self.rates[self.index(elapsed)]
+
+    def environment(self, elapsed):
+        if self.env is None:
+            return DEFAULT_ENV
+        return tuple(self.env[self.index(elapsed)])
+
+
+class SyntheticLight():
+    # Light source for the simulated TSL2591: a dark sky with a fireball every fireball_interval seconds,
+    # and optionally a dawn starting after dawn seconds which brightens to daylight, to exercise the gain switching
+
+    def __init__(self, fireball_interval=FIREBALL_INTERVAL, fireball_peak=FIREBALL_PEAK,
+                 fireball_duration=FIREBALL_DURATION, dawn=None):
+        self.fireball_interval = fireball_interval
+        self.fireball_peak = fireball_peak
+        self.fireball_duration = fireball_duration
+        self.dawn = dawn
+
+    def __call__(self, elapsed):
+        # Fireballs are a gaussian flash half way through each interval
+        offset = math.fmod(elapsed, self.fireball_interval) - self.fireball_interval / 2
+        scale = 1.0 + self.fireball_peak * math.exp(-0.5 * (offset / (self.fireball_duration / 4)) ** 2)
+        if self.dawn is not None and elapsed > self.dawn:
+            scale *= min(DAYLIGHT_FACTOR, 10 ** ((elapsed - self.dawn) / DAWN_DECADE))
+        return DARK_SKY_RATE[0] * scale, DARK_SKY_RATE[1] * scale
+
+    def environment(self, elapsed):
+        return DEFAULT_ENV
+
+
+class FakeBME280():
+    # Stands in for adafruit_bme280.basic.Adafruit_BME280_I2C
+
+    def __init__(self, clock, light):
+        self.clock = clock
+        self.light = light
+
+    @property
+    def temperature(self):
+        return self.light.environment(self.clock.elapsed())[0]
+
+    @property
+    def humidity(self):
+        return self.light.environment(self.clock.elapsed())[1]
+
+    @property
+    def pressure(self):
+        return self.light.environment(self.clock.elapsed())[2]
+
+
+class FakeMLX90614():
+    # Stands in for adafruit_mlx90614.MLX90614
+
+    def __init__(self, clock, light):
+        self.clock = clock
+        self.light = light
+
+    @property
+    def object_temperature(self):
+        return self.light.environment(self.clock.elapsed())[3]
+
+    @property
+    def ambient_temperature(self):
+        return self.light.environment(self.clock.elapsed())[0]
+
+
+def install_devices(clock, light, noise):
+    # Make the hardware modules used by the acquisition scripts return the simulated devices.
+    # Each i2c bus has its own simulated TSL2591 at each address and multiplexer channel, all seeing the same light.
+    # Returns the buses by number
+    buses = {}
+
+    def extended_i2c(bus_number, *args, **kwargs):
+        if bus_number not in buses:
+            buses[bus_number] = FakeI2CBus(light=light, noise=noise)
+        return buses[bus_number]
+
+    extended_bus = types.ModuleType("adafruit_extended_bus")
+    extended_bus.ExtendedI2C = extended_i2c
+    bme280_basic = types.ModuleType("adafruit_bme280.basic")
+    bme280_basic.Adafruit_BME280_I2C = lambda i2c, *args, **kwargs: FakeBME280(clock, light)
+    bme280 = types.ModuleType("adafruit_bme280")
+    bme280.basic = bme280_basic
+    mlx90614 = types.ModuleType("adafruit_mlx90614")
+    mlx90614.MLX90614 = lambda i2c, *args, **kwargs: FakeMLX90614(clock, light)
+    sys.modules.update({
+        "adafruit_extended_bus": extended_bus,
+        "adafruit_bme280": bme280,
+        "adafruit_bme280.basic": bme280_basic,
+        "adafruit_mlx90614": mlx90614,
+    })
+
+    # Wait for the interrupts of the first simulated sensor in place of a GPIO line
+    def interrupt_line(chip, line, *args, **kwargs):
+        devices = [device for bus in buses.values() for device in bus.devices.values()]
+        return FakeInterruptLine(devices[0] if devices else extended_i2c(1).device(TSL2591_ADDRESS))
+
+    tsl2591_io.GpioInterruptLine = interrupt_line
+    return buses
+
+
+def stop_after(clock, duration, buses):
+    # Stop the script with SIGINT, so that it writes out its data files as it would on a real shutdown
+    real_start = real_monotonic()
+    while clock.elapsed() < duration:
+        real_sleep(0.05)
+    real_elapsed = real_monotonic() - real_start
+    print("Simulated {0:.1f} s in {1:.1f} s ({2:.1f}x real time), {3:d} i2c transactions".format(
+        clock.elapsed(), real_elapsed, clock.elapsed() / real_elapsed, sum(bus.transactions for bus in buses.values())))
+    os.kill(os.getpid(), signal.SIGINT)
+
+
+# Main program
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(
+        description='Run an acquisition script against simulated sensors, replaying a recorded night or a synthetic one',
+        epilog='Example usage: python simulator.py --replay ../samples/20230113_021400.csv --speed 10 sqm_tsl2591.py --events')
+    ap.add_argument("script", type=str,
+                    help="Acquisition script to run e.g. sqm_tsl2591.py")
+    ap.add_argument("script_args", nargs=argparse.REMAINDER,
+                    help="Options for the acquisition script")
+    ap.add_argument("-r", "--replay", type=str, default=None,
+                    help="Csv or binary (.bin) data file to replay. Default is a synthetic night")
+    ap.add_argument("-x", "--speed", type=float, default=1.0,
+                    help="Run this many times faster than real time. Default is 1")
+    ap.add_argument("--start", type=str, default=None,
+                    help="Simulated start date and time as YYYY/mm/dd HH:MM:SS. Default is the start of the replayed file, or now")
+    ap.add_argument("-t", "--duration", type=float, default=None,
+                    help="Seconds of simulated time to run for. Default is the length of the replayed file, or until stopped")
+    ap.add_argument("--dawn", type=float, default=None,
+                    help="For a synthetic night, start the dawn after this many seconds, to test the gain switching")
+    args = vars(ap.parse_args())
+
+    if args['replay'] is not None:
+        light = ReplayLight(args['replay'])
+        start = light.start
+        duration = light.duration
+    else:
+        light = SyntheticLight(dawn=args['dawn'])
+        start = real_datetime.now()
+        duration = None
+    if args['start'] is not None:
+        start = real_datetime.strptime(args['start'], "%Y/%m/%d %H:%M:%S")
+    if args['duration'] is not None:
+        duration = args['duration']
+
+    clock = SimulatedClock(start, args['speed'])
+    clock.install()
+    # Replayed readings already have the recorded noise
+    buses = install_devices(clock, light, noise=args['replay'] is None)
+    if duration is not None:
+        threading.Thread(target=stop_after, args=(clock, duration, buses), daemon=True).start()
+
+    # Run the script as if it had been started from the command line
+    script = args['script']
+    sys.argv = [script] + args['script_args']
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    runpy.run_path(script, run_name="__main__")
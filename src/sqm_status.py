@@ -0,0 +1,101 @@
+import argparse
+import datetime
+import mmap
+import os
+import struct
+import time
+
+# Latest SQM reading published for other processes on the node, as a small fixed size record in shared
+# memory. Readers map the file once and then poll it without any system calls.
+STATUS_FILE = '/dev/shm/sqm_tsl2591.status' if os.path.isdir('/dev/shm') else '/tmp/sqm_tsl2591.status'
+
+# Record: magic, version, record size, sequence number, readings in the rolling average,
+# then reading time (seconds since the unix epoch), latest SQM and rolling average SQM in mag/arcsec^2.
+# The writer makes the sequence number odd while it updates the record, and even again when it has
+# finished, so a reader that sees an odd or changed sequence number knows to read the record again.
+MAGIC = b'SQMS'
+VERSION = 1
+STATUS = struct.Struct('<4sHHIIddd')
+SEQUENCE = struct.Struct('<I')
+SEQUENCE_OFFSET = 8
+
+
+class SqmStatusWriter():
+
+    def __init__(self, file_name=STATUS_FILE):
+        self.file_name = file_name
+        # Reuse an existing status file, so that readers which already have it mapped see new readings.
+        # Otherwise create the record at its full size before moving it into place, so that readers
+        # never map a short file
+        if not os.path.exists(file_name) or os.path.getsize(file_name) != STATUS.size:
+            tmp_name = file_name + ".tmp"
+            with open(tmp_name, "wb") as file:
+                file.write(STATUS.pack(MAGIC, VERSION, STATUS.size, 0, 0, 0.0, float('nan'), float('nan')))
+            os.replace(tmp_name, file_name)
+        self.file = open(file_name, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), STATUS.size)
+        self.sequence = SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)[0] & ~1
+
+    def update(self, obs_time, sky_brightness, average, count):
+        # The record is written with an odd sequence number, which is made even once it is complete
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+        STATUS.pack_into(self.map, 0, MAGIC, VERSION, STATUS.size, self.sequence, count,
+                         obs_time.timestamp(), sky_brightness, average)
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class SqmStatusReader():
+
+    def __init__(self, file_name=STATUS_FILE):
+        with open(file_name, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), STATUS.size, access=mmap.ACCESS_READ)
+        magic, version, size = STATUS.unpack_from(self.map)[:3]
+        if magic != MAGIC or version != VERSION or size != STATUS.size:
+            raise ValueError("Not an SQM status file: " + file_name)
+
+    def read(self):
+        # Returns the reading time, latest SQM, rolling average SQM and the number of readings averaged,
+        # or None if no reading has been published yet
+        while True:
+            record = STATUS.unpack_from(self.map)
+            sequence = record[3]
+            if sequence % 2 == 0 and SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)[0] == sequence:
+                break
+            time.sleep(0)
+        if sequence == 0:
+            return None
+        count, timestamp, sky_brightness, average = record[4:]
+        return datetime.datetime.fromtimestamp(timestamp), sky_brightness, average, count
+
+    def close(self):
+        self.map.close()
+
+
+# Main program
+if __name__ == "__main__":
+
+    # Construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description='Print the latest SQM reading published by sqm_tsl2591.py')
+    ap.add_argument("-f", "--file", type=str, default=STATUS_FILE,
+                    help="SQM status file. Default is " + STATUS_FILE)
+    ap.add_argument("-w", "--watch", type=float, default=None,
+                    help="Keep printing the reading every this many seconds")
+    args = vars(ap.parse_args())
+
+    reader = SqmStatusReader(args['file'])
+    while True:
+        status = reader.read()
+        if status is None:
+            print("No SQM reading yet")
+        else:
+            print("{0:s} SQM {1:.2f} average {2:.2f} over {3:d} readings".format(
+                status[0].strftime("%Y/%m/%d %H:%M:%S.%f")[:-3], *status[1:]))
+        if args['watch'] is None:
+            break
+        time.sleep(args['watch'])
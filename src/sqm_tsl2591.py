@@ -1,29 +1,41 @@
 import argparse
-import datetime
+import math
 import os
 import signal
-import threading
 import time
-import numpy as np
 from collections import deque
 import syslog
-import board
-from adafruit_extended_bus import ExtendedI2C as I2C
 import adafruit_tsl2591
+from radiometer_logger import BatchedDataLogger, DayFileSink, close_loggers, DATA_DIR
+from radiometer_binary import BinaryDayFileSink
+from event_capture import EventCapture, EventFileSink, Decimator, PRE_TRIGGER, POST_TRIGGER
+from fireball_detector import StreamingDetector, TRIGGER_SIGMA, TRIGGER_STEP, DETECTION_FORMAT
+import tsl2591_lux
+import tsl2591_io
+from obs_clock import default_clock
+from sqm_status import SqmStatusWriter
+from acquisition_metrics import (AcquisitionMetrics, start_metrics_exporter, STAGE_WAIT, STAGE_I2C, STAGE_LUX,
+                                 STAGE_LOG, STAGE_SQM, EXPORT_INTERVAL)
 
-DATA_DIR = os.path.expanduser('~/radiometer_data/')
 SQM_FILE = '/tmp/sqm_tsl2591.txt'
+SQM_TMP_FILE = SQM_FILE + '.tmp'
 
 
 # Minimum time to wait after a sensor time or gain setting
 GUARD_TIME = 0.12
 
+# When polling the status register, start this long before the expected end of the integration,
+# then poll at this interval
+POLL_MARGIN = 0.02
+POLL_INTERVAL = 0.01
+
 # The tsl2591 default i2c address is 0x29
 DEFAULT_I2C_ADDRESS = adafruit_tsl2591._TSL2591_ADDR
 
 
 def signalHandler(signum, frame):
-    # Handle process signals
+    # Handle process signals. Write out any queued readings before exiting
+    close_loggers()
     os._exit(0)
 
 
@@ -41,75 +53,134 @@ def reset_sensor(sensor, gain, integration_time):
 
 
 class Sqm_Writer():
-    def __init__(self):
-        self.rolling = deque(maxlen=10)
-
-
-    def update(self, sky_brightness):
-        # Take a rolling average over last 10 measurements (6s) and write it to /tmp/sqm_tsl2591.txt
-
+    # Publishes the latest SQM value and its rolling average over the last 10 measurements (6s), to
+    # /tmp/sqm_tsl2591.txt and to the shared memory status record read by sqm_status.py
+
+    def __init__(self, window=10):
+        self.rolling = deque(maxlen=window)
+        self.total = 0.0
+        self.status = SqmStatusWriter()
+
+    def update(self, sky_brightness, obs_time=None):
+        # Keep a running sum of the window instead of averaging it on every reading
+        sky_brightness = float(sky_brightness)
+        if len(self.rolling) == self.rolling.maxlen:
+            self.total -= self.rolling[0]
         self.rolling.append(sky_brightness)
-        rolling_average = np.average(self.rolling)
-
-        with open(SQM_FILE, 'w') as sqm_file:
+        self.total += sky_brightness
+        # A reading of 0 lux gives an infinite SQM, after which the running sum has to be restarted
+        if not math.isfinite(self.total):
+            self.total = math.fsum(self.rolling)
+        rolling_average = self.total / len(self.rolling)
+
+        if obs_time is None:
+            obs_time = default_clock().now()
+        self.status.update(obs_time, sky_brightness, rolling_average, len(self.rolling))
+
+        # Write a new file and move it into place, so that readers never see an empty or partly written file
+        with open(SQM_TMP_FILE, 'w') as sqm_file:
             sqm_file.write(str(rolling_average) + "\n")
+        os.replace(SQM_TMP_FILE, SQM_FILE)
 
-        return
+        return rolling_average
 
 # Class for logging detections to radiometer data file
 class RadiometerDataLogger():
 
-    def __init__(self, name=""):
+    DATA_SINK = 0
+    EVENT_SINK = 1
+    DETECTION_SINK = 2
+    BINARY_SINK = 3
+
+    def __init__(self, name="", binary=False, events=False, detect=False, rate=1 / 0.6, decimate=1,
+                 pre_trigger=PRE_TRIGGER, post_trigger=POST_TRIGGER, trigger_sigma=TRIGGER_SIGMA, trigger_step=TRIGGER_STEP):
         self.name = name
         if name:
             self.name = "_" + name + "_"
-        # Make the data logging directory
-        os.makedirs(DATA_DIR, exist_ok=True)
 
-        # Set the filename and open it for appending
-        self.filename = "R" + self.name + \
-            datetime.datetime.now().strftime("%Y%m%d") + ".csv"
+        # Records are written to the dated file by a background thread, which also flushes
+        # the file to disk and moves to a new file at midnight
+        self.binary = binary
+        line_format = '{0:s} {1:.9f} {2:d} {3:d} {4:.1f} {5:.1f}\n'
+        sinks = [DayFileSink("R", self.name, line_format),
+                 EventFileSink("E", self.name, line_format),
+                 DayFileSink("F", self.name, DETECTION_FORMAT)]
+        # Optionally also write the readings to a binary data file
+        if binary:
+            sinks.append(BinaryDayFileSink("R", self.name))
+        self.logger = BatchedDataLogger(sinks)
         if verbose:
-            print("Writing data to file:", DATA_DIR + self.filename)
-        self.rmfile = open(DATA_DIR + self.filename, "a")
-
-        # Start a thread to periodically flush the data to disk
-        self.flush_thread = threading.Thread(target=self.flush_file)
-        self.flush_thread.start()
+            print("Writing data to directory:", DATA_DIR)
+
+        # Optionally write the full rate readings around events to separate event files,
+        # and average blocks of readings for the main data file
+        self.events = None
+        if events:
+            self.events = EventCapture(self.logger, self.EVENT_SINK, rate, pre_trigger=pre_trigger,
+                                       post_trigger=post_trigger)
+        # Events are found as the readings are taken, and the peak of each is written to the detection file
+        self.detector = None
+        if events or detect:
+            self.detector = StreamingDetector(rate, trigger_sigma=trigger_sigma, trigger_step=trigger_step)
+            self.detector.on_trigger = self.trigger
+            self.detector.on_peak = self.log_detection
+        self.decimator = Decimator(decimate) if decimate > 1 else None
 
     # Log the date/time and lux reading
     def log_data(self, obs_time, lux_value, vis_level, ir_level, again, atime):
-        # Check for date change
-        try:
-            filename = "R" + self.name + obs_time.strftime("%Y%m%d") + ".csv"
-            if filename != self.filename:
-                self.rmfile.close()
-                self.filename = filename
-                self.rmfile = open(DATA_DIR + self.filename, "a")
-
-            # Log the data
-            out_string = '{0:s} {1:.9f} {2:d} {3:d} {4:.1f} {5:.1f}\n'.format(obs_time.strftime(
-                "%Y/%m/%d %H:%M:%S.%f")[:-3], lux_value, vis_level, ir_level, again, atime)
-            self.rmfile.write(out_string)
-            if verbose:
-                print(out_string, end='')
-
-        except Exception as e:
-            print(e)
-
-    # Flush the data log file to disk every 10s
-    def flush_file(self):
-        while True:
-            time.sleep(10)
-            try:
-                self.rmfile.flush()
-            except:
-                pass
+        if verbose:
+            print(obs_time, lux_value, vis_level, ir_level, again, atime)
+
+        values = (lux_value, vis_level, ir_level, again, atime)
+        if self.events is not None:
+            self.events.add(obs_time, values)
+        if self.detector is not None:
+            self.detector.add(obs_time, lux_value)
+        if self.decimator is not None:
+            block = self.decimator.add(obs_time, values)
+            if block is None:
+                return
+            obs_time, values = block
+
+        self.logger.log(self.DATA_SINK, obs_time, *values)
+        if self.binary:
+            self.logger.log(self.BINARY_SINK, obs_time, *values)
+
+    def trigger(self, obs_time):
+        # Start writing an event file, or extend the one being written
+        if self.events is not None:
+            self.events.trigger(obs_time)
+
+    # Log the peak of a detected event, and keep writing the event file until post_trigger seconds after it
+    def log_detection(self, peak_time, start_time, peak_lux, background, noise):
+        if verbose:
+            print("Event detected:", peak_time, peak_lux, background, noise)
+        self.logger.log(self.DETECTION_SINK, peak_time, start_time.strftime("%Y/%m/%d %H:%M:%S.%f")[:-3],
+                        peak_lux, background, noise)
+        self.trigger(peak_time)
 
 
 # Add a get_light_levels method to the adafruit_tsl2591 class
 class adafruit_tsl2591_extended(adafruit_tsl2591.TSL2591):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # GPIO line connected to the sensor's INT pin, or None to poll the status register
+        self.interrupt_line = None
+        # Monotonic time of the last interrupt seen by polling, to predict the end of the next integration
+        self.last_interrupt = None
+        # Status and channel registers read by wait_interrupt, for the following get_light_levels
+        self.block = None
+        self._block_buffer = bytearray(tsl2591_io.BLOCK_LENGTH)
+        # Clock for the reading times
+        self.clock = default_clock()
+        # Optional AcquisitionMetrics for the interrupt wait and i2c read times
+        self.metrics = None
+
+    def read_block(self):
+        # Status and both channels in one i2c transaction
+        return tsl2591_io.read_status_and_channels(self._device, self._block_buffer)
+
     def get_light_levels(self, disable_exception=False):
         """Read the sensor and calculate a lux value from both its infrared
         and visible light channels.
@@ -118,7 +189,12 @@ class adafruit_tsl2591_extended(adafruit_tsl2591.TSL2591):
             :attr:`lux` is not calibrated!
 
         """
-        channel_0, channel_1 = self.raw_luminosity
+        # Use the channels read with the interrupt status if there are any, otherwise read them now
+        if self.block is not None:
+            status, channel_0, channel_1 = self.block
+            self.block = None
+        else:
+            status, channel_0, channel_1 = self.read_block()
 
         # Compute the atime in milliseconds
         atime = 100.0 * self._integration_time + 100.0
@@ -137,36 +213,35 @@ class adafruit_tsl2591_extended(adafruit_tsl2591.TSL2591):
             )
             if not disable_exception:
                 raise RuntimeError(message)
-        # Calculate lux using same equation as Arduino library:
-        #  https://github.com/adafruit/Adafruit_TSL2591_Library/blob/master/Adafruit_TSL2591.cpp
-        again = 1.0
-        if self._gain == adafruit_tsl2591.GAIN_MED:
-            again = 25.0
-        elif self._gain == adafruit_tsl2591.GAIN_HIGH:
-            again = 428.0
-        elif self._gain == adafruit_tsl2591.GAIN_MAX:
-            again = 9876.0
-        cpl = (atime * again) / adafruit_tsl2591._TSL2591_LUX_DF
-        lux1 = (channel_0 - (adafruit_tsl2591._TSL2591_LUX_COEFB * channel_1)) / cpl
-        lux2 = (
-            (adafruit_tsl2591._TSL2591_LUX_COEFC * channel_0) -
-            (adafruit_tsl2591._TSL2591_LUX_COEFD * channel_1)
-        ) / cpl
+        # Calculate lux using same equation as Arduino library, see tsl2591_lux
+        again = tsl2591_lux.GAIN_FACTORS[self._gain]
+        lux = tsl2591_lux.reading_lux(channel_0, channel_1, again, atime)
 
         # Alternate lux calculation 1 - currently used by C++ libraries
         # See: https://github.com/adafruit/Adafruit_TSL2591_Library/issues/14
         #     lux = (((float)ch0 - (float)ch1)) * (1.0F - ((float)ch1 / (float)ch0)) / cpl;
         # alt_lux = ((float(channel_0) - float(channel_1))) * (1.0 - (float(channel_1) / float(channel_0))) / cpl
 
-        return max(lux1, lux2), channel_0, channel_1, again, atime
+        return lux, channel_0, channel_1, again, atime
+
+    # Power on with the ALS and no persist interrupts enabled, so that the INT pin signals each reading.
+    # Newer versions of adafruit_tsl2591 no longer enable the interrupts
+    def enable(self):
+        self._write_u8(
+            tsl2591_io.REGISTER_ENABLE,
+            tsl2591_io.ENABLE_POWERON
+            | tsl2591_io.ENABLE_AEN
+            | tsl2591_io.ENABLE_AIEN
+            | tsl2591_io.ENABLE_NPIEN,
+        )
 
     # Switch off only the ADC_EN
     def adc_en_off(self):
         self._write_u8(
-            adafruit_tsl2591._TSL2591_REGISTER_ENABLE,
-            adafruit_tsl2591._TSL2591_ENABLE_POWERON
-            | adafruit_tsl2591._TSL2591_ENABLE_AIEN
-            | adafruit_tsl2591._TSL2591_ENABLE_NPIEN,
+            tsl2591_io.REGISTER_ENABLE,
+            tsl2591_io.ENABLE_POWERON
+            | tsl2591_io.ENABLE_AIEN
+            | tsl2591_io.ENABLE_NPIEN,
         )
 
     def reset(self):
@@ -184,22 +259,45 @@ class adafruit_tsl2591_extended(adafruit_tsl2591.TSL2591):
 
     def clear_interrupts(self):
         # Clear ALS interrupts.
-        with self._device as i2c:
-            # Make sure to add command bit and special function bit to write request.
-            sf = 0x07
-            self._BUFFER[0] = (0xE0 | sf) & 0xFF
-            self._BUFFER[1] = 0x00 & 0xFF
-            i2c.write(self._BUFFER, end=2)
+        tsl2591_io.clear_interrupts(self._device, self._BUFFER)
 
     def wait_interrupt(self):
-        # Wait for AINT interrupt to signal a reading has completed
-        # Initial sleep 500ms
-        time.sleep(0.5)
-        # Get the status to check for the AINT interrupt being asserted
-        while self._read_u8(0x13) & 0x10 == 0:
-            time.sleep(0.05)
+        # Wait for AINT interrupt to signal a reading has completed, and return the time it completed.
+        # The channels are read with the status, and kept for get_light_levels
+        start_ns = time.perf_counter_ns()
+        if self.interrupt_line is not None:
+            # Wait for the INT line's falling edge, which the kernel timestamps at the end of the integration.
+            # If no edge comes, e.g. because one was missed, check the status register anyway
+            while True:
+                edge_ns = self.interrupt_line.wait(tsl2591_io.INTERRUPT_TIMEOUT)
+                poll_time = self.clock.now()
+                read_ns = time.perf_counter_ns()
+                self.block = self.read_block()
+                if edge_ns is not None or self.block[0] & tsl2591_io.STATUS_AINT:
+                    break
+            time_stamp = poll_time if edge_ns is None else tsl2591_io.monotonic_ns_to_datetime(edge_ns)
+        else:
+            # Sleep until just before the integration is expected to end, then poll the status register.
+            # The end is only known if a previous poll saw the interrupt arrive, otherwise poll from now on
+            if self.last_interrupt is not None:
+                integration_time = 0.1 * self._integration_time + 0.1
+                time.sleep(max(0.0, self.last_interrupt + integration_time - POLL_MARGIN - time.monotonic()))
+            polls = 0
+            while True:
+                time_stamp = self.clock.now()
+                read_ns = time.perf_counter_ns()
+                self.block = self.read_block()
+                polls += 1
+                if self.block[0] & tsl2591_io.STATUS_AINT:
+                    break
+                time.sleep(POLL_INTERVAL)
+            self.last_interrupt = time.monotonic() if polls > 1 else None
 
         self.clear_interrupts()
+        if self.metrics is not None:
+            self.metrics.add(STAGE_WAIT, read_ns - start_ns)
+            self.metrics.lap(STAGE_I2C, read_ns)
+        return time_stamp
 
 
 # Main program
@@ -218,6 +316,32 @@ if __name__ == "__main__":
                     help="Connect to the i2c sensor via an adafruit TCA9548A multiplexer using the number of the multiplexer channel e.g. 0-7")
     ap.add_argument("-n", "--name", type=str, default="",
                     help="Optional name of the sensor for the output file name. Default is no name")
+    ap.add_argument("--binary", action='store_true',
+                    help="Also write the readings to a binary .bin data file")
+    ap.add_argument("--events", action='store_true',
+                    help="Write the full rate readings around sudden increases in light level (e.g. fireballs) to separate event files")
+    ap.add_argument("--detect", action='store_true',
+                    help="Record the peaks of sudden increases in light level to F*.csv detection files. Implied by --events")
+    ap.add_argument("--pre-trigger", type=float, default=PRE_TRIGGER,
+                    help="Seconds of readings written before an event. Default is " + str(PRE_TRIGGER))
+    ap.add_argument("--post-trigger", type=float, default=POST_TRIGGER,
+                    help="Seconds of readings written after an event. Default is " + str(POST_TRIGGER))
+    ap.add_argument("--trigger-step", type=float, default=TRIGGER_STEP,
+                    help="Minimum rise in lux above the background which triggers an event. Default is " + str(TRIGGER_STEP))
+    ap.add_argument("--trigger-sigma", type=float, default=TRIGGER_SIGMA,
+                    help="Rise above the background in noise levels (standard deviations) which triggers an event. Default is " + str(TRIGGER_SIGMA))
+    ap.add_argument("-d", "--decimate", type=int, default=1,
+                    help="Write the average of this many readings to the main data file. Default is 1 (every reading)")
+    ap.add_argument("-i", "--interrupt", type=str, default=None,
+                    help="GPIO line connected to the sensor's INT pin as chip:line e.g. gpiochip0:4, to wait for readings without polling the sensor. Needs the gpiod package")
+    ap.add_argument("--fake", action='store_true',
+                    help="Use a software sensor instead of the i2c bus and GPIO line, for testing")
+    ap.add_argument("--metrics", action='store_true',
+                    help="Write the timings of each stage of a reading to a status file e.g. /dev/shm/sqm_tsl2591_metrics.json")
+    ap.add_argument("--metrics-interval", type=float, default=EXPORT_INTERVAL,
+                    help="Seconds between status file updates. Default is " + str(EXPORT_INTERVAL))
+    ap.add_argument("--metrics-port", type=int, default=None,
+                    help="Also serve the timings as text metrics over http on this port e.g. 9100")
     ap.add_argument("-v", "--verbose", action='store_true',
                     help="Verbose output to terminal")
     args = vars(ap.parse_args())
@@ -241,7 +365,12 @@ if __name__ == "__main__":
     signal.signal(signal.SIGTERM, signalHandler)
 
     # Open the i2c bus
-    i2c = I2C(i2c_bus)
+    if args['fake']:
+        import tsl2591_fake
+        i2c = tsl2591_fake.FakeTSL2591Bus(address=i2c_address)
+    else:
+        from adafruit_extended_bus import ExtendedI2C as I2C
+        i2c = I2C(i2c_bus)
 
     # Create the sensor or TCA9548A object and pass it the I2C bus
     if multiplexer is not None:
@@ -252,6 +381,13 @@ if __name__ == "__main__":
     else:
         sensor = adafruit_tsl2591_extended(i2c, address=i2c_address)
 
+    # Wait for readings on the INT line instead of polling the status register
+    if args['interrupt'] is not None:
+        if args['fake']:
+            sensor.interrupt_line = tsl2591_fake.FakeInterruptLine(i2c)
+        else:
+            sensor.interrupt_line = tsl2591_io.GpioInterruptLine(*tsl2591_io.parse_gpio_line(args['interrupt']))
+
     # Set gain and integration time (600ms)
     sensor.enable()
     gain_level = required_device_gain_setting
@@ -264,32 +400,45 @@ if __name__ == "__main__":
     time.sleep(0.5)
 
     # Create the data logger
-    radiometer_data_logger = RadiometerDataLogger(name=device_name)
+    radiometer_data_logger = RadiometerDataLogger(
+        name=device_name, binary=args['binary'], events=args['events'], detect=args['detect'],
+        decimate=args['decimate'], pre_trigger=args['pre_trigger'], post_trigger=args['post_trigger'],
+        trigger_sigma=args['trigger_sigma'], trigger_step=args['trigger_step'])
 
     # Create the SQM readings writer
     sqm_writer = Sqm_Writer()
 
+    # Time each stage of a reading, and optionally export the timings
+    metrics = AcquisitionMetrics(device_name)
+    sensor.metrics = metrics
+    if args['metrics'] or args['metrics_port'] is not None:
+        start_metrics_exporter("sqm_tsl2591" + radiometer_data_logger.name.rstrip("_"),
+                               interval=args['metrics_interval'], port=args['metrics_port'])
+
 
     while True:
         try:
-            # Wait for an ALS interrupt to signal a reading has completed
-            sensor.wait_interrupt()
-
-            # Get a time stamp for the latest reading
-            time_stamp = datetime.datetime.now()
+            # Wait for an ALS interrupt to signal a reading has completed, and get its time stamp
+            time_stamp = sensor.wait_interrupt()
+            metrics.reading(0.1 * sensor._integration_time + 0.1)
+            t = metrics.now()
 
             # Read and calculate the light level in lux.
             lux, vis_level, ir_level, again, atime = sensor.get_light_levels()
+            t = metrics.lap(STAGE_LUX, t)
 
             # Log the latest reading
             radiometer_data_logger.log_data(
                 time_stamp, lux, vis_level, ir_level, again, atime)
+            t = metrics.lap(STAGE_LOG, t)
 
             # Write the latest SQM value
-            sqm_writer.update(np.log10(lux/108000)/-0.4)
+            sqm_writer.update(tsl2591_lux.reading_sqm(lux), time_stamp)
+            metrics.lap(STAGE_SQM, t)
 
             # Check if the gain level can be changed back to max
             if auto_gain and gain_level != adafruit_tsl2591.GAIN_MAX and lux < 1.0:
+                metrics.gain_switch_started()
                 # sensor.disable()
                 sensor.adc_en_off()
                 gain_level = adafruit_tsl2591.GAIN_MAX
@@ -298,6 +447,7 @@ if __name__ == "__main__":
                 sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_600MS
                 # Wait for next valid reading
                 sensor.wait_interrupt()
+                metrics.gain_switch_finished()
                 # time.sleep(GUARD_TIME)
 
             # Reset the saturation counter amd store the previous lux value
@@ -316,6 +466,7 @@ if __name__ == "__main__":
                 if saturation_counter > 100:
                     reset_sensor(sensor, gain_level,
                                  adafruit_tsl2591.INTEGRATIONTIME_100MS)
+                    metrics.restart()
                     saturation_counter = 0
                 continue
 
@@ -330,6 +481,7 @@ if __name__ == "__main__":
                     radiometer_data_logger.log_data(
                         time_stamp, prev_lux, vis_level, ir_level, again, atime)
 
+                metrics.gain_switch_started()
                 # sensor.disable()
                 sensor.adc_en_off()
                 gain_level = adafruit_tsl2591.GAIN_MED
@@ -338,6 +490,7 @@ if __name__ == "__main__":
                 sensor.integration_time = adafruit_tsl2591.INTEGRATIONTIME_100MS
                 # Sleep to ensure next reading is valid
                 sensor.wait_interrupt()
+                metrics.gain_switch_finished()
                 # time.sleep(GUARD_TIME)
 
             # If the sensor has been saturated for a long time (60s), reset the sensor and then stay asleep
@@ -354,12 +507,12 @@ if __name__ == "__main__":
                     time.sleep(1)
                     try:
                         lux, vis_level, ir_level, again, atime = sensor.get_light_levels()
-                        time_stamp = datetime.datetime.now()
+                        time_stamp = default_clock().now()
                         radiometer_data_logger.log_data(
                             time_stamp, lux, vis_level, ir_level, again, atime)
  
                         # Write the new SQM value
-                        sqm_writer.update(np.log10(lux/108000)/-0.4)
+                        sqm_writer.update(tsl2591_lux.reading_sqm(lux), time_stamp)
 
                     except Exception as e:
                         print(e)
@@ -371,5 +524,6 @@ if __name__ == "__main__":
                     sensor.gain = gain_level
                     sensor.enable()
                     time.sleep(1)
+                    metrics.restart()
 
             time.sleep(0.05)
@@ -0,0 +1,278 @@
+import math
+import random
+import time
+import tsl2591_lux
+from tsl2591_io import (REGISTER_ENABLE, REGISTER_STATUS, ENABLE_AEN, ENABLE_AIEN, ENABLE_NPIEN,
+                        STATUS_AVALID, STATUS_AINT, STATUS_NPINTR)
+
+# Software TSL2591 for running and testing the acquisition scripts on any Linux machine.
+# FakeTSL2591Bus stands in for the i2c bus (the busio.I2C interface used by adafruit_bus_device),
+# with one TSL2591 whose integrations run on the clock, and FakeInterruptLine stands in for the
+# GPIO line connected to its INT pin. FakeI2CBus is a bus with a separate TSL2591 at each address
+# and behind each channel of a TCA9548A multiplexer, for running several sensors at once.
+
+TSL2591_ADDRESS = 0x29
+DEVICE_ID = 0x50
+
+REGISTER_CONTROL = 0x01
+REGISTER_DEVICE_ID = 0x12
+REGISTER_C0DATAL = 0x14
+
+CONTROL_SRESET = 0x80
+
+# Special functions in the command register
+SPECIAL_FUNCTION = 0xE0
+SF_FORCE_INTERRUPT = 0x04
+SF_CLEAR_ALS = 0x06
+SF_CLEAR_ALS_NP = 0x07
+SF_CLEAR_NP = 0x0A
+
+# Addresses of a TCA9548A multiplexer, whose channel is selected by writing a byte with its bit set
+TCA9548A_ADDRESSES = range(0x70, 0x78)
+
+MAX_COUNT_100MS = 36863
+MAX_COUNT = 65535
+
+# Points at which the light source is sampled during each integration, as the counts are the light
+# collected over the whole integration time
+INTEGRATION_SAMPLES = 8
+
+# Channel 0 and channel 1 counts per ms of integration at gain 1 for a dark sky,
+# about 120 and 40 counts at maximum gain and 100ms
+DARK_SKY_RATE = (1.2e-4, 4.0e-5)
+
+
+def dark_sky(elapsed):
+    # Light source: counts per ms at gain 1 on each channel, at elapsed seconds of sensor time
+    return DARK_SKY_RATE
+
+
+class FakeTSL2591Bus():
+
+    def __init__(self, light=dark_sky, noise=True, address=TSL2591_ADDRESS):
+        self.light = light
+        self.noise = noise
+        self.address = address
+        self.registers = bytearray(32)
+        self.registers[REGISTER_DEVICE_ID] = DEVICE_ID
+        self.pointer = 0
+        self.start = time.monotonic()
+
+        # Sensor time at which the current run of integrations started, and the number completed
+        self.cycle_start = None
+        self.completed = 0
+
+        # Monotonic time in ns of the latest INT falling edge not yet seen by a FakeInterruptLine
+        self.edge_ns = None
+
+        # Number of i2c transactions, for comparing ways of reading the sensor
+        self.transactions = 0
+
+    # Sensor time is the time since the sensor was created. It follows the monotonic clock, which
+    # simulator.py runs faster than real time
+    def sensor_time(self):
+        return time.monotonic() - self.start
+
+    def monotonic_time(self, sensor_time):
+        return self.start + sensor_time
+
+    def integration_time(self):
+        return 0.1 * (self.registers[REGISTER_CONTROL] & 0x07) + 0.1
+
+    def interrupt_asserted(self):
+        status = self.registers[REGISTER_STATUS]
+        enable = self.registers[REGISTER_ENABLE]
+        return bool((status & STATUS_AINT and enable & ENABLE_AIEN) or (status & STATUS_NPINTR and enable & ENABLE_NPIEN))
+
+    def next_integration_end(self):
+        # Monotonic time of the end of the integration in progress, or None if the ADC is off
+        if self.cycle_start is None:
+            return None
+        return self.monotonic_time(self.cycle_start + (self.completed + 1) * self.integration_time())
+
+    def start_integration(self):
+        if self.registers[REGISTER_ENABLE] & ENABLE_AEN:
+            self.cycle_start = self.sensor_time()
+            self.completed = 0
+        else:
+            self.cycle_start = None
+
+    def counts(self, end_time):
+        control = self.registers[REGISTER_CONTROL]
+        again = tsl2591_lux.GAIN_FACTORS[control & 0x30]
+        atime = 100.0 * (control & 0x07) + 100.0
+        max_counts = MAX_COUNT_100MS if control & 0x07 == 0 else MAX_COUNT
+
+        # Average light level over the integration
+        rates = [0.0, 0.0]
+        for i in range(INTEGRATION_SAMPLES):
+            sample = self.light(end_time - atime / 1000.0 * (i + 0.5) / INTEGRATION_SAMPLES)
+            rates[0] += sample[0] / INTEGRATION_SAMPLES
+            rates[1] += sample[1] / INTEGRATION_SAMPLES
+
+        counts = []
+        for rate in rates:
+            count = rate * again * atime
+            if self.noise:
+                count = random.gauss(count, math.sqrt(count))
+            counts.append(min(max_counts, max(0, int(round(count)))))
+        return counts
+
+    def update(self):
+        # Complete the integrations which have ended since the last access: latch the channel data
+        # of the latest one and set the interrupt flags
+        if self.cycle_start is None:
+            return
+        end_count = int((self.sensor_time() - self.cycle_start) / self.integration_time())
+        if end_count <= self.completed:
+            return
+        self.completed = end_count
+        end_time = self.cycle_start + end_count * self.integration_time()
+        channel_0, channel_1 = self.counts(end_time)
+        self.registers[REGISTER_C0DATAL:REGISTER_C0DATAL + 4] = (
+            channel_0.to_bytes(2, 'little') + channel_1.to_bytes(2, 'little'))
+
+        was_asserted = self.interrupt_asserted()
+        self.registers[REGISTER_STATUS] |= STATUS_AVALID | STATUS_AINT | STATUS_NPINTR
+        if not was_asserted and self.interrupt_asserted():
+            self.edge_ns = int(self.monotonic_time(end_time) * 1e9)
+
+    def command(self, value):
+        if value & SPECIAL_FUNCTION == SPECIAL_FUNCTION:
+            function = value & 0x1F
+            if function in (SF_CLEAR_ALS, SF_CLEAR_ALS_NP):
+                self.registers[REGISTER_STATUS] &= ~STATUS_AINT & 0xFF
+            if function in (SF_CLEAR_NP, SF_CLEAR_ALS_NP):
+                self.registers[REGISTER_STATUS] &= ~STATUS_NPINTR & 0xFF
+            if function == SF_FORCE_INTERRUPT:
+                self.registers[REGISTER_STATUS] |= STATUS_AINT
+        else:
+            self.pointer = value & 0x1F
+
+    def write_register(self, register, value):
+        if register == REGISTER_CONTROL and value & CONTROL_SRESET:
+            # Software reset
+            self.registers[REGISTER_ENABLE] = 0
+            self.registers[REGISTER_CONTROL] = 0
+            self.registers[REGISTER_STATUS] = 0
+            self.cycle_start = None
+            return
+        self.registers[register] = value
+        # Changing the enable, gain or integration time starts a new integration
+        if register in (REGISTER_ENABLE, REGISTER_CONTROL):
+            self.start_integration()
+
+    # busio.I2C interface
+
+    def try_lock(self):
+        return True
+
+    def unlock(self):
+        pass
+
+    def deinit(self):
+        pass
+
+    def scan(self):
+        return [self.address]
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        self.transactions += 1
+        self.update()
+        data = bytes(buffer[start:end])
+        if not data:
+            return
+        self.command(data[0])
+        for value in data[1:]:
+            self.write_register(self.pointer, value)
+            self.pointer += 1
+
+    def readfrom_into(self, address, buffer, *, start=0, end=None, transaction=True):
+        if transaction:
+            self.transactions += 1
+            self.update()
+        if end is None:
+            end = len(buffer)
+        for i in range(start, end):
+            buffer[i] = self.registers[self.pointer & 0x1F]
+            self.pointer += 1
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, *, out_start=0, out_end=None, in_start=0, in_end=None):
+        # One transaction with a repeated start
+        self.writeto(address, buffer_out, start=out_start, end=out_end)
+        self.readfrom_into(address, buffer_in, start=in_start, end=in_end, transaction=False)
+
+
+class FakeI2CBus():
+    # Stands in for one i2c bus, with a FakeTSL2591Bus for each address and multiplexer channel used, so that
+    # each sensor has its own gain, integration time and integrations
+
+    def __init__(self, light=dark_sky, noise=True):
+        self.light = light
+        self.noise = noise
+        self.devices = {}  # (multiplexer channel or None, address): FakeTSL2591Bus
+        self.channel = None
+
+    def device(self, address, channel=None):
+        key = (channel, address)
+        if key not in self.devices:
+            self.devices[key] = FakeTSL2591Bus(light=self.light, noise=self.noise, address=address)
+        return self.devices[key]
+
+    @property
+    def transactions(self):
+        return sum(device.transactions for device in self.devices.values())
+
+    # busio.I2C interface
+
+    def try_lock(self):
+        return True
+
+    def unlock(self):
+        pass
+
+    def deinit(self):
+        pass
+
+    def scan(self):
+        return sorted({address for channel, address in self.devices if channel == self.channel})
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        if address in TCA9548A_ADDRESSES:
+            # Select the lowest channel whose bit is set, or none
+            data = bytes(buffer[start:end])
+            mask = data[-1] if data else 0
+            self.channel = (mask & -mask).bit_length() - 1 if mask else None
+            return
+        self.device(address, self.channel).writeto(address, buffer, start=start, end=end)
+
+    def readfrom_into(self, address, buffer, *, start=0, end=None):
+        self.device(address, self.channel).readfrom_into(address, buffer, start=start, end=end)
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, *, out_start=0, out_end=None, in_start=0, in_end=None):
+        self.device(address, self.channel).writeto_then_readfrom(
+            address, buffer_out, buffer_in, out_start=out_start, out_end=out_end, in_start=in_start, in_end=in_end)
+
+
+class FakeInterruptLine():
+    # Waits for the INT falling edges of a FakeTSL2591Bus, with the same interface as tsl2591_io.GpioInterruptLine
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def wait(self, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            self.bus.update()
+            if self.bus.edge_ns is not None:
+                edge_ns, self.bus.edge_ns = self.bus.edge_ns, None
+                return edge_ns
+            now = time.monotonic()
+            if now >= deadline:
+                return None
+            next_end = self.bus.next_integration_end()
+            wake = deadline if next_end is None else min(deadline, next_end)
+            time.sleep(max(0.0, wake - now) + 1e-4)
+
+    def close(self):
+        pass
@@ -0,0 +1,86 @@
+import datetime
+import obs_clock
+
+# Low level TSL2591 access shared by the driver extensions: the status and channel data registers
+# in one i2c transaction, and waiting for the sensor's INT line through the Linux GPIO character device.
+
+# Command register: command bit with normal operation, and the special function to clear the
+# ALS and no persist ALS interrupts
+COMMAND_NORMAL = 0xA0
+COMMAND_CLEAR_INTERRUPTS = 0xE0 | 0x07
+
+# STATUS, C0DATAL, C0DATAH, C1DATAL and C1DATAH are consecutive registers, so one block read
+# starting at STATUS returns the interrupt flags with both channels of the same integration
+REGISTER_STATUS = 0x13
+BLOCK_LENGTH = 5
+
+# ENABLE register bits. The ALS and no persist interrupt enables make the INT pin signal each reading
+REGISTER_ENABLE = 0x00
+ENABLE_POWERON = 0x01
+ENABLE_AEN = 0x02
+ENABLE_AIEN = 0x10
+ENABLE_NPIEN = 0x80
+
+# STATUS register flags
+STATUS_AVALID = 0x01
+STATUS_AINT = 0x10
+STATUS_NPINTR = 0x20
+
+# Seconds to wait for an interrupt edge before checking the status register anyway, in case an edge was missed
+INTERRUPT_TIMEOUT = 2.0
+
+
+def read_status_and_channels(device, buffer=None):
+    # Read STATUS and both channels in one write then read transaction on the i2c device.
+    # Returns the status flags, channel 0 and channel 1 counts
+    if buffer is None:
+        buffer = bytearray(BLOCK_LENGTH)
+    buffer[0] = COMMAND_NORMAL | REGISTER_STATUS
+    with device as i2c:
+        i2c.write_then_readinto(buffer, buffer, out_end=1, in_end=BLOCK_LENGTH)
+    return buffer[0], buffer[1] | (buffer[2] << 8), buffer[3] | (buffer[4] << 8)
+
+
+def clear_interrupts(device, buffer=None):
+    # Clear the ALS and no persist ALS interrupts, which releases the INT line
+    if buffer is None:
+        buffer = bytearray(1)
+    buffer[0] = COMMAND_CLEAR_INTERRUPTS
+    with device as i2c:
+        i2c.write(buffer, end=1)
+
+
+def monotonic_ns_to_datetime(timestamp_ns):
+    # Convert a CLOCK_MONOTONIC timestamp, as used for GPIO edge events, to a local datetime
+    return obs_clock.default_clock().from_monotonic_ns(timestamp_ns)
+
+
+class GpioInterruptLine():
+    # The sensor's open drain, active low INT pin connected to a GPIO line, e.g. chip "gpiochip0" line 4.
+    # Waits for the falling edge in the kernel instead of polling the STATUS register over i2c, and
+    # uses the kernel's timestamp of the edge, i.e. the end of the integration.
+    # Needs the libgpiod version 2 python bindings (pip install gpiod)
+
+    def __init__(self, chip, line, consumer="tsl2591"):
+        import gpiod
+        from gpiod.line import Bias, Edge
+        if not chip.startswith("/"):
+            chip = "/dev/" + chip
+        self.line = line
+        self.request = gpiod.request_lines(chip, consumer=consumer, config={
+            line: gpiod.LineSettings(edge_detection=Edge.FALLING, bias=Bias.PULL_UP)})
+
+    def wait(self, timeout=INTERRUPT_TIMEOUT):
+        # Returns the CLOCK_MONOTONIC time in ns of the latest falling edge, or None on a timeout
+        if not self.request.wait_edge_events(datetime.timedelta(seconds=timeout)):
+            return None
+        return self.request.read_edge_events()[-1].timestamp_ns
+
+    def close(self):
+        self.request.release()
+
+
+def parse_gpio_line(spec):
+    # Parse a GPIO line description "chip:line" e.g. "gpiochip0:4", or just a line number on gpiochip0
+    chip, _, line = spec.rpartition(":")
+    return chip or "gpiochip0", int(line)
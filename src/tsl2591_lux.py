@@ -0,0 +1,81 @@
+import math
+import numpy as np
+
+# Conversion of TSL2591 raw channel counts to lux, sky brightness and irradiance.
+# All the functions take numpy arrays (or single values) so that whole nights of raw counts
+# can be converted in one go, and old data can be reprocessed if the constants change.
+# reading_lux and reading_sqm do the same for a single reading in plain Python, for the acquisition
+# loops, where converting each value to and from numpy would cost more than the calculation.
+
+# Taken from https://github.com/adafruit/Adafruit_CircuitPython_TSL2591/blob/main/adafruit_tsl2591.py
+LUX_DF = 408.0
+LUX_COEFB = 1.64
+LUX_COEFC = 0.59
+LUX_COEFD = 0.86
+
+# Gain factors for the TSL2591 gain register codes GAIN_LOW, GAIN_MED, GAIN_HIGH and GAIN_MAX
+GAIN_FACTORS = {0x00: 1.0, 0x10: 25.0, 0x20: 428.0, 0x30: 9876.0}
+GAIN_FACTOR_TABLE = np.full(256, np.nan)
+for gain_code, factor in GAIN_FACTORS.items():
+    GAIN_FACTOR_TABLE[gain_code] = factor
+
+# High gain factor, the gain at which the datasheet irradiance responsivity is measured
+GAIN_HIGH = 428.0
+
+# Re irradiance responsivity from TSL2591 datasheet, white light on "visible" sensor channel 0
+# The 100 scaling factor is to convert the RE_WHITE_CHANNEL0 from the datsheet units of counts/(μW/cm2) to counts/(W/m2)
+RE_WHITE_CHANNEL0 = 264.1 * 100
+
+# Lux of a sky brightness of 0 mag/arcsec^2
+SQM_ZERO_LUX = 108000
+
+
+def gain_factor(gain_code):
+    # Gain factor for TSL2591 gain register codes
+    return GAIN_FACTOR_TABLE[gain_code]
+
+
+def integration_time_ms(atime_code):
+    # Integration time in ms for TSL2591 integration time register codes
+    return 100.0 * np.asarray(atime_code) + 100.0
+
+
+def lux(channel_0, channel_1, again, atime):
+    # Calculate lux using same equation as Arduino library:
+    #  https://github.com/adafruit/Adafruit_TSL2591_Library/blob/master/Adafruit_TSL2591.cpp
+    # again is the gain factor e.g. 9876.0 and atime the integration time in ms
+    channel_0 = np.asarray(channel_0, dtype=np.float64)
+    channel_1 = np.asarray(channel_1, dtype=np.float64)
+    cpl = (atime * np.asarray(again, dtype=np.float64)) / LUX_DF
+    lux1 = (channel_0 - (LUX_COEFB * channel_1)) / cpl
+    lux2 = ((LUX_COEFC * channel_0) - (LUX_COEFD * channel_1)) / cpl
+    return np.maximum(lux1, lux2)
+
+
+def reading_lux(channel_0, channel_1, again, atime):
+    # lux of one reading, as a float. The same calculation in the same order as lux, so gives the same value
+    cpl = (atime * again) / LUX_DF
+    lux1 = (channel_0 - (LUX_COEFB * channel_1)) / cpl
+    lux2 = ((LUX_COEFC * channel_0) - (LUX_COEFD * channel_1)) / cpl
+    return float(max(lux1, lux2))
+
+
+def sqm(lux_value):
+    # Sky brightness in mag/arcsec^2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log10(np.asarray(lux_value) / SQM_ZERO_LUX) / -0.4
+
+
+def reading_sqm(lux_value):
+    # sqm of one reading, as a float: infinite for 0 lux and NaN for negative lux, as for sqm
+    if lux_value > 0:
+        return math.log10(lux_value / SQM_ZERO_LUX) / -0.4
+    return math.inf if lux_value == 0 else math.nan
+
+
+def irradiance(channel_0, again):
+    # Irradiance in W/m2 from the channel 0 counts.
+    # The RE_WHITE_CHANNEL0 measured in the datasheet is measured at high gain, so divide by the GAIN_HIGH factor
+    # Note: datasheet says the gain scaling for max gain is 9200/400
+    gain_scaling = np.asarray(again, dtype=np.float64) / GAIN_HIGH
+    return np.asarray(channel_0, dtype=np.float64) / (RE_WHITE_CHANNEL0 * gain_scaling)